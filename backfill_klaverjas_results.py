@@ -9,6 +9,8 @@ for i, d in enumerate(m.games.all()):
   print(i, end="\r")
   if d['game_type'] != 100:
     continue
+  if d.get('version'): # saved as moves, these save their result when they end
+    continue
   g = pickle.loads(d['game_data'])
   if g.is_active:
     continue
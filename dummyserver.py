@@ -24,14 +24,13 @@ def make_message(s):
 
 def alias_list():
     h = henkBot
-    pairs = h.aliasdict.items()
 
     categories = []
     responses = []
     mix = []
-    for i in set(h.aliasdict.values()):
-        categories.append([k for k,v in pairs if v==i])
-        responses.append(h.userresponses.get(i,[]))
+    for root, members in h.aliasindex.members.items():
+        categories.append(list(members))
+        responses.append(h.aliasindex.pooled[root])
 
         mix.append((categories[-1],responses[-1]))
         
@@ -12,12 +12,11 @@ import time
 import random
 import math
 import json
+import signal
 import urllib3
 from collections import OrderedDict
 import threading
 
-import difflib
-
 import telepot
 from telepot.loop import MessageLoop
 from telepot.namedtuple import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, ForceReply
@@ -27,7 +26,7 @@ from telepot.namedtuple import InlineQueryResultArticle, InlineQueryResultPhoto,
 
 from managedata import ManageData
 import longstrings
-from util import get_current_hour, normalise, prepare_query, startswith, probaccept, Message
+from util import get_current_hour, normalise, prepare_query, probaccept, startswith, Message, AliasIndex, Dispatcher, PrefixMatcher, ThrottleStore
 import modules
 
 
@@ -39,18 +38,24 @@ class Henk(object):
         self.telebot = telebot # the bot interface for Telegram
         self.dataManager = ManageData() #interface to the database
         if isdummy: self.dataManager.dummy = True
+        else: self.dataManager.start_maintenance(keep=lambda: self.games.open_ids()) #closes and archives old games now and then
         self.should_exit = False
         self.messagelock = threading.Lock()
 
-        self.querycounts = {} #counts how many times I've said a thing lately
-        self.lastupdate = 0 #how long it has been since I've updated querycounts
-        self.active = False #whether someone has just talked to me
+        self.throttle = ThrottleStore() #per chat: how many times I've said a thing lately and whether someone has just talked to me
+        self.local = threading.local() #the state of the message the current thread is handling
+        self.dispatcher = Dispatcher() #hands slow commands to worker threads
         
         self.morning_message_timer = 0 #how long ago we have said a morning message
+        self.morninglock = threading.Lock() #held by the thread that is deciding on a morning message
 
         self.slashcommands = OrderedDict() # command:callback where the callback takes two arguments, (self,msg)
         self.commandcategories = OrderedDict() #commandtype:callback where commandtype is a key in self.commands
+        self.slowcommands = set() #slash commands and command categories whose callbacks take long, see add_slash_command
+        self.slowcategories = set()
         self.callback_query_types = OrderedDict() #ident:callback for special reply actions from Telegram
+        self.callback_query_index = {} #ident:(number in callback_query_types, callback, slow)
+        self.callback_query_lengths = [] #the different lengths of the idents, sorted
 
         self.load_files() #must be called before module.register_commands
 
@@ -62,56 +67,56 @@ class Henk(object):
 
         self.admin_ids = [19620232] #John
 
-    def add_slash_command(self,command, callback):
+    def add_slash_command(self,command, callback, slow=False):
+        '''slow should be set when the callback can take a while, like when it needs a website,
+        so the message is handled by a worker thread instead of holding up the other chats'''
         if command in self.slashcommands:
             raise Exception("Slashcommand %s is already implemented" % command)
         self.slashcommands[command] = callback
+        if slow: self.slowcommands.add(command)
         return
 
-    def add_command_category(self, command, callback):
+    def add_command_category(self, command, callback, slow=False):
         if command in self.commandcategories:
             raise Exception("Command Category %s is already implemented" % command)
         if command not in self.commands:
             raise Exception("Unknown command category %s" % command)
         self.commandcategories[command] = callback
+        if slow: self.slowcategories.add(command)
+        self.compile_commands()
 
-    def add_callback_query(self, ident, callback):
+    def add_callback_query(self, ident, callback, slow=False):
+        '''slow works like it does for add_slash_command'''
         if ident in self.callback_query_types:
             raise Exception("Callback ident %s already used" % ident)
+        self.callback_query_index[ident] = (len(self.callback_query_types), callback, slow)
         self.callback_query_types[ident] = callback
+        self.callback_query_lengths = sorted(set(len(i) for i in self.callback_query_types))
+
+    def find_callback_entry(self, data):
+        '''Returns (number, callback, slow) of the first registered ident that data starts with, or None'''
+        found = None
+        for n in self.callback_query_lengths:
+            if n > len(data): break
+            entry = self.callback_query_index.get(data[:n])
+            if entry and (not found or entry[0] < found[0]): found = entry
+        return found
+
+    def find_callback_query(self, data):
+        '''Returns the callback of the first registered ident that data starts with, or None'''
+        found = self.find_callback_entry(data)
+        return found[1] if found else None
 
     def build_response_dict(self):
-        aliases = self.dataManager.get_all_aliases()
-        self.aliasdict = {} #mapping a query to an int
-        #usually we will call pick(self.userresponses[self.aliasdict[query]])
-        i = 0
-        for synonyms in aliases: #go trough all lists of aliases
-            for query in self.aliasdict: #for all registered aliases
-                if query in synonyms: #check if it is in this list
-                    for s in synonyms: #and then register them as the same
-                        self.aliasdict[s] = self.aliasdict[query]
-                    break
-            else: #if not in the registered list
-                for s in synonyms: #register them as a new subset
-                    self.aliasdict[s] = i
-                i += 1
-
-        d = self.dataManager.get_all_responses()
-        for k,v in list(d.items()):
-            if k.startswith("$"): #special queries such as $question_what
-                self.responses[k[1:]].extend(v)
-                del d[k]
-
-        self.userresponses = {} #mapping an int (from aliases) to a list of responses
-        for query in d:
-            if query in self.aliasdict:
-                if self.aliasdict[query] in self.userresponses:
-                    self.userresponses[self.aliasdict[query]].extend(d[query])
-                else: self.userresponses[self.aliasdict[query]] = d[query]
-            else:
-                self.aliasdict[query] = i
-                self.userresponses[i] = d[query]
-                i += 1
+        '''Reads the learned responses and aliases from the database. After that they are
+        kept up to date by the commands that change them, so this is only needed on a reload.'''
+        rows = []
+        for user_id, call, response in self.dataManager.get_response_rows():
+            if call.startswith("$"): #special queries such as $question_what
+                self.responses[call[1:]].extend(response.split(" | "))
+            else: rows.append((user_id, call, response))
+        #usually we will call pick(self.aliasindex.responses_for(query))
+        self.aliasindex = AliasIndex(rows, self.dataManager.get_alias_rows())
 
     def load_files(self):
         f = open("commands.json","r")
@@ -121,33 +126,51 @@ class Henk(object):
         self.responses = d["responses"]
 
         self.build_response_dict()
+        self.compile_commands()
         
         self.silentchats = self.dataManager.get_silent_chats()
         for module in modules.modules:
             module.initialise(self)
 
+    def compile_commands(self):
+        '''Builds the matchers of the phrases in self.commands that messages are routed with'''
+        self.categorymatcher = PrefixMatcher() #the phrases of all command categories, in the order they were added
+        for n, cmd in enumerate(self.commandcategories):
+            for i, phrase in enumerate(self.commands[cmd]):
+                if phrase: self.categorymatcher.add(phrase, cmd, (n, i)) #startswith doesn't match empty phrases
+        self.introductionmatcher = PrefixMatcher()
+        for i, phrase in enumerate(self.commands['introductions']):
+            self.introductionmatcher.add(phrase, None, i)
+        self.cussmatcher = PrefixMatcher()
+        for i, phrase in enumerate(self.commands['cuss_out']):
+            if phrase: self.cussmatcher.add(phrase, None, i)
+
+    @property
+    def sendername(self):
+        return getattr(self.local, "sendername", "")
+
+    @sendername.setter
+    def sendername(self, name):
+        self.local.sendername = name
+
     def sendMessage(self, chat_id, s):
         with self.messagelock:
             m = self.telebot.sendMessage(chat_id, s)
-        if probaccept(0.7): self.active = True
-        else: self.active = False
+        self.throttle.set_active(chat_id, probaccept(0.7))
         return m
 
     def pick(self, options):
+        if not options: return None
         return random.sample(options,1)[0].replace("!name", self.sendername)
 
-    def update_querycounts(self, amount):
-        for q in self.querycounts:
-            self.querycounts[q] = max([0,self.querycounts[q]-amount])
-
-    def react_to_query(self, q):
-        '''Determine whether we will react to this specific query based on if we did so previously, to prevent spam'''
-        i = self.aliasdict[q]
-        if i not in self.querycounts: self.querycounts[i] = 0
-        if (q.find("henk") != -1 or (self.active and probaccept(2**-(max([self.querycounts[i]-3,0]))))
-            or probaccept(2**-(max([self.querycounts[i]-1,0])))):
-            self.querycounts[i] += 1
-            self.active = True
+    def react_to_query(self, chat_id, q):
+        '''Determine whether we will react to this specific query based on if we did so previously in this chat, to prevent spam'''
+        i = self.aliasindex.group(q)
+        count = self.throttle.count(chat_id, i)
+        if (q.find("henk") != -1 or (self.throttle.is_active(chat_id) and probaccept(2**-(max([count-3,0]))))
+            or probaccept(2**-(max([count-1,0])))):
+            self.throttle.increment(chat_id, i)
+            self.throttle.set_active(chat_id, True)
             return True
         return False
 
@@ -169,11 +192,38 @@ class Henk(object):
         else:
             return None
 
-    def on_chat_message(self, message):
+    def is_slow(self, msg):
+        '''Whether msg is routed to a slow callback by on_chat_message. This doesn't look at
+        whether Henk would react at all, so it can say so for messages he ignores.'''
+        if msg.raw.startswith("/"):
+            return msg.raw.split()[0][1:] in self.slowcommands
+        command = msg.normalised
+        intro = self.introductionmatcher.match(command)
+        if intro: command = command[len(intro[0])+1:].strip()
+        if command.startswith(","): command = command[1:].strip()
+        if command.startswith("."): command = command[1:].strip()
+        found = self.categorymatcher.match(command)
+        return bool(found) and found[1] in self.slowcategories
+
+    def dispatch_chat_message(self, message):
+        '''Called by the update loop, hands the message to on_chat_message through the dispatcher'''
         msg = Message(message)
+        slow = msg.istext and self.is_slow(msg)
+        self.dispatcher.dispatch(msg.chat_id, lambda: self.on_chat_message(msg), slow)
+
+    def dispatch_callback_query(self, msg):
+        '''Called by the update loop, hands the query to on_callback_query through the dispatcher.
+        It goes in the queue of the chat its buttons are in, after the messages sent there.'''
+        query_id, from_id, data = telepot.glance(msg, flavor='callback_query')
+        chat_id = msg['message']['chat']['id'] if 'message' in msg else from_id #buttons of inline messages have no chat
+        found = self.find_callback_entry(data)
+        self.dispatcher.dispatch(chat_id, lambda: self.on_callback_query(msg), bool(found) and found[2])
+
+    def on_chat_message(self, message):
+        msg = message if isinstance(message, Message) else Message(message)
         if not msg.istext:
             print('Chat:', msg.content_type, msg.chat_type, msg.chat_id)
-            self.active = False
+            self.throttle.set_active(msg.chat_id, False)
             return
 
         self.dataManager.write_message(msg.object)
@@ -187,58 +237,56 @@ class Henk(object):
 
         #slash commands first
         if msg.raw.startswith("/"):
-            for k in self.slashcommands.keys():
-                cmd = msg.raw.split()[0]
-                if cmd[1:] == k:
-                    msg.command = msg.raw[len(k)+2:].strip()
-                    v = self.slashcommands[k](self, msg)
-                    if v: self.sendMessage(msg.chat_id, v)
-                    return
+            k = msg.raw.split()[0][1:]
+            if k in self.slashcommands:
+                msg.command = msg.raw[len(k)+2:].strip()
+                v = self.slashcommands[k](self, msg)
+                if v: self.sendMessage(msg.chat_id, v)
+                return
 
         #if modules.games.is_games_message(msg):
         #    modules.games.parse_message(self, msg)
         #    return
         
-        #Morning message
-        if msg.date-self.morning_message_timer> 3600*16: #16 hours since last message
-            h = get_current_hour()
-            if h>6 and h <12: #it is morning
-                v = self.morning_message(self.homegroup,command)
-                if v:
-                    self.morning_message_timer = msg.date
-                    self.sendMessage(self.homegroup,v)
-                    return
+        #Morning message, the other threads skip it while one is deciding on it
+        if msg.date-self.morning_message_timer> 3600*16 and self.morninglock.acquire(blocking=False): #16 hours since last message
+            v = None
+            try:
+                h = get_current_hour()
+                if msg.date-self.morning_message_timer> 3600*16 and h>6 and h <12: #it is morning
+                    v = self.morning_message(self.homegroup,command)
+                    if v: self.morning_message_timer = msg.date
+            finally:
+                self.morninglock.release()
+            if v:
+                self.sendMessage(self.homegroup,v)
+                return
 
         if msg.chat_id in self.silentchats:
-            self.active = False
+            self.throttle.set_active(msg.chat_id, False)
             return
         
         #now for the fun stuff :)
 
         #custom user responses
         c = prepare_query(msg.raw)
-        if c in self.aliasdict:
-            t = msg.date
-            if t-self.lastupdate > 1800: #every half hour update my willingness to say stuff
-                self.update_querycounts(int((t-self.lastupdate)/1800))
-                self.lastupdate = t
-            if self.react_to_query(c):
-                p = self.pick(self.userresponses[self.aliasdict[c]])
+        if c in self.aliasindex:
+            if self.react_to_query(msg.chat_id, c):
+                p = self.pick(self.aliasindex.responses_for(c))
                 # p = p.replace("!name", msg.sendername)
                 if p: self.sendMessage(msg.chat_id, p)
                 return
             
         #respond to cussing
-        if startswith(msg.normalised.replace(", "," "), self.commands['cuss_out']):
+        if self.cussmatcher.match(msg.normalised.replace(", "," ")):
             self.sendMessage(msg.chat_id, self.pick(self.responses['cuss_out']))
             return
         command = msg.normalised
-        for i in self.commands['introductions']:
-            if command.startswith(i):
-                command = command[len(i)+1:].strip()
-                break
+        intro = self.introductionmatcher.match(command)
+        if intro:
+            command = command[len(intro[0])+1:].strip()
         else:
-            if not self.active: return #no introduction given and not active
+            if not self.throttle.is_active(msg.chat_id): return #no introduction given and not active
         if command.startswith(","): command = command[1:].strip()
         if command.startswith("."): command = command[1:].strip()
 
@@ -254,24 +302,24 @@ class Henk(object):
                     self.sendMessage(msg.chat_id, modules.entertainment.get_joke())
                 return
             except KeyError:
-                self.active = False
+                self.throttle.set_active(msg.chat_id, False)
                 return
 
         #check if the command corresponds to a module
-        for cmd in self.commandcategories.keys():
-            s = startswith(command, self.commands[cmd])
-            if s:
-                msg.command = command[len(s)+1:].strip()
-                r = self.commandcategories[cmd](self, msg)
-                if r and type(r)==str: self.sendMessage(msg.chat_id, r)
-                return
+        found = self.categorymatcher.match(command)
+        if found:
+            s, cmd = found
+            msg.command = command[len(s)+1:].strip()
+            r = self.commandcategories[cmd](self, msg)
+            if r and type(r)==str: self.sendMessage(msg.chat_id, r)
+            return
         
         #try approximate custom matches
-        options = difflib.get_close_matches(command,self.aliasdict.keys(),n=1,cutoff=0.9)
-        if not options: options = difflib.get_close_matches(prepare_query(msg.raw),self.aliasdict.keys(),n=1,cutoff=0.9)
+        options = self.aliasindex.get_close_matches(command,n=1,cutoff=0.9)
+        if not options: options = self.aliasindex.get_close_matches(prepare_query(msg.raw),n=1,cutoff=0.9)
         if options:
-            if self.react_to_query(options[0]):
-                p = self.pick(self.userresponses[self.aliasdict[options[0]]])
+            if self.react_to_query(msg.chat_id, options[0]):
+                p = self.pick(self.aliasindex.responses_for(options[0]))
                 if p: self.sendMessage(msg.chat_id, p)
                 return
 
@@ -313,27 +361,27 @@ class Henk(object):
                 else: #yes/no question
                     self.sendMessage(chat_id, self.pick(self.responses["question_degree"]))
                 return
-            self.active = False
+            self.throttle.set_active(chat_id, False)
             if probaccept(0.05):
                 self.sendMessage(chat_id, modules.entertainment.get_openingline())
             elif probaccept(0.15):
                 self.sendMessage(chat_id,self.pick(self.responses["negative_response"]))
             elif probaccept(0.08):
-                r = random.randint(0,len(self.userresponses)-1) # this works because the keys of userresponses are consecutive integers
-                self.sendMessage(chat_id, self.pick(self.userresponses[r]))
+                p = self.pick(self.aliasindex.random_group())
+                if p: self.sendMessage(chat_id, p)
             return
         
-        self.active = False
+        self.throttle.set_active(msg.chat_id, False)
         return
 
 
     def on_callback_query(self, msg):
         query_id, from_id, data = telepot.glance(msg, flavor='callback_query')
         print('Callback query:', query_id, from_id, data)
-        for ident,callback in self.callback_query_types.items():
-            if data.startswith(ident):
-                callback(self,msg)
-                return
+        callback = self.find_callback_query(data)
+        if callback:
+            callback(self,msg)
+            return
         print("Unkown callback query: %s" % data)
 
     def on_inline_query(self, msg):
@@ -368,11 +416,16 @@ if __name__ == '__main__':
     telebot = telepot.Bot(TOKEN)
     answerer = telepot.helper.Answerer(telebot)
     henk = None
+
+    def stop(signum, frame): #shut down like on ctrl-c, so the database is closed properly
+        raise KeyboardInterrupt
+    for name in ("SIGTERM", "SIGHUP"):
+        if hasattr(signal, name): signal.signal(getattr(signal, name), stop)
     
     try: 
         henk = Henk(telebot)
-        MessageLoop(telebot, {'chat': henk.on_chat_message,
-                          'callback_query': henk.on_callback_query,
+        MessageLoop(telebot, {'chat': henk.dispatch_chat_message,
+                          'callback_query': henk.dispatch_callback_query,
                           'inline_query': henk.on_inline_query,
                           'chosen_inline_result': henk.on_chosen_inline_result}).run_as_thread()
         print('Listening ...')
@@ -402,6 +455,7 @@ if __name__ == '__main__':
         pass
     finally:
         if henk:
+            henk.dispatcher.stop()
             henk.dataManager.close()
             if not henk.should_exit:
                 telebot.sendMessage(PPA,"Ik ga even slapen nu. doei doei")
@@ -1,8 +1,12 @@
+import atexit
 import time
 import math
 import os
-import pickle
+import queue
+import sqlite3
 import threading
+import traceback
+from contextlib import contextmanager
 
 import dataset
 from textblob import TextBlob
@@ -36,12 +40,126 @@ wordfilterlist = [
     "voor", "henk", "welke", "waarom", "vind", "zijn", "echt", "mijn", "delete","myaliases","deleteresponse",
     "gaat", "goed", "denk", "meer", "bent", "waar", "weer", "toch", "even", "stats"]
 
+GAME_CLOSE_DAYS = 7 # Active games older than this are considered abandoned and closed
+GAME_ARCHIVE_DAYS = 12 # Inactive games older than this are moved to the archive database
+ARCHIVE_CHUNK = 500 # Games moved to the archive per transaction
+ARCHIVE_PATH = "gamedata.db"
+MAINTENANCE_INTERVAL = 24*3600 # Seconds between two runs of the maintenance of the games
+MAINTENANCE_DELAY = 600 # Seconds after starting before the first run
+READ_CONNECTIONS = 4 # Connections the reads are spread over
+LOG_BATCH = 200 # Buffered messages that are written at once without waiting for LOG_INTERVAL
+LOG_INTERVAL = 2.0 # Seconds a message is buffered at most before it is written
+
+INDEXES = [("Messages", ["chat_id", "time"]), ("Games", ["game_id"]), ("Commands", ["call"]),
+           ("GameMoves", ["game_id", "number"])]
+
 def is_word_relevant(word):
     if len(word) < 4: return False
     if word.isdigit(): return False
     if word in wordfilterlist: return False
     return True
 
+class ReadPool(object):
+    '''Read-only connections to the database, each used by one thread at a time. The database
+    is in WAL mode, so reads on them don't wait for the writes done on the dataset connection
+    or for each other. At most size connections are opened, a thread asking for one when they
+    are all in use waits for one to be given back. The queries are parameterised, so sqlite
+    keeps them prepared in the statement cache of every connection.'''
+    def __init__(self, path, size=READ_CONNECTIONS):
+        self.path = path
+        self.size = size
+        self.free = queue.LifoQueue() #the most recently used connection first
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        conn = sqlite3.connect("file:{}?mode=ro".format(self.path), uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.free.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                new = self.opened < self.size
+                if new: self.opened += 1
+            conn = self.connect() if new else self.free.get()
+        try:
+            yield conn
+        finally:
+            self.free.put(conn)
+
+    def query(self, sql, params=()):
+        '''Returns the rows of the query as a list of dictionaries'''
+        with self.connection() as conn:
+            try:
+                return [dict(row) for row in conn.execute(sql, params)]
+            except sqlite3.OperationalError as e:
+                if "no such table" in str(e): return [] #like dataset, which creates tables on the first insert
+                raise
+
+    def close(self):
+        with self.lock:
+            while self.opened:
+                self.free.get().close()
+                self.opened -= 1
+
+class MessageLog(object):
+    '''Write-behind buffer of the chat messages that are saved. Messages are written by a
+    background thread in one transaction per batch: when batch of them are waiting, or
+    interval seconds after the first one came in. flush writes everything right away, and
+    close stops the thread and flushes, which ManageData.close and exiting Python do.'''
+    def __init__(self, data, batch=LOG_BATCH, interval=LOG_INTERVAL):
+        self.data = data
+        self.batch = batch
+        self.interval = interval
+        self.buffer = []
+        self.condition = threading.Condition()
+        self.writing = threading.Lock() #so batches are written in the order they came in
+        self.running = True
+        self.written = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, row):
+        with self.condition:
+            self.buffer.append(row)
+            if len(self.buffer) == 1 or len(self.buffer) >= self.batch: self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.buffer: self.condition.wait()
+                if self.running and len(self.buffer) < self.batch: self.condition.wait(self.interval)
+                if not self.running: return
+            self.flush()
+
+    def flush(self):
+        with self.writing:
+            with self.condition:
+                rows, self.buffer = self.buffer, []
+            if not rows: return
+            try:
+                with self.data.datalock:
+                    with self.data.db as tx:
+                        tx['Messages'].insert_many(rows)
+            except Exception:
+                traceback.print_exc()
+                with self.condition: self.buffer[:0] = rows #try again with the next batch
+                return
+            self.written += len(rows)
+            self.batches += 1
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not threading.current_thread(): self.thread.join()
+        self.flush()
+
 class ManageData(object):
     def __init__(self):
         f = open("isencrypted.txt", "r")
@@ -62,6 +180,12 @@ class ManageData(object):
             time.sleep(0.5)
 
         self.db = dataset.connect('sqlite:///data.db?check_same_thread=False')
+        self.db.query("PRAGMA journal_mode=WAL")
+        self.db.query("PRAGMA synchronous=NORMAL")
+        self.create_indexes()
+        self.reader = ReadPool("data.db")
+        self.message_log = MessageLog(self)
+        atexit.register(self.message_log.close) #when Python exits without calling close
         self.messages = self.db['Messages']
         self.users = self.db['Users']
         self.commands = self.db['Commands']
@@ -69,16 +193,31 @@ class ManageData(object):
         self.chats = self.db['Chats']
         self.polls = self.db['Polls']  # TODO: This feature is no longer needed, so we can remove it.
         self.games = self.db['Games']
+        self.game_moves = self.db['GameMoves']
         self.maxgameid = next(self.db.query("SELECT MAX(game_id) as max_id FROM Games;"))['max_id']
         self.klaverjas_results = self.db['KlaverjasResults']
         self.dummy = False
         self.datalock = threading.Lock()
+        self.textlock = threading.Lock() #for alltext, which messages are added to from several threads
+        self.maintenance_stop = None
 
         # self.alltext = "\n".join(i['text'] for i in self.messages.all())
-        recentish_messages = self.db.query("SELECT text FROM Messages WHERE (time >= %d) ORDER BY time" % int(time.time() - 90*24*3600))
+        recentish_messages = self.reader.query("SELECT text FROM Messages WHERE time >= ? ORDER BY time", (int(time.time() - 90*24*3600),))
         self.alltext = "\n".join(i['text'] for i in recentish_messages)
 
+    def create_indexes(self):
+        tables = self.db.tables
+        for table, columns in INDEXES:
+            if table not in tables: continue
+            self.db.query("CREATE INDEX IF NOT EXISTS ix_{}_{} ON {} ({})".format(
+                table, "_".join(columns), table, ", ".join(columns)))
+
     def close(self):
+        self.stop_maintenance()
+        self.message_log.close()
+        self.reader.close()
+        with self.datalock: #put everything in data.db itself before encrypting it, and empty the WAL
+            self.db.query("PRAGMA wal_checkpoint(TRUNCATE)")
         print(os.getcwd())
         encrypt()
         f = open("isencrypted.txt", "w")
@@ -90,14 +229,13 @@ class ManageData(object):
         d = {'chat_id': msg['chat']['id'], 'chat_type': msg['chat']['type'],
              'from_id': msg['from']['id'], 'from_name': msg['from']['first_name'],
              'time': msg['date'], 'text': msg['text']}
-        self.alltext += "\n" + d['text']
-        with self.datalock: self.messages.insert(d)
+        with self.textlock: self.alltext += "\n" + d['text']
+        self.message_log.add(d)
 
     def latest_messages(self, chat_id, hours=3):
         begin = int(time.time() - hours*3600)
-        with self.datalock: res = self.db.query("SELECT time, from_id, text FROM Messages WHERE (chat_id = %d) AND (time >= %d) ORDER BY time" % (chat_id, begin))
-
-        return res
+        self.message_log.flush() #so the stats include the messages that are still buffered
+        return self.reader.query("SELECT time, from_id, text FROM Messages WHERE chat_id = ? AND time >= ? ORDER BY time", (chat_id, begin))
 
     def spam_stats(self, chat_id, hours=3):
         msgs = self.latest_messages(chat_id,hours)
@@ -126,26 +264,30 @@ class ManageData(object):
 
     def get_all_responses(self):
         cdict = {}
-        with self.datalock:
-            com = self.commands.all()
-            for c in com:
-                r = c['response'].split(" | ")
-                if c['call'] in cdict:
-                    cdict[c['call']].extend(r)
-                else: cdict[c['call']] = r
+        for c in self.reader.query("SELECT call, response FROM Commands ORDER BY id"):
+            r = c['response'].split(" | ")
+            if c['call'] in cdict:
+                cdict[c['call']].extend(r)
+            else: cdict[c['call']] = r
 
         return cdict
 
+    def get_response_rows(self):
+        '''Returns (user_id, call, response) of every learned response, in the order they were added'''
+        return [(c['user_id'], c['call'], c['response']) for c in
+                self.reader.query("SELECT user_id, call, response FROM Commands ORDER BY id")]
+
     def get_user_responses(self, user):
-        with self.datalock: com = self.commands.find(user_id = user, order_by='time')
+        com = self.reader.query("SELECT call, response FROM Commands WHERE user_id = ? ORDER BY time", (user,))
         return [(c['call'], c['response']) for c in com]
 
     def delete_response(self, user, num):
+        '''Deletes the num-th response of user, returns its (call, response) or False'''
         if self.dummy: return
         res = self.get_user_responses(user)
         if num >= len(res): return False
         with self.datalock: self.commands.delete(user_id=user, call=res[num][0], response=res[num][1])
-        return True
+        return res[num]
 
 
     def add_alias(self, aliases, user_id, time):
@@ -153,21 +295,23 @@ class ManageData(object):
         with self.datalock: self.aliases.insert({'user_id': user_id, 'aliases': " | ".join(aliases), 'time': time})
 
     def get_all_aliases(self):
-        with self.datalock:
-            com = self.aliases.all()
-            return [c['aliases'].split(" | ") for c in com]
+        com = self.reader.query("SELECT aliases FROM Aliases ORDER BY id")
+        return [c['aliases'].split(" | ") for c in com]
+
+    def get_alias_rows(self):
+        '''Returns (user_id, aliases) of every alias, in the order they were added'''
+        return [(c['user_id'], c['aliases']) for c in self.reader.query("SELECT user_id, aliases FROM Aliases ORDER BY id")]
 
     def get_user_aliases(self, user):
-        with self.datalock:
-            com = self.aliases.find(user_id = user, order_by='time')
-            return [c['aliases'] for c in com]
+        com = self.reader.query("SELECT aliases FROM Aliases WHERE user_id = ? ORDER BY time", (user,))
+        return [c['aliases'] for c in com]
 
     def delete_alias(self, user, num):
         if self.dummy: return
         res = self.get_user_aliases(user)
         if num >= len(res): return False
         with self.datalock: self.aliases.delete(user_id=user, aliases=res[num])
-        return True
+        return res[num]
 
 
     def add_poll(self, chat_id, mess_id, poll_id, text, votes):
@@ -180,13 +324,13 @@ class ManageData(object):
                 self.polls.insert(d)
 
     def get_all_polls(self):
-        with self.datalock: return self.polls.find(order_by='poll_id')
+        return self.reader.query("SELECT * FROM Polls ORDER BY poll_id")
 
 
-    def add_game(self, game_type, game_id, game_data, date, is_active):
+    def add_game(self, game_type, game_id, game_data, date, is_active, version=0):
         if self.dummy: return
         d = {'game_type': game_type, 'game_id': game_id,
-             'game_data': game_data, 'date': date, 'is_active': is_active}
+             'game_data': game_data, 'date': date, 'is_active': is_active, 'version': version}
         with self.datalock:
             if self.games.find_one(game_id=game_id):
                 self.games.update(d, ['game_id'])
@@ -194,22 +338,121 @@ class ManageData(object):
                 self.maxgameid += 1
                 self.games.insert(d)
 
+    def add_game_move(self, game_id, number, move):
+        if self.dummy: return
+        with self.datalock:
+            self.game_moves.insert({'game_id': game_id, 'number': number, 'move': move, 'time': int(time.time())})
+
+    def get_game_moves(self, game_id):
+        return [d['move'] for d in self.reader.query("SELECT move FROM GameMoves WHERE game_id = ? ORDER BY number", (game_id,))]
+
     def get_unique_game_id(self):
         with self.datalock:
             self.maxgameid += 1
             return self.maxgameid
 
     def get_active_games(self, game_type=None):
-        with self.datalock:
-            if not game_type:
-                return self.games.find(is_active=True, order_by='game_id')
-            return self.games.find(game_type=game_type, is_active=True, order_by='game_id')
+        if not game_type:
+            return self.reader.query("SELECT * FROM Games WHERE is_active ORDER BY game_id")
+        return self.reader.query("SELECT * FROM Games WHERE game_type = ? AND is_active ORDER BY game_id", (game_type,))
+
+    def get_active_game_ids(self):
+        '''Returns (game_id, game_type) of the active games, without loading them'''
+        return [(d['game_id'], d['game_type']) for d in
+                self.reader.query("SELECT game_id, game_type FROM Games WHERE is_active ORDER BY game_id")]
 
     def load_game(self, game_id):
-        with self.datalock:
-            g = self.games.find_one(game_id=game_id)
-            return pickle.loads(g['game_data'])
+        '''Returns the row of the game, restore it with modules.games.base.restore_game'''
+        rows = self.reader.query("SELECT * FROM Games WHERE game_id = ? LIMIT 1", (game_id,))
+        return rows[0] if rows else None
+
 
+    def close_stale_games(self, days=GAME_CLOSE_DAYS, keep=()):
+        '''Marks the active games without a move in the last days as inactive, except the
+        ones with their game_id in keep. Moves saved before their time was, count as made
+        when the game started. Returns how many games were closed.'''
+        before = int(time.time() - days*24*3600)
+        sql = "SELECT game_id FROM Games WHERE is_active AND date < :before"
+        with self.datalock:
+            if self.game_moves.has_column("time"):
+                sql += " AND game_id NOT IN (SELECT game_id FROM GameMoves WHERE time >= :before)"
+            ids = [r['game_id'] for r in self.db.query(sql, before=before) if r['game_id'] not in keep]
+            if ids:
+                with self.db as tx:
+                    for game_id in ids: tx['Games'].update({'game_id': game_id, 'is_active': False}, ['game_id'])
+        return len(ids)
+
+    def archive_games(self, days=GAME_ARCHIVE_DAYS, chunk_size=ARCHIVE_CHUNK, path=ARCHIVE_PATH):
+        '''Moves the inactive games started more than days ago, with their moves, to the
+        archive database at path. Every chunk of games is inserted there in one transaction
+        and then deleted here in one transaction. Returns how many games and moves were moved.'''
+        before = int(time.time() - days*24*3600)
+        archive = dataset.connect('sqlite:///%s' % path)
+        games = moves = 0
+        while True:
+            with self.datalock:
+                rows = list(self.db.query("SELECT * FROM Games WHERE NOT is_active AND date < :before ORDER BY id LIMIT :n",
+                                          before=before, n=chunk_size))
+                if not rows: break
+                ids = [r['game_id'] for r in rows]
+                move_rows = list(self.game_moves.find(game_id=ids))
+                for r in rows + move_rows: del r['id']
+                with archive as tx:
+                    tx['Games'].insert_many(rows)
+                    if move_rows: tx['GameMoves'].insert_many(move_rows)
+                with self.db as tx:
+                    tx['Games'].delete(game_id=ids)
+                    if move_rows: tx['GameMoves'].delete(game_id=ids)
+            games += len(rows)
+            moves += len(move_rows)
+        archive.close()
+        return games, moves
+
+    def database_size(self):
+        with self.datalock:
+            pages = next(self.db.query("PRAGMA page_count"))['page_count']
+            return pages*next(self.db.query("PRAGMA page_size"))['page_size']
+
+    def maintain_games(self, close_after=GAME_CLOSE_DAYS, archive_after=GAME_ARCHIVE_DAYS,
+                       chunk_size=ARCHIVE_CHUNK, path=ARCHIVE_PATH, keep=None):
+        '''Closes abandoned games, archives old ones and then compacts the database.
+        keep is called for the ids of the games that shouldn't be closed, like the ones the
+        bot has in memory. Returns a report of what was done.'''
+        t = time.time()
+        size = self.database_size()
+        closed = self.close_stale_games(close_after, keep() if keep else ())
+        games, moves = self.archive_games(archive_after, chunk_size, path)
+        if games:
+            with self.datalock: self.db.query("VACUUM")
+        reclaimed = max(0, size - self.database_size()) #before ANALYZE, which can make the file grow
+        with self.datalock:
+            self.create_indexes() #for the tables created since starting
+            self.db.query("ANALYZE")
+        report = {"closed": closed, "archived_games": games, "archived_moves": moves,
+                  "bytes_reclaimed": reclaimed, "seconds": time.time() - t}
+        print("Game maintenance: closed {closed} games, archived {archived_games} games with "
+              "{archived_moves} moves, reclaimed {bytes_reclaimed} bytes in {seconds:.1f}s".format(**report))
+        return report
+
+    def start_maintenance(self, interval=MAINTENANCE_INTERVAL, delay=MAINTENANCE_DELAY, **settings):
+        '''Runs maintain_games with settings in a background thread, first after delay
+        seconds and then every interval seconds'''
+        if self.dummy or self.maintenance_stop: return
+        self.maintenance_stop = threading.Event()
+        def run(stop):
+            wait = delay
+            while not stop.wait(wait):
+                try: self.maintain_games(**settings)
+                except Exception: traceback.print_exc()
+                wait = interval
+        self.maintenance_thread = threading.Thread(target=run, args=(self.maintenance_stop,), daemon=True)
+        self.maintenance_thread.start()
+
+    def stop_maintenance(self):
+        if not self.maintenance_stop: return
+        self.maintenance_stop.set()
+        self.maintenance_thread.join()
+        self.maintenance_stop = None
 
     def add_klaverjas_result(self, seed, game_id, result):
         if self.dummy: return
@@ -229,9 +472,7 @@ class ManageData(object):
                 self.chats.insert({"chat_id": chat_id, "silent":setsilent})
 
     def get_silent_chats(self):
-        with self.datalock:
-            t = self.chats.find(silent=1)
-            return [i['chat_id'] for i in t]
+        return [i['chat_id'] for i in self.reader.query("SELECT chat_id FROM Chats WHERE silent = 1")]
         
 
 
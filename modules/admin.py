@@ -9,6 +9,7 @@ class Admin(Module):
         bot.add_slash_command("reload", self.reload)
         bot.add_slash_command("setsilent", self.setsilent)
         bot.add_slash_command("quit", self.quit)
+        bot.add_slash_command("dispatchstats", self.dispatchstats)
 
         bot.add_command_category("whatcanyoudo", self.help)
         bot.add_command_category("howdoyoulearn", self.learnhelp)
@@ -32,6 +33,13 @@ class Admin(Module):
             bot.should_exit = True
             return "Quitting"
 
+    def dispatchstats(self, bot, msg):
+        if msg.sender in bot.admin_ids:
+            s = bot.dispatcher.stats()
+            return ("Handled directly: {handled:d}\nHanded to workers: {queued:d}, of which {pending:d} pending "
+                    "in {busy_chats:d} chats\nMost pending at once: {max_pending:d}\nTimes I had to wait for a worker: {waits:d}\n"
+                    "Average wait before a worker started: {average_delay:.2f}s").format(**s)
+
     def reload(self, bot, msg):
         if msg.sender in bot.admin_ids:
             bot.load_files()
@@ -13,11 +13,11 @@ from .base import Module
 class Calc(Module):
     def register_commands(self, bot):
         bot.add_slash_command("calc", self.calc)
-        bot.add_slash_command("stats", self.stats)
+        bot.add_slash_command("stats", self.stats, slow=True)
         bot.add_slash_command("learnstats", self.learnstats)
 
         bot.add_command_category("math", self.calc)
-        bot.add_command_category("spam_ask", self.stats)
+        bot.add_command_category("spam_ask", self.stats, slow=True)
 
     def calc(self, bot, msg):
         text = msg.command
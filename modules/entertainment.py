@@ -1,6 +1,7 @@
 import os
 import json
 import random
+import threading
 import time
 
 from .base import Module
@@ -32,6 +33,7 @@ class Entertainment(Module):
         f.close()
 
         self.tolkien_calls = []
+        self.lock = threading.Lock() #the counters are used by messages on several threads
 
     def register_commands(self,bot):
         bot.add_command_category("funny", self.get_joke)
@@ -41,14 +43,15 @@ class Entertainment(Module):
         bot.add_slash_command("tolkien", self.tolkien)
 
     def get_item(self, l, v):
-        try:
-            result = l[self.counters[v]]
-            self.counters[v] += 1
-        except KeyError:  # Time to reset the counter
-            self.counters[v] = 0
-            result = l[self.counters[v]]
-        f = open(os.path.join(datadir,"counters.json"),"w")
-        json.dump(self.counters,f)
+        with self.lock:
+            try:
+                result = l[self.counters[v]]
+                self.counters[v] += 1
+            except KeyError:  # Time to reset the counter
+                self.counters[v] = 0
+                result = l[self.counters[v]]
+            f = open(os.path.join(datadir,"counters.json"),"w")
+            json.dump(self.counters,f)
         return result
 
     def amuse(self, bot, msg):
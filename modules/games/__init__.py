@@ -1,33 +1,41 @@
-import pickle
 import time
 
 import telepot
 
 from ..base import Module
 
+from .decisions import DecisionCache
 from .klaverjas_game import Klaverjas, KlaverjasDispatcher, KlaverjasChallenge, KLAVERJASSEN
+from .outbox import Outbox
+from .registry import GameRegistry
+from .scheduler import GameScheduler
 
 #game_identifier = {KLAVERJASSEN: "k"}
 
 
 class Games(Module):
     def initialise(self, bot):
-        bot.games = {}
-        games = bot.dataManager.get_active_games()
-        for g in games:
-            game = pickle.loads(g['game_data'])
-            game.setstate(bot)
-            bot.games[g['game_id']] = game
+        if not hasattr(bot, "gamescheduler"): #keep the running one on a reload
+            bot.gamescheduler = GameScheduler()
+        if not hasattr(bot, "outbox"):
+            bot.outbox = Outbox(bot)
+        if not hasattr(bot, "decisions"):
+            bot.decisions = DecisionCache()
+        old = getattr(bot, "games", None)
+        bot.games = GameRegistry(bot)
+        if hasattr(old, "live"): #keep the games that are in memory on a reload
+            for game_id, game in old.live.items(): bot.games[game_id] = game
 
     def register_commands(self, bot):
-        bot.add_slash_command("klaverjassen", self.klaverjassen)
-        bot.add_slash_command("klaverchallenge", self.klaverchallenge)
-        bot.add_slash_command("klaverchallenge4", self.klaverchallenge4)
-        bot.add_slash_command("klaverchallenge8", self.klaverchallenge8)
-        bot.add_slash_command("klaverchallenge12", self.klaverchallenge8)
-        bot.add_slash_command("klaverchallenge16", self.klaverchallenge16)
+        #starting a game sends its keyboards and deals the cards, so these are slow like the callback
+        bot.add_slash_command("klaverjassen", self.klaverjassen, slow=True)
+        bot.add_slash_command("klaverchallenge", self.klaverchallenge, slow=True)
+        bot.add_slash_command("klaverchallenge4", self.klaverchallenge4, slow=True)
+        bot.add_slash_command("klaverchallenge8", self.klaverchallenge8, slow=True)
+        bot.add_slash_command("klaverchallenge12", self.klaverchallenge8, slow=True)
+        bot.add_slash_command("klaverchallenge16", self.klaverchallenge16, slow=True)
         #bot.add_callback_query("gamestart", self.callbackstart)
-        bot.add_callback_query("games", self.callback)
+        bot.add_callback_query("games", self.callback, slow=True) #loads and plays the game
 
     def klaverjassen(self, bot, msg):
         ident = bot.dataManager.get_unique_game_id()
@@ -65,10 +73,12 @@ class Games(Module):
     def callback(self, bot, msg):
         query_id, from_id, data = telepot.glance(msg, flavor='callback_query')
         game_id, callback_id, button_id = [int(s) for s in data[5:].split(":")]
-        g = bot.games[game_id]
-        if not g.loaded: g.load()
-        ident, func = g.callbacks[callback_id]
-        s = func(ident, button_id,(msg['from']['id'],msg['from']['first_name']))
+        with bot.games.use(game_id) as g:
+            if not g.loaded: g.load()
+            entry = g.callbacks.get(callback_id)
+            if not entry: return #already answered
+            ident, func = entry
+            s = func(ident, button_id,(msg['from']['id'],msg['from']['first_name']))
         if s: bot.telebot.answerCallbackQuery(query_id, s)
 
 games = Games()
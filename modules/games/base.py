@@ -1,9 +1,40 @@
+import json
 import pickle
 import threading
 
-import telepot
 from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
 
+game_classes = {} # game_type -> class, of the games that are saved as a state and moves
+
+def when_sent(sent, func):
+    '''Calls func with the identifier of the message of the future sent once it is sent,
+    or None if it couldn't be. sent can also be a list of futures, then func gets the list
+    of the identifiers of the ones that could be sent, once they all are. func is called
+    from the thread of the outbox, or right away when they were sent already.'''
+    futures = sent if isinstance(sent, list) else [sent]
+    left = [len(futures)]
+    lock = threading.Lock()
+    def done(future):
+        with lock:
+            left[0] -= 1
+            if left[0]: return
+        idents = [f.result() for f in futures if not f.exception()]
+        if isinstance(sent, list): func(idents)
+        else: func(idents[0] if idents else None)
+    if not futures: return func([])
+    for f in futures: f.add_done_callback(done)
+
+def restore_game(bot, row):
+    '''Recreates a game from its row in the Games table. Games saved as a state and a list
+    of moves are restored by replaying the moves, older ones are unpickled.'''
+    if not row.get('version'):
+        game = pickle.loads(row['game_data'])
+        game.setstate(bot)
+        return game
+    moves = [json.loads(m) for m in bot.dataManager.get_game_moves(row['game_id'])]
+    return game_classes[row['game_type']].from_state(bot, row['game_id'], row['date'],
+                                                     row['is_active'], json.loads(row['game_data']), moves)
+
 class BaseGame(object):
     game_type = 0 #specifies which game it is. Should be unique for each class
     def __init__(self, bot, game_id, players, date, cmd=""):
@@ -19,11 +50,15 @@ class BaseGame(object):
 
         #self.current_users = [] # The list of user_ids for which the game is waiting for input.
 
-        self.callbacks = [] #consists of tuples ((chat_id, message_id), callback) where callback is 
-                            # a function with 2 arguments: ident, button_id where
-                            # ident = (chat_id, message_id)
+        self.callbacks = {} #callback_id -> ((chat_id, message_id), callback) for the keyboards that can
+                            # still be answered, where callback is a function with 3 arguments:
+                            # ident, button_id, (user_id, user_name) where ident = (chat_id, message_id)
+        self.callback_ids = {} #ident -> callback_id of the keyboards in self.callbacks
+        self.callbacks_disposed = set() #idents of the keyboards that have been answered
+        self.next_callback = 0
 
         self.final_callback = None
+        self.parent_id = None #the game_id of the game this one was started from
 
         self._lock = bot.messagelock
         #self.save_game_state()
@@ -31,33 +66,35 @@ class BaseGame(object):
     def load(self):
         self.loaded = True
 
+    def attach(self, game):
+        '''Called with a game started from this one when that game gets loaded again'''
+        pass
+
+    def child_ids(self):
+        '''Returns the game_ids of the games started from this one'''
+        return []
+
     def game_ended(self):
         self.is_active = False
         if self.final_callback: self.final_callback(self)
 
 
     def send_user_message(self, msg, user_id=None, parse_mode=None):
-        '''Send msg to user_id. If user_id is None, it sends the message to all the players'''
-        with self._lock:
-            if user_id:
-                if not parse_mode: sent = self.bot.telebot.sendMessage(user_id, msg)
-                else: sent = self.bot.telebot.sendMessage(user_id, msg, parse_mode=parse_mode)
-                return telepot.message_identifier(sent)
-            idents = []
-            for i in self.player_names:
-                if not parse_mode: sent = self.bot.telebot.sendMessage(i, msg)
-                else: sent = self.bot.telebot.sendMessage(i, msg, parse_mode=parse_mode)
-                idents.append(telepot.message_identifier(sent))
-            return idents
-
-    def edit_message_text(self, ident, msg, parse_mode=None):
-        editor = telepot.helper.Editor(self.bot.telebot, ident)
-        with self._lock:
-            try:
-                if parse_mode: editor.editMessageText(msg, parse_mode=parse_mode)
-                else: editor.editMessageText(msg)
-            except telepot.exception.TelegramError:
-                pass
+        '''Send msg to user_id. If user_id is None, it sends the message to all the players.
+        The messages go through the outbox, this doesn't wait for them to be sent. Returns
+        the future of the identifier, or a list of them, which can be edited right away.
+        Use when_sent to get the identifiers themselves.'''
+        kwargs = {"parse_mode": parse_mode} if parse_mode else {}
+        if user_id:
+            return self.bot.outbox.send(user_id, msg, **kwargs)
+        return [self.bot.outbox.send(i, msg, **kwargs) for i in self.player_names]
+
+    def edit_message_text(self, ident, msg, parse_mode=None, reply_markup=None):
+        '''Queues the edit in the outbox, where it gets merged with later edits of ident'''
+        kwargs = {}
+        if parse_mode: kwargs["parse_mode"] = parse_mode
+        if reply_markup: kwargs["reply_markup"] = reply_markup
+        self.bot.outbox.edit(ident, msg, **kwargs)
 
     def get_keyboard(self, buttons, index):
         options = []
@@ -65,19 +102,48 @@ class BaseGame(object):
             options.append(InlineKeyboardButton(text=o,callback_data="games%d:%d:%d" % (self.game_id,index,i)))
         return InlineKeyboardMarkup(inline_keyboard=[options])
 
-    def send_keyboard_message(self, chat_id, text, buttons, callback):
-        keyboard = self.get_keyboard(buttons, len(self.callbacks))
-        with self._lock:
-            sent = self.bot.telebot.sendMessage(chat_id, text, reply_markup=keyboard)
-        ident = telepot.message_identifier(sent)
-        self.callbacks.append((ident, callback))
-        return ident
+    def send_keyboard_message(self, chat_id, text, buttons, callback, sent=None):
+        '''Sends a keyboard whose buttons call callback. Its callback_id is taken now, and once
+        it is sent, callback is registered under its identifier and sent is called with that,
+        see when_sent. Returns the future of the identifier. Without sent, it waits until then
+        and returns the identifier: the dispatchers do that, as their state is pickled with it.'''
+        callback_id = self.next_callback
+        self.next_callback += 1
+        keyboard = self.get_keyboard(buttons, callback_id)
+        future = self.bot.outbox.send(chat_id, text, reply_markup=keyboard)
+        if sent is None:
+            ident = future.result()
+            self.add_callback(ident, callback, callback_id)
+            return ident
+        def register(ident):
+            if ident is None: return #it couldn't be sent
+            self.add_callback(ident, callback, callback_id)
+            sent(ident)
+        when_sent(future, register)
+        return future
+
+    def add_callback(self, ident, callback, callback_id=None):
+        '''Registers callback for the keyboard in message ident, under callback_id or the next one'''
+        if callback_id is None:
+            callback_id = self.next_callback
+            self.next_callback += 1
+        self.callbacks[callback_id] = (ident, callback)
+        self.callback_ids[ident] = callback_id
+
+    def dispose_callback(self, ident):
+        '''Marks the keyboard in message ident as answered. Returns False if it already was.'''
+        if ident in self.callbacks_disposed: return False
+        self.callbacks_disposed.add(ident)
+        callback_id = self.callback_ids.pop(ident, None)
+        if callback_id is not None: del self.callbacks[callback_id]
+        return True
+
+    def remove_keyboard(self, ident):
+        self.bot.outbox.call(ident[0], self.bot.telebot.editMessageReplyMarkup, ident, ident=ident)
 
     def disable_keyboard(self, ident):
-        editor = telepot.helper.Editor(self.bot.telebot, ident)
-        with self._lock:
-            editor.editMessageReplyMarkup()
-            self.bot.telebot.deleteMessage(ident)
+        self.remove_keyboard(ident)
+        self.bot.outbox.call(ident[0], self.bot.telebot.deleteMessage, ident, ident=ident)
 
     def __getstate__(self):
         state = self.__dict__.copy()
@@ -90,6 +156,12 @@ class BaseGame(object):
     def setstate(self, bot):
         self.bot = bot
         self._lock = bot.messagelock
+        if isinstance(self.callbacks, list): #pickled when the callbacks were a list
+            callbacks, disposed = self.callbacks, getattr(self, "callbacks_disposed", [])
+            self.callbacks, self.callback_ids, self.callbacks_disposed = {}, {}, set()
+            self.next_callback = 0
+            for ident, callback in callbacks: self.add_callback(ident, callback)
+            for ident in disposed: self.dispose_callback(ident)
 
     def save_game_state(self):
         with self._lock:
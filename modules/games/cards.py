@@ -1,3 +1,7 @@
+import itertools
+import operator
+import os
+import pickle
 import random
 
 PRINT = True
@@ -72,7 +76,19 @@ glory_order = [SEVEN,EIGHT,NINE,TEN,JACK,QUEEN,KING,ACE]
 trump_order = [SEVEN,EIGHT,QUEEN,KING,TEN,ACE,NINE,JACK]
 normal_order= [SEVEN,EIGHT,NINE,JACK,QUEEN,KING,TEN,ACE]
 
+# Bitboard representation of a set of cards: the card with index color*8+value
+# is bit 1<<index, so a hand fits in 32 bits and every suit is one byte.
+ALL_CARDS = 0xFFFFFFFF
+suit_masks = [0xFF << (8*color) for color in range(4)]
+trump_rank = [trump_order.index(v) for v in range(8)] # value -> strength as trump
+normal_rank = [normal_order.index(v) for v in range(8)] # value -> strength as non-trump
+# For every value, the byte of values in the same suit that beat it
+trump_higher = [sum(1 << w for w in range(8) if trump_rank[w] > trump_rank[v]) for v in range(8)]
+normal_higher = [sum(1 << w for w in range(8) if normal_rank[w] > normal_rank[v]) for v in range(8)]
+
 class Card(object):
+    __slots__ = ("value", "color", "index", "owner", "rank", "_is_trump", "played_index")
+
     def __init__(self,value,color):
         self.value = value
         self.color = color
@@ -80,6 +96,29 @@ class Card(object):
         self.owner = None
         self.is_trump = False
 
+    @property
+    def is_trump(self):
+        return self._is_trump
+
+    @is_trump.setter
+    def is_trump(self, is_trump):
+        #rank is the strength of the card, so that cards can be compared by just comparing ranks
+        self._is_trump = is_trump
+        if self.value == FAKE: self.rank = -1
+        elif is_trump: self.rank = 8 + trump_rank[self.value]
+        else: self.rank = normal_rank[self.value]
+
+    def __getstate__(self):
+        state = {"value": self.value, "color": self.color, "owner": self.owner, "is_trump": self._is_trump}
+        if hasattr(self, "played_index"): state["played_index"] = self.played_index
+        return state
+
+    def __setstate__(self, state): #also loads the cards pickled before Card had __slots__
+        Card.__init__(self, state["value"], state["color"])
+        self.owner = state.get("owner")
+        self.is_trump = state.get("is_trump", False)
+        if "played_index" in state: self.played_index = state["played_index"]
+
     def __str__(self):
         return "Card({}, {})".format(valuenames[self.value],colornames[self.color])
 
@@ -90,16 +129,13 @@ class Card(object):
         return suit_to_unicode[self.color]+short_valuenames[self.value]
 
     def __gt__(self,other):
-        if self.is_trump:
-            if not other.is_trump: return True
-            return trump_order.index(self.value) > trump_order.index(other.value)
-        if other.is_trump: return False
-        return normal_order.index(self.value) > normal_order.index(other.value)
+        return self.rank > other.rank
 
-    def __le__(self,other):
-        if self.is_trump == other.is_trump and self.value == other.value:
-            return False
-        return not (self > other)
+    def __lt__(self,other):
+        return self.rank < other.rank
+
+    def __le__(self,other): #a card of the same value and trumpness is not lower or equal
+        return self.rank < other.rank
 
     def __eq__(self, other):
         return (self.color == other.color and self.value == other.value)
@@ -107,6 +143,8 @@ class Card(object):
     def __hash__(self):
         return hash(self.index)
 
+card_key = operator.attrgetter("rank") # Sorting key that orders cards like comparing them does
+
 def fake_card():
     return Card(FAKE, FAKE)
 
@@ -114,6 +152,13 @@ def index_to_card(index):
     color, value = divmod(index, 8)
     return Card(value, color)
 
+# For every trump (and None) the 32 cards with is_trump set accordingly. These are shared,
+# so only use them where the cards are read and never get an owner.
+interned_cards = {}
+for _trump in (None, CLUBS, SPADES, DIAMONDS, HEARTS):
+    interned_cards[_trump] = [index_to_card(i) for i in range(32)]
+    for _c in interned_cards[_trump]: _c.is_trump = (_c.color == _trump)
+
 def create_deck():
     return Cards([index_to_card(i) for i in range(32)])
 
@@ -122,20 +167,100 @@ def random_cards(amount):
     random.shuffle(l)
     return Cards([index_to_card(i) for i in l[:amount]])
 
-def highest_card(cards, trump=None):
-    if trump:
-        for c in cards:
-            c.is_trump = (c.color == trump)
+def cards_to_mask(cards):
+    '''Returns the bitmask of the given cards'''
+    mask = 0
+    for c in cards:
+        mask |= 1 << c.index
+    return mask
 
-    color = cards[0].color
+def mask_to_cards(mask, trump=None):
+    '''Creates a new Cards object with the interned card for every bit set in mask'''
+    cards = interned_cards[trump]
+    return Cards([cards[i] for i in range(32) if mask >> i & 1])
 
-    l = []
-    cards = sorted(cards)
-    for c in cards:
-        if c.color == color or c.is_trump:
-            l.append(c)
+def mask_count(mask):
+    return bin(mask).count("1")
+
+def card_strength(card):
+    '''Trump aware strength of a card. Only meaningful when comparing
+    cards that are either trump or of the asked colour.'''
+    return card.rank
 
-    return l[-1]
+def higher_mask(index, trump):
+    '''Returns the bitmask of all cards that beat the card with this index when played on it.'''
+    color, value = divmod(index, 8)
+    if color == trump:
+        return trump_higher[value] << (8*color)
+    mask = normal_higher[value] << (8*color)
+    if trump is not None:
+        mask |= suit_masks[trump]
+    return mask
+
+def card_rank(card, trump):
+    '''Returns the strength of card when trump is trump, like the rank of a card with is_trump set'''
+    if card.value == FAKE: return -1
+    if card.color == trump: return 8 + trump_rank[card.value]
+    return normal_rank[card.value]
+
+def highest_card(cards, trump=None):
+    '''Returns the card that wins the round of cards. Without trump, is_trump of the cards
+    themselves is used. The cards aren't changed, as the interned ones are shared.'''
+    color = cards[0].color
+    highest = cards[0]
+    if trump is None:
+        strength = highest.rank
+        for c in cards:
+            if c.color == color or c._is_trump:
+                if c.rank > strength:
+                    highest = c
+                    strength = c.rank
+        return highest
+    strength = card_rank(highest, trump)
+    for c in cards:
+        if c.color == color or c.color == trump:
+            rank = card_rank(c, trump)
+            if rank > strength:
+                highest = c
+                strength = rank
+    return highest
+
+def legal_mask(hand, color, highest, winning, trumped, trump):
+    '''Bitmask version of legal_cards. hand is the bitmask of the cards in hand, color
+    the asked colour, highest the index of the card currently winning the round,
+    winning whether that card is from our mate and trumped whether a trump has been played.'''
+    cards = hand & suit_masks[color]
+    if cards: #we can confess colour
+        if color != trump: return cards #no trumps so no restrictions
+        #must not undertrump
+        higher = cards & higher_mask(highest, trump)
+        if higher: return higher # We must overtrump
+        return cards
+    trumps = hand & suit_masks[trump]
+    if not trumps: return hand # Don't have any trumps so everything is legal
+    if not trumped and not winning: return trumps # We aren't winning and we have trumps, so we must play one of those
+    higher = trumps & higher_mask(highest, trump)
+    if higher and not winning: return higher # We must overtrump
+    c = (hand & ~suit_masks[trump]) | higher #Any card except trumps
+    if c: return c
+    return hand #we can't overtrump, but we only have trumps so we need to play them.
+
+def legal_cards(hand, played_cards, trump, partner):
+    '''Returns the cards of hand that may be played on played_cards by a player
+    whose mate has index partner. The resulting cards keep the order they have in hand,
+    except that non-trumps come before trumps when both are allowed.'''
+    if not played_cards: return hand #first to play, everything is legal
+    highest = highest_card(played_cards)
+    if highest.owner == None:
+        raise KeyError("Played card doesn't have owner")
+    handmask = hand.mask()
+    trumped = cards_to_mask(played_cards) & suit_masks[trump]
+    legal = legal_mask(handmask, played_cards[0].color, highest.index,
+                       highest.owner == partner, trumped, trump)
+    if legal == handmask: return hand
+    c = hand.select(legal & ~suit_masks[trump])
+    c.extend(hand.select(legal & suit_masks[trump]))
+    return c
 
 class Cards(list):
     """
@@ -145,10 +270,21 @@ class Cards(list):
     def filter(self, func):
         return Cards(filter(func, self))
 
+    def sort(self, key=card_key, reverse=False):
+        list.sort(self, key=key, reverse=reverse)
+
     def sorted(self,*args,**kwargs):
         self.sort(*args,**kwargs)
         return self
 
+    def mask(self):
+        '''Returns the bitmask representation of these cards'''
+        return cards_to_mask(self)
+
+    def select(self, mask):
+        '''Creates a new Cards object with only the cards in mask, in the current order'''
+        return Cards([a for a in self if mask >> a.index & 1])
+
     def filter_color(self, color):
         '''Creates a new Cards object with only cards with that color'''
         return Cards([a for a in self if a.color == color])
@@ -166,11 +302,12 @@ class Cards(list):
         '''c is either a Card object or a number.
         Returns wether we have that card or a card of that value (if it is a number)'''
         if isinstance(c, Card):
-            a = [b for b in self if b == c]
+            for b in self:
+                if b == c: return b
         else:
-            a = [b for b in self if b.value == c]
-        if a: return a[0]
-        else: return False
+            for b in self:
+                if b.value == c: return b
+        return False
 
     def values(self):
         return list(set([c.value for c in self]))
@@ -189,42 +326,127 @@ class Cards(list):
             s += "{} {}\n".format(suit_to_unicode[color], vals)
         return s.strip()
 
+#Per suit byte lookup tables for points and glory
+suit_points = [sum(point_value[v] for v in range(8) if b >> v & 1) for b in range(256)]
+suit_pointsT = [sum(point_valueT[v] for v in range(8) if b >> v & 1) for b in range(256)]
+
+def mask_points(mask, trump):
+    val = 0
+    for color in range(4):
+        suit = mask >> (8*color) & 0xFF
+        if color == trump: val += suit_pointsT[suit]
+        else: val += suit_points[suit]
+    return val
+
 def card_points(cards, trump=None):
+    if trump is not None:
+        return mask_points(cards_to_mask(cards), trump)
     val = 0
     for c in cards:
-        if c.is_trump or c.color == trump:
+        if c.is_trump:
             val += point_valueT[c.value]
         else: val += point_value[c.value]
     return val
 
-def glory_calculation(cards, trump):
+def _sequence_glory(values):
+    '''Glory for a sequence of cards within one colour'''
+    if len(values) < 3: return 0 #only glory with at least 3 cards
+    order = sorted([glory_order.index(i) for i in values])
+    if len(values) == 3:
+        if (order[2] == order[0] + 2) and (order[1] == order[0] + 1):
+            return 20
+        return 0
+    #len(values) = 4
+    if (order[3] == order[0] + 3) and (order[2] == order[0] + 2) and (order[1] == order[0] + 1):
+        return 50
+    if (order[2] == order[0] + 2) and (order[1] == order[0] + 1):
+        return 20
+    if (order[3] == order[1] + 2) and (order[2] == order[1] + 1):
+        return 20
+    return 0
+
+suit_glory = [_sequence_glory([v for v in range(8) if b >> v & 1]) for b in range(256)]
+STUK = (1 << QUEEN) | (1 << KING)
+
+def _suit_glory(mask, trump):
     glory = 0
     for color in range(4):
-        values = Cards(cards).filter_color(color).values()
-        if color == trump and QUEEN in values and KING in values: #"stuk"
-            glory += 20
-        if len(values) < 3: continue #only glory with at least 3 cards
-        order = sorted([glory_order.index(i) for i in values])
-        if len(values) == 3:
-            if (order[2] == order[0] + 2) and (order[1] == order[0] + 1):
-                glory += 20
-            return glory
-        #len(values) = 4
-        if (order[3] == order[0] + 3) and (order[2] == order[0] + 2) and (order[1] == order[0] + 1):
-            glory += 50
-            return glory
-        if (order[2] == order[0] + 2) and (order[1] == order[0] + 1):
+        suit = mask >> (8*color) & 0xFF
+        if not suit: continue
+        if color == trump and suit & STUK == STUK: #"stuk"
             glory += 20
-            return glory
-        if (order[3] == order[1] + 2) and (order[2] == order[1] + 1):
-            glory += 20
-            return glory
+        glory += suit_glory[suit]
+    return glory
+
+def mask_glory(mask, trump):
+    '''Glory of the cards in mask, which should be a trick of at most four cards'''
+    glory = _suit_glory(mask, trump)
+    values = 0
+    for color in range(4):
+        values |= mask >> (8*color) & 0xFF
     #100 points glory for 4 cards with the same value, 200 if it's four Jacks.
-    values = Cards(cards).values()
-    if len(set(values)) == 1:
+    if values and not values & (values-1):
         glory += 100
-        if JACK in values:
+        if values == 1 << JACK:
             glory += 100
-
     return glory
-    
+
+GLORY_TABLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "glory_table.pickle")
+GLORY_TABLE_VERSION = 1
+_glory_table = None
+
+def build_glory_table():
+    '''Returns a list with for every trump a dictionary mapping the bitmask of
+    every set of at most four cards that makes glory to that glory.'''
+    table = [{} for trump in range(4)]
+    for n in range(1, 5):
+        for indices in itertools.combinations(range(32), n):
+            mask = 0
+            for i in indices: mask |= 1 << i
+            for trump in range(4):
+                glory = mask_glory(mask, trump)
+                if glory: table[trump][mask] = glory
+    return table
+
+def load_glory_table(path=GLORY_TABLE_FILE):
+    '''Loads the glory table from path, or builds it and tries to store it there.'''
+    try:
+        with open(path, "rb") as f:
+            version, table = pickle.load(f)
+        if version == GLORY_TABLE_VERSION:
+            return table
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+        pass
+    table = build_glory_table()
+    try:
+        with open(path, "wb") as f:
+            pickle.dump((GLORY_TABLE_VERSION, table), f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass
+    return table
+
+def trick_glory(mask, trump):
+    '''Glory of the trick with bitmask mask, in O(1) by looking it up in the glory table'''
+    global _glory_table
+    if _glory_table is None:
+        _glory_table = load_glory_table()
+    return _glory_table[trump].get(mask, 0)
+
+def partial_glory(mask, fake, trump):
+    '''Glory of at most four cards with bitmask mask, plus some fake cards if fake is True'''
+    if not fake:
+        if trump is None: return mask_glory(mask, trump)
+        return trick_glory(mask, trump)
+    #Fake cards never make glory, but they do count as a different value
+    if not mask: return 100
+    return _suit_glory(mask, trump)
+
+def glory_calculation(cards, trump):
+    mask = 0
+    fake = False
+    for c in cards:
+        if c.color == FAKE: fake = True
+        else: mask |= 1 << c.index
+    if not fake and len(cards) > 4:
+        return mask_glory(mask, trump)
+    return partial_glory(mask, fake, trump)
@@ -0,0 +1,45 @@
+import collections
+import threading
+import time
+
+class DecisionCache(object):
+    '''The cards the AI's played in challenge games, shared by all games. Everyone in a
+    challenge plays the same deals against the same AI's, so when the moves of a game so far
+    are the same as in an earlier one, an AI seat can play the card it played there instead of
+    searching again. Keys are (seed, first player, seat, moves so far).
+
+    Entries expire ttl seconds after they were stored, and at most max_entries are kept:
+    when there are more the oldest are dropped.'''
+    def __init__(self, max_entries=10000, ttl=3*24*3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # key -> (time stored, card index), the oldest first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        '''Returns the card index stored for key, or None'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] + self.ttl < time.time():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, index):
+        with self.lock:
+            self.entries[key] = (time.time(), index)
+            self.entries.move_to_end(key)
+            self.expire()
+
+    def expire(self):
+        now = time.time()
+        while self.entries:
+            stored, _ = next(iter(self.entries.values()))
+            if len(self.entries) <= self.max_entries and stored + self.ttl >= now: return
+            self.entries.popitem(last=False)
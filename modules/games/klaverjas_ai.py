@@ -1,10 +1,16 @@
 if __package__ is None or __package__ == '':
     from cards import *
+    from klaverjas_solver import evaluate_states
+    from klaverjas_sampler import DealSampler
+    from klaverjas_book import get_book
 else:
     from .cards import *
+    from .klaverjas_solver import evaluate_states
+    from .klaverjas_sampler import DealSampler
+    from .klaverjas_book import get_book
 
 import random
-import itertools
+import time
 
 class BasePlayer(object):
     def __init__(self, index):
@@ -12,8 +18,39 @@ class BasePlayer(object):
         self.name = ["Henk", "Ingrid", "Klaas", "Bert"][index]
         self.silent = False
         self.printer = pp
+        self.random = random.Random() # Source of all random choices, seed it to make them reproducible
         self.reset()
 
+    def seed(self, seed):
+        self.random.seed(seed)
+
+    def __setstate__(self, state): #also loads the players pickled before possible cards were bitmasks
+        self.__dict__.update(state)
+        if "possible" not in state:
+            self.possible = [cards_to_mask(d) for d in state["unknown_cards"]]
+            #unknown_colours was one list shared by the three players, so the voids follow from the cards
+            self.voids = [sum(1 << color for color in range(4) if not mask & suit_masks[color]) for mask in self.possible]
+            self.mystery = cards_to_mask(state["mystery_cards"])
+            for name in ("unknown_cards", "unknown_colours", "mystery_cards"):
+                self.__dict__.pop(name, None)
+        if "random" not in state:
+            self.random = random.Random()
+
+    def knowledge(self):
+        '''What we concluded about the other players while playing our cards, as something
+        that can be saved as JSON. The cards we see played are handled by show_trick.'''
+        return {"possible": list(self.possible), "voids": list(self.voids), "mystery": self.mystery,
+                "prefered": sorted(self.prefered_colors.items()), "signed": sorted(self.signed_colors.items()),
+                "partner_trump": self.flag_partner_started_with_trump}
+
+    def set_knowledge(self, knowledge):
+        self.possible = list(knowledge["possible"])
+        self.voids = list(knowledge["voids"])
+        self.mystery = knowledge["mystery"]
+        self.prefered_colors = dict(knowledge["prefered"])
+        self.signed_colors = dict(knowledge["signed"])
+        self.flag_partner_started_with_trump = knowledge["partner_trump"]
+
     def reset(self):
         self.partner = None # Index of player on your team
         self.cards = Cards() # Current cards in your hand
@@ -22,19 +59,11 @@ class BasePlayer(object):
         self.points2 = 0 # Points of the defending team
         self.trump = None # The suite of Trump
         self.is_playing = False # Whether we are the 'attacking' team.
-        #We want to record what the possible cards are for every player
-        self.unknown_cards = [create_deck(), create_deck(), create_deck()]
-        #unknown_cards[0] is the player next, [1] is our mate, and [2] is the player before us
-        index = self.index
-        self.unknown_cards[0].owner = (1 + index) % 4
-        self.unknown_cards[1].owner = (2 + index) % 4
-        self.unknown_cards[2].owner = (3 + index) % 4
-        for i,d in enumerate(self.unknown_cards):
-            j = (index+i+1)%4
-            d.owner = j
-            for c in d: c.owner = j
-        self.unknown_colours = [list(range(4))]*3 # The possible colours every player might have
-        self.mystery_cards = create_deck() # The cards still in play that we don't have
+        #We want to record what the possible cards are for every player, as bitmasks
+        #possible[0] is the player next, [1] is our mate, and [2] is the player before us
+        self.possible = [ALL_CARDS, ALL_CARDS, ALL_CARDS]
+        self.voids = [0, 0, 0] # For every player a bit for every colour we concluded he doesn't have
+        self.mystery = ALL_CARDS # Bitmask of the cards still in play that we don't have
         self.prefered_colors = {} # Dictionary containing information about which colors are desirable to play
         self.signed_colors = {} # The colors we have given information of to our mate
         self.flag_partner_started_with_trump = False
@@ -63,27 +92,47 @@ class BasePlayer(object):
         self.trump = trump
         for c in self.cards.filter_color(trump):
             c.is_trump = True
-        for deck in self.unknown_cards:
-            for card in deck.filter_color(trump):
-                card.is_trump = True
-        for c in self.mystery_cards.filter_color(trump):
-            c.is_trump = True
 
     def give_cards(self,cards):
         self.cards = cards
         self.cards.sort()
         for c in self.cards:
             c.owner = self.index
-            for deck in self.unknown_cards:
-                deck.remove(c)
-            self.mystery_cards.remove(c)
+        self.remove_known_cards(self.cards)
+
+    def slot(self, index):
+        '''Returns the position of player index in possible'''
+        if index == self.index or index not in range(4):
+            raise ValueError("Player {} has no slot for player {}".format(self.index, index))
+        return (index - self.index - 1) % 4
+
+    def possible_cards(self, slot, color=None):
+        '''Creates a new Cards object with the cards the player in this slot might have'''
+        mask = self.possible[slot]
+        if color is not None: mask &= suit_masks[color]
+        return mask_to_cards(mask, self.trump)
+
+    def remove_known_cards(self, cards):
+        '''Nobody can have these cards anymore'''
+        mask = ~cards_to_mask(cards)
+        for i in range(3):
+            self.possible[i] &= mask
+        self.mystery &= mask
+
+    def player_has_card(self, player, card):
+        '''Player has this card, so the others can't have it'''
+        mask = ~(1 << card.index)
+        for i in range(3):
+            if (self.index + i + 1) % 4 == player: continue
+            self.possible[i] &= mask
 
+    def count_trumps(self, mask):
+        '''Returns the amount of trumps in mask'''
+        return mask_count(mask & suit_masks[self.trump])
 
-    def index_to_deck(self, index):
-        for d in self.unknown_cards:
-            if d.owner == index:
-                return d
-        raise NotImplementedError("Wrong index given")
+    def higher_in_color(self, card):
+        '''Returns the bitmask of the cards of the colour of card that are higher'''
+        return higher_mask(card.index, self.trump) & suit_masks[card.color]
 
     def index_to_mate(self, index):
         if index == 0: return 2
@@ -100,10 +149,10 @@ class BasePlayer(object):
 
     def is_high(self, card):
         '''returns whether card is the highest one of that colour'''
-        for d in self.unknown_cards:
-            if card.owner == d.owner: continue
-            filt = d.higher_then(card)
-            if filt:
+        higher = self.higher_in_color(card)
+        for i in range(3):
+            if card.owner == (self.index + i + 1) % 4: continue
+            if self.possible[i] & higher:
                 return False
         return True
 
@@ -111,30 +160,7 @@ class BasePlayer(object):
         pass
 
     def legal_cards(self, played_cards):
-        if not played_cards: return self.cards #first to play, everything is legal
-        played_cards = Cards(played_cards)
-        color = played_cards[0].color
-        played_trumps = played_cards.filter_color(self.trump)
-        highest = highest_card(played_cards)
-        if highest.owner == None:
-            raise KeyError("Played card doesn't have owner")
-        winning = (highest.owner == self.partner)
-        cards = self.cards.filter_color(color)
-        if cards: #we can confess colour
-            if color != self.trump: return cards #no trumps so no restrictions
-            #must not undertrump
-            higher = [t for t in cards if t>highest]
-            if higher: return higher # We must overtrump
-            return cards
-        trumps = self.cards.get_trumps()
-        if not trumps: return self.cards # Don't have any trumps so everything is legal
-        if not played_trumps and not winning: return trumps # We aren't winning and we have trumps, so we must play one of those
-        higher = [t for t in trumps if t>highest]
-        if higher and not winning: return higher # We must overtrump
-        c = self.cards.filter(lambda c: c.color!=self.trump) #Any card except trumps
-        c.extend(higher)
-        if c: return c
-        return self.cards #we can't overtrump, but we only have trumps so we need to play them.
+        return legal_cards(self.cards, played_cards, self.trump, self.partner)
 
 
 
@@ -142,7 +168,15 @@ class BasePlayer(object):
 
 
 class AI(BasePlayer):
+    workers = 0 # Amount of processes do_minmax spreads its work over, 0 to do everything in this process
+    use_book = True # Whether to look up the trump and the first lead in the opening book
+
     def pick_trump(self):
+        if self.use_book:
+            trump = get_book().trump(self.cards.mask())
+            if trump is not None:
+                self.pp("Trump from the opening book")
+                return trump
         maxval = 0
         picked = 0
         for color in range(4): #we go trough every colour and assign a value to them
@@ -211,22 +245,32 @@ class AI(BasePlayer):
 
         def remove_all_in_color(index, color, exceptions=[]):
             if index == self.index: return
-            d = self.index_to_deck(index)
-            for cc in  [a for a in d if (a.color == color and a.value not in exceptions)]:
-                d.remove(cc)
-            if not exceptions or not any(c in d.filter_color(color).values() for c in exceptions):
-                i = (index-1-self.index)%4
-                if color in self.unknown_colours[i]: self.unknown_colours[i].remove(color)
+            i = self.slot(index)
+            mask = suit_masks[color]
+            for v in exceptions: mask &= ~(1 << (8*color + v))
+            self.possible[i] &= ~mask
+            if not self.possible[i] & suit_masks[color]:
+                self.voids[i] |= 1 << color
+
+        def remove_card(index, card):
+            if index == self.index: return
+            self.possible[self.slot(index)] &= ~(1 << card.index)
+
+        def remove_higher_trumps(index, highest):
+            i = self.slot(index)
+            trumps = self.possible[i] & suit_masks[self.trump]
+            higher = trumps & self.higher_in_color(highest)
+            if higher == trumps: remove_all_in_color(index, self.trump)
+            else: self.possible[i] &= ~higher
         
         if p != self.index: #we did not start this round
-            d = self.index_to_deck(p)
+            d = self.possible[self.slot(p)]
             if round == 1:
                 if color != self.trump: #starting player didn't play a trump
-                    if Card(JACK, self.trump) in d:
-                        d.remove(Card(JACK, self.trump))
+                    remove_card(p, Card(JACK, self.trump))
                 else:
                     if cards[0].value == NINE:
-                        if Card(JACK, self.trump) in d:
+                        if d >> Card(JACK, self.trump).index & 1:
                             self.player_has_card(p, Card(JACK, self.trump))
                     elif cards[0].value != JACK and p == self.partner:
                         self.pp("Mate started with non-high trump, so he probably wants it back")
@@ -237,7 +281,7 @@ class AI(BasePlayer):
 
             #if not self.player_is_playing(p): #player starting didn't play
             if cards[0].value == TEN and color != self.trump:
-                if Card(ACE, color) in d:
+                if self.possible[self.slot(p)] >> Card(ACE, color).index & 1:
                     self.player_has_card(p, Card(ACE, color))
 
         if color == self.trump and cards[0].value == JACK:
@@ -258,14 +302,12 @@ class AI(BasePlayer):
                         self.prefered_colors[m.color] = 2
                         self.pp("Mate signed card color")
                         if round < 6 and m.value == ACE:
-                            if Card(TEN, m.color) in self.unknown_cards[1]:
-                                self.unknown_cards[1].remove(Card(TEN,m.color))
+                            remove_card(self.partner, Card(TEN, m.color))
                     elif m.value in (QUEEN, KING, TEN): #mate is de-signing the color
                         self.pp("Mate signed off card color")
                         self.prefered_colors[m.color] = -2
                         if round < 6 and m.value == TEN:
-                            if Card(ACE, m.color) in self.unknown_cards[1]:
-                                self.unknown_cards[1].remove(Card(ACE,m.color))
+                            remove_card(self.partner, Card(ACE, m.color))
         if h.owner not in (self.index, self.partner) and h.owner in (cards[0].owner,cards[1].owner): # opponent won this round early
             m = cards[2] if (cards[0].owner == h.owner) else cards[3] # the card of its mate
             if m.color not in (color, self.trump): #mate didn't confess color and didn't trump
@@ -274,14 +316,12 @@ class AI(BasePlayer):
                         self.prefered_colors[m.color] = -1
                         self.pp("Opponent signed card color")
                         if round < 6 and m.value == ACE:
-                            if Card(TEN, m.color) in self.index_to_deck(m.owner):
-                                self.index_to_deck(m.owner).remove(Card(TEN,m.color))
+                            remove_card(m.owner, Card(TEN, m.color))
                     elif m.value in (QUEEN, KING, TEN): #mate is de-signing the color
                         self.pp("Opponent signed off card color")
                         self.prefered_colors[m.color] = 1
                         if round < 6 and m.value == TEN:
-                            if Card(ACE, m.color) in self.index_to_deck(m.owner):
-                                self.index_to_deck(m.owner).remove(Card(ACE,m.color))
+                            remove_card(m.owner, Card(ACE, m.color))
         
         for c in cards:
             if c.owner == self.index: continue
@@ -295,8 +335,7 @@ class AI(BasePlayer):
                         self.prefered_colors[c.color] = -2
                     elif c.color not in self.prefered_colors:
                         self.prefered_colors[c.color] = 1
-                    d = self.index_to_deck(c.owner)
-                    if Card(ACE, c.color) in d: d.remove(Card(ACE, c.color))
+                    remove_card(c.owner, Card(ACE, c.color))
 
         if color == self.trump: #trump asked
             highest = cards[0]
@@ -306,13 +345,7 @@ class AI(BasePlayer):
                         highest = c
                     else: #didn't overtrump, remove those possibilities
                         if c.owner == self.index: continue
-                        d = self.index_to_deck(c.owner)
-                        rem = [a for a in d if (a.color == self.trump and a > highest)]
-                        if rem == d.filter_color(self.trump):
-                            remove_all_in_color(c.owner, self.trump)
-                        else:
-                            for cc in rem:
-                                d.remove(cc)
+                        remove_higher_trumps(c.owner, highest)
                 else: #couldn't confess color
                     if c.owner == self.index: continue
                     remove_all_in_color(c.owner, self.trump)
@@ -328,13 +361,7 @@ class AI(BasePlayer):
                             if highest.color != self.trump:
                                 remove_all_in_color(c.owner, self.trump)
                             else:
-                                d = self.index_to_deck(c.owner)
-                                rem = [a for a in d if (a.color == self.trump and a > highest)]
-                                if rem == d.filter_color(self.trump):
-                                    remove_all_in_color(c.owner, self.trump)
-                                else:
-                                    for cc in rem:
-                                        d.remove(cc)
+                                remove_higher_trumps(c.owner, highest)
         
         highest = highest_card(cards)
         if highest.owner != cards[3].owner: #last person didn't win the round
@@ -348,7 +375,7 @@ class AI(BasePlayer):
         if color != self.trump:
             a = Card(ACE, color)
             t = Card(TEN, color)
-            if a in self.mystery_cards: #we haven't seen the ACE yet
+            if self.mystery >> a.index & 1: #we haven't seen the ACE yet
                 if a not in cards and cards[0].value!=TEN: #it is not played in this round
                     if self.trump not in Cards(cards).colors(): #not trumped in anywhere
                         pass
@@ -381,7 +408,7 @@ class AI(BasePlayer):
             if c.owner == self.index: continue
             if c.color != color and c.value in (TEN, ACE) and c != highest and self.index_to_mate(c.owner) != highest.owner:
                 mate = (c.owner+1-self.index)%4
-                if i == 2 or (mate!=3 and color not in self.unknown_colours[mate]) or (color not in self.cards.colors()):
+                if i == 2 or (mate!=3 and self.voids[mate] >> color & 1) or (color not in self.cards.colors()):
                     self.pp("Person threw away valuable card to opponent, must not have lower cards to play")
                     for col in range(4):
                         if col == self.trump: continue
@@ -389,25 +416,10 @@ class AI(BasePlayer):
         
         # If the possible cards of a player exactly match how many cards they should have,
         # we remove those possibilities from other players
-        for d in self.unknown_cards:
-            if len(d) == len(self.cards):
-                for c in d:
-                    self.player_has_card(d.owner, c)
-
-    def remove_known_cards(self, cards):
-        for deck in self.unknown_cards:
-            for c in cards:
-                if c in deck:
-                    deck.remove(c)
-        for c in cards:
-            if c in self.mystery_cards:
-                self.mystery_cards.remove(c)
-        
-    def player_has_card(self, player, card):
-        for d in self.unknown_cards:
-            if d.owner == player: continue
-            if card in d:
-                d.remove(card)
+        for i in range(3):
+            if mask_count(self.possible[i]) == len(self.cards):
+                for j in range(3):
+                    if j != i: self.possible[j] &= ~self.possible[i]
 
     def play_this_card(self, card): #helper function to remove it from lists
         self.cards.remove(card)
@@ -431,12 +443,12 @@ class AI(BasePlayer):
         # And we are not last to play, there is exactly one other player that
         # needs to play a card
         p = notyetplayed[0]
-        d = self.index_to_deck(p) # Possible cards in hand of the player
+        d = self.possible[self.slot(p)] # Possible cards in hand of the player
         if is_trumped: #winning card is trump
-            if d.higher_then(h): return False # Person could overtrump
+            if d & self.higher_in_color(h): return False # Person could overtrump
             else: return True
-        if d.filter_color(self.trump): return False # Person could trump in
-        if d.higher_then(h): return False
+        if d & suit_masks[self.trump]: return False # Person could trump in
+        if d & self.higher_in_color(h): return False
         return True
 
 
@@ -450,13 +462,13 @@ class AI(BasePlayer):
             filt = [c for c in high_cards if self.glory_possibility(c)]
             if filt:
                 return filt[0]
-            if len(high_cards) >= len(self.mystery_cards.get_trumps()):
+            if len(high_cards) >= self.count_trumps(self.mystery):
                 return high_cards[0]
             elif len(high_cards) > 1:
                 return high_cards[0]
             else:
-                m = len(self.unknown_cards[0].get_trumps())
-                n = len(self.unknown_cards[2].get_trumps())
+                m = self.count_trumps(self.possible[0])
+                n = self.count_trumps(self.possible[2])
                 if m <= 1 and n <= 1:
                     if high_cards:
                         return high_cards[0] #the other team only have a maximum of 1 trump each
@@ -487,9 +499,8 @@ class AI(BasePlayer):
                 if len(poss) > 1:
                     self.pp("We will try to free our TEN")
                     return poss[0]
-            if self.unknown_cards[0].get_trumps():
-                colors = list(range(4))
-                for color in self.unknown_cards[0].colors(): colors.remove(color)
+            if self.possible[0] & suit_masks[self.trump]:
+                colors = [color for color in range(4) if not self.possible[0] & suit_masks[color]]
                 for color in colors:
                     poss = sorted([c for c in non_trumps.filter_color(color) if c.value not in (TEN,ACE)])
                     if poss: 
@@ -613,7 +624,7 @@ class AI(BasePlayer):
         self.pp("We can't signal on a color")
         for color in colors:
             filt = self.cards.filter_color(color)
-            if len(filt) == 1 and len(self.mystery_cards.filter_color(color))>5 and filt[0].value in (JACK, QUEEN, KING):
+            if len(filt) == 1 and mask_count(self.mystery & suit_masks[color])>5 and filt[0].value in (JACK, QUEEN, KING):
                 self.pp("Give glory sensitive solo card")
                 self.signed_colors[color]=-1
                 return filt[0]
@@ -664,7 +675,7 @@ class AI(BasePlayer):
         poss = Cards()
         for color in colors:
             filt = self.cards.filter_color(color)
-            if len(filt) == 1 and filt[0].value not in (ACE, TEN, SEVEN) and len(self.mystery_cards.filter_color(color))>=6:
+            if len(filt) == 1 and filt[0].value not in (ACE, TEN, SEVEN) and mask_count(self.mystery & suit_masks[color])>=6:
                 self.pp("Trow away single glory sensitive card")
                 return filt[0]
             # if len(filt) >= 4:
@@ -685,9 +696,14 @@ class AI(BasePlayer):
         return c
             
 
-    def play_card(self, rnum, played_cards):
+    def play_card(self, rnum, played_cards, budget=None, cache=None, cache_key=None):
         '''This function is called by the game class. It should return
-        the card that the AI is playing this round.'''
+        the card that the AI is playing this round. If budget is given,
+        the AI can think for about that many seconds, see do_minmax. It
+        only searches from round 5 on: the first 4 rounds are played by
+        rules that take no time, so there the budget isn't used. If cache
+        is given (see decisions.DecisionCache), a search is only done when
+        there is no card stored for cache_key yet.'''
         played_cards = Cards(played_cards)
         self.played_cards = played_cards
         self.round = rnum
@@ -695,8 +711,14 @@ class AI(BasePlayer):
         if len(legal) == 1:
             self.pp("Only one legal card to play")
             return self.play_this_card(legal[0])
-        if self.round >= 6 or (self.round == 5 and len(played_cards)>1):
-            c = self.do_minmax()
+        if rnum == 1 and not played_cards and self.use_book:
+            index = get_book().lead(self.cards.mask(), self.trump)
+            for c in legal:
+                if c.index == index:
+                    self.pp("Lead from the opening book")
+                    return self.play_this_card(c)
+        if self.round >= 5:
+            c = self.cached_minmax(budget, cache, cache_key)
             if c: return self.play_this_card(c)
         trumps = self.cards.get_trumps().sorted()
         high_trumps = trumps.filter(self.is_high)
@@ -712,10 +734,10 @@ class AI(BasePlayer):
                     return self.play_this_card(filt.has(NINE))
                 return self.play_this_card(filt.sorted()[0])
 
-            n = len(self.unknown_cards[0].get_trumps())
-            m = len(self.unknown_cards[2].get_trumps())
-            mate_trumps = len(self.unknown_cards[1].get_trumps())
-            totaltrumps = len(self.mystery_cards.get_trumps())
+            n = self.count_trumps(self.possible[0])
+            m = self.count_trumps(self.possible[2])
+            mate_trumps = self.count_trumps(self.possible[1])
+            totaltrumps = self.count_trumps(self.mystery)
             if n!=0 and m!=0 and totaltrumps>1 and trumps and not mate_trumps : #we want to trade 2 for 1
                 if len(trumps)>1 or not trumps.has(NINE): # More than one trump, or otherwise we have something lower than the nine
                     
@@ -774,8 +796,8 @@ class AI(BasePlayer):
             if not possibilities:
                 self.pp("Can't confess color")
                 if trumps:
-                    opponent_trumps = max((len(self.unknown_cards[0].get_trumps()),
-                                           len(self.unknown_cards[2].get_trumps())))
+                    opponent_trumps = max(self.count_trumps(self.possible[0]),
+                                          self.count_trumps(self.possible[2]))
                     if opponent_trumps < len(high_trumps):
                         high_non_trumps = non_trumps.filter(self.is_high)
                         if (non_trumps == high_non_trumps or
@@ -966,93 +988,86 @@ class AI(BasePlayer):
 
         raise NotImplementedError("Ahhhh, shouldn't get here!")
 
-    def generate_all_distributions(self, rnum, played_cards):
-        cardsleft = [9-rnum]*3
-        for c in played_cards:
-            cardsleft[(c.owner - self.index -1)%4] -= 1
-
-        for c1 in itertools.combinations(self.unknown_cards[0], cardsleft[0]):
-            r2 = self.unknown_cards[1].copy()
-            for c in c1:
-                if c in r2: r2.remove(c)
-            if len(r2) < cardsleft[1]: continue
-            for c2 in itertools.combinations(r2, cardsleft[1]):
-                r3 = self.unknown_cards[2].copy()
-                for c in c1+c2:
-                    if c in r3: r3.remove(c)
-                if len(r3) < cardsleft[2]: continue
-                for c3 in itertools.combinations(r3, cardsleft[2]):
-                    yield [c1,c2,c3]
-
-    def generate_distribution(self, rnum, played_cards):
+    def deal_sampler(self, rnum, played_cards):
+        '''Returns a DealSampler for the hands the other players might have'''
         cardsleft = [9-rnum]*3
         for c in played_cards:
             cardsleft[(c.owner - self.index -1)%4] -= 1
+        return DealSampler(self.possible, cardsleft)
+
+    def evaluate_distributions(self, options, distributions):
+        '''Solves every distribution for every card in options, and appends the scores to options'''
+        playing = tuple(self.player_is_playing(i) for i in range(4))
+        trick = tuple(c.index for c in self.played_cards)
+        states = []
+        for distribution in distributions:
+            hands = [0]*4
+            hands[self.index] = self.cards.mask()
+            for i,hand in enumerate(distribution):
+                hands[(self.index+i+1)%4] = hand
+            states.append((tuple(hands), self.trump, playing, self.points1, self.points2,
+                           self.index, self.round, trick))
+        results = evaluate_states(states, [c.index for c in options], self.workers)
+        for values in results:
+            for c, points in zip(options, values):
+                if not self.is_playing: points = -points
+                options[c].append(points)
 
-        while True:
-            c1 = random.sample(self.unknown_cards[0], cardsleft[0])
-            r2 = self.unknown_cards[1].copy()
-            for c in c1:
-                if c in r2: r2.remove(c)
-            if len(r2) < cardsleft[1]: continue
-            c2 = random.sample(r2, cardsleft[1])
-            r3 = self.unknown_cards[2].copy()
-            for c in c1+c2:
-                if c in r3: r3.remove(c)
-            if len(r3) < cardsleft[2]: continue
-            c3 = random.sample(r3, cardsleft[2])
-            return [c1,c2,c3]
-
-
-    def do_minmax(self, amount=None):
-        self.pp("Minmaxing")
-        options = {c:list() for c in self.legal_cards(self.played_cards)}
+    def note_played_cards(self):
+        '''Updates what we know of the other hands with the cards played this round'''
         self.remove_known_cards(self.played_cards)
         if self.played_cards and self.played_cards[0].value == TEN:
             self.player_has_card(self.played_cards[0].owner, Card(ACE, self.played_cards[0].color))
+
+    def cached_minmax(self, budget=None, cache=None, key=None):
+        '''do_minmax, but the card found is stored in cache under key, and
+        when a card is stored there already it is played again'''
+        if cache is None: return self.do_minmax(budget=budget)
+        index = cache.get(key)
+        if index is not None:
+            for c in self.cards:
+                if c.index == index:
+                    self.pp("Playing the card found before in this position")
+                    self.note_played_cards()
+                    return c
+        c = self.do_minmax(budget=budget)
+        if c: cache.put(key, c.index)
+        return c
+
+    def do_minmax(self, amount=None, budget=None):
+        '''Picks a card by solving deals of the hidden cards. Without a budget a fixed amount of
+        deals is solved. With a budget in seconds it keeps sampling and solving new deals until
+        the time is up, and returns the best card found so far. The time is checked after every
+        batch of a deal per worker, so a move can take a bit longer than the budget: the first
+        batch is always solved in full, even for a budget of 0, as a card can't be picked
+        without any deal. When there are few enough deals that they are all solved, the budget
+        isn't used either.'''
+        t = time.time()
+        self.pp("Minmaxing")
+        options = {c:list() for c in self.legal_cards(self.played_cards)}
+        self.note_played_cards()
         if self.round < 6:
             maxcount = 100//len(options) if not amount else amount
         else:
             maxcount = 200//len(options) if not amount else amount
-        distributions = []
-        count = 0 
-        for i,d in enumerate(self.generate_all_distributions(self.round, self.played_cards)):
-            distributions.append(d)
-            count += 1
-            if count>500: break
-        if count == 0:
+        sampler = self.deal_sampler(self.round, self.played_cards)
+        if sampler.count == 0:
             self.pp("No valid distributions")
             return None
-        #if count>500:
-        if count>maxcount:
-            self.pp("Too many distributions, picking randomly")
-            distributions = [self.generate_distribution(self.round,self.played_cards) for i in range(maxcount)]
-        # elif count>maxcount:
-        #     self.pp("{!s} distributions, taking a subset".format(count))
-        #     skipvalue = (count-1)//maxcount + 1
-        #     distributions = [d for i,d in enumerate(distributions) if i%skipvalue == 0]
+        if sampler.count <= maxcount:
+            self.pp("Evaluating {!s} possibilities".format(sampler.count))
+            self.evaluate_distributions(options, sampler.all_deals())
+        elif budget is None:
+            self.pp("{!s} distributions, picking {!s} randomly".format(sampler.count, maxcount))
+            self.evaluate_distributions(options, sampler.deals(self.random, samples=maxcount))
         else:
-            self.pp("Evaluating {!s} possibilities".format(count))
-        
-        players = []
-        p = DummyPlayer(self.index, self.is_playing, self.trump, Cards(self.cards))
-        players.append(p)
-        for i in range(3):
-            index = (self.index+i+1)%4
-            p = DummyPlayer(index, self.player_is_playing(index), self.trump, Cards())
-            players.append(p)
-        players.sort(key=lambda p: p.index)
-        for hands in distributions:
-            for i,hand in enumerate(hands):
-                players[(self.index+i+1)%4].cards = Cards(hand)
-            m = MinMaxer(players, self.trump, self.points1, self.points2, 
-                         self.index, self.round, Cards(self.played_cards))
-            for c in options:
-                m2 = m.copy()
-                m2.progress_game(c)
-                points1, points2 = m2.do_minmax()
-                points = points1 - points2 if self.is_playing else points2 - points1
-                options[c].append(points)
+            batch = max(1, self.workers)
+            count = 0
+            while True:
+                self.evaluate_distributions(options, [sampler.sample(self.random) for i in range(batch)])
+                count += batch
+                if time.time() - t >= budget: break
+            self.pp("{!s} distributions, evaluated {!s} randomly in {:.2f}s".format(sampler.count, count, time.time()-t))
 
         scores = {}
         best_score = -500
@@ -1072,18 +1087,19 @@ class AI(BasePlayer):
     def glory_possibility(self, card):
         '''Returns wether there is still a chance this card can produce glory'''
         color = card.color
-        d1 = self.unknown_cards[0].filter_color(color)
-        d2 = self.unknown_cards[1].filter_color(color)
-        d3 = self.unknown_cards[2].filter_color(color)
-        if not d1: d1 = [fake_card()]
-        if not d2: d2 = [fake_card()]
-        if not d3: d3 = [fake_card()]
-        for a in d1:
-            for b in d2:
-                for c in d3:
-                    if glory_calculation([a,b,c], self.trump): continue #disregard glory caused by other cards
-                    g = glory_calculation([card, a, b, c], self.trump)
-                    if g: return True
+        #For every player the bits of the cards of this colour he might have, or 0 for a fake card
+        options = []
+        for d in self.possible:
+            suit = d & suit_masks[color]
+            options.append([1 << i for i in range(8*color, 8*color+8) if suit >> i & 1] or [0])
+        bit = 1 << card.index
+        for a in options[0]:
+            for b in options[1]:
+                for c in options[2]:
+                    mask = a | b | c
+                    fake = not (a and b and c)
+                    if partial_glory(mask, fake, self.trump): continue #disregard glory caused by other cards
+                    if partial_glory(mask | bit, fake, self.trump): return True
         return False
 
     def maxmin_glory(self, cards, maximize = True, deck=None, color=None):
@@ -1121,8 +1137,8 @@ class AI(BasePlayer):
             return (best, glory)
         if len(cards) == 2:
             for c in poss:
-                other = self.unknown_cards[0].filter_color(c.color) # the cards of the next player
-                if not other: other = self.unknown_cards[0].filter_color(cards[0].color)
+                other = self.possible_cards(0, c.color) # the cards of the next player
+                if not other: other = self.possible_cards(0, cards[0].color)
                 if not other:
                     g = glory_calculation(cards + [c], self.trump)
                     if mult*cmp(g,glory) == 1:
@@ -1142,8 +1158,8 @@ class AI(BasePlayer):
                         best = c
             return (best, glory)
         if len(cards) == 1:
-            other1 = self.unknown_cards[0].filter_color(cards[0].color)
-            other2 = self.unknown_cards[1].filter_color(cards[0].color)
+            other1 = self.possible_cards(0, cards[0].color)
+            other2 = self.possible_cards(1, cards[0].color)
             if not other1:
                 other1 = other2
                 other2 = []
@@ -1183,126 +1199,3 @@ class AI(BasePlayer):
             return (best, glory)
         if len(cards) == 0:
             raise Exception("Shouldn't call this function when played_cards is empty")
-
-
-
-class DummyPlayer(object):
-    def __init__(self, index, is_playing, trump, cards):
-        self.index = index
-        self.partner = (index+2)%4
-        self.is_playing = is_playing
-        self.trump = trump
-        self.cards = cards
-
-    def copy(self):
-        return DummyPlayer(self.index, self.is_playing, self.trump, Cards(self.cards))
-
-    def legal_cards(self, played_cards):
-        if not played_cards: return self.cards #first to play, everything is legal
-        played_cards = Cards(played_cards)
-        color = played_cards[0].color
-        played_trumps = played_cards.filter_color(self.trump)
-        highest = highest_card(played_cards)
-        if highest.owner == None:
-            raise KeyError("Played card doesn't have owner")
-        winning = (highest.owner == self.partner)
-        cards = self.cards.filter_color(color)
-        if cards: #we can confess colour
-            if color != self.trump: return cards #no trumps so no restrictions
-            #must not undertrump
-            higher = [t for t in cards if t>highest]
-            if higher: return higher # We must overtrump
-            return cards
-        trumps = self.cards.get_trumps()
-        if not trumps: return self.cards # Don't have any trumps so everything is legal
-        if not played_trumps and not winning: return trumps # We aren't winning and we have trumps, so we must play one of those
-        higher = [t for t in trumps if t>highest]
-        if higher and not winning: return higher # We must overtrump
-        c = self.cards.filter(lambda c: c.color!=self.trump) #Any card except trumps
-        c.extend(higher)
-        if c: return c
-        return self.cards #we can't overtrump, but we only have trumps so we need to play them.
-
-
-
-class MinMaxer(object):
-    def __init__(self, players, trump, points1, points2, currentplayer, round, played_cards):
-        self.players = players
-        self.round = round
-        self.played_cards = played_cards
-        self.currentplayer = currentplayer
-        self.trump = trump
-        self.points1 = points1
-        self.points2 = points2
-
-    def copy(self):
-        players = [p.copy() for p in self.players]
-        return MinMaxer(players, self.trump, self.points1, self.points2, 
-                        self.currentplayer, self.round, Cards(self.played_cards))
-
-    def progress_game(self,c):
-        self.players[self.currentplayer].cards.remove(c)
-        self.played_cards.append(c)
-        if len(self.played_cards) != 4:
-            self.currentplayer = (self.currentplayer + 1)%4
-            return
-        cards = self.played_cards
-        h = highest_card(cards,self.trump)
-        winner = h.owner 
-        points = card_points(cards, self.trump)
-        glory = glory_calculation(cards, self.trump)
-        if self.players[winner].is_playing: 
-            self.points1 += points + glory
-            if self.round == 8: self.points1 += 10
-        else: 
-            self.points2 += points + glory
-            if self.round == 8: self.points2 += 10
-        
-        if self.round == 8:
-            if self.points1 == 0:
-                self.points2 += 100
-            if self.points2 == 0:
-                self.points1 += 100
-            if self.points1 < self.points2: #Nat
-                self.points2 += self.points1
-                self.points1 = 0
-
-
-        self.currentplayer = winner
-        self.round += 1
-        self.played_cards = Cards()
-
-    def do_minmax(self):
-        while True:
-            p = self.players[self.currentplayer]
-            options = p.legal_cards(self.played_cards)
-            #print(self.round, self.currentplayer, options, [len(p.cards) for p in self.players])
-            if len(options) == 1:
-                self.progress_game(options[0])
-            else:
-                break
-            if self.round > 8:
-                return self.points1, self.points2
-
-        #best_card = None
-        best_score = -500
-        p1, p2 = 0, 0
-        for c in options:
-            m = self.copy()
-            #print("Going deeper")
-            #print(self.round, self.currentplayer, [len(p.cards) for p in m.players])
-            m.progress_game(c)
-            points1, points2 = m.do_minmax()
-            if p.is_playing: points = points1 - points2
-            else: points = points2 - points1
-            if points > best_score:
-                best_score = points
-                #best_card = c
-                p1 = points1
-                p2 = points2
-
-        return p1, p2
-
-
-
-
@@ -0,0 +1,97 @@
+import array
+import os
+import struct
+
+BOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "klaverjas_book.bin")
+MAGIC = b"KJBOOK"
+VERSION = 1
+
+def suit_bytes(mask):
+    return [(mask >> 8*color) & 0xFF for color in range(4)]
+
+def trump_key(mask):
+    '''Returns the key of a hand for choosing trump, which is the same for hands that only
+    differ by a permutation of the colours, and the colours in the order of the key'''
+    s = suit_bytes(mask)
+    order = sorted(range(4), key=lambda color: s[color])
+    return sum(s[color] << 8*i for i, color in enumerate(order)), order
+
+def lead_key(mask, trump):
+    '''Like trump_key, but for leading with a given trump, which is kept as the first colour'''
+    s = suit_bytes(mask)
+    order = [trump] + sorted((color for color in range(4) if color != trump), key=lambda color: s[color])
+    return sum(s[color] << 8*i for i, color in enumerate(order)), order
+
+class OpeningBook(object):
+    '''Precomputed trump choices and first leads for hands of eight cards, built by
+    modules.games.simulation.book. Hands are stored up to permutations of the colours
+    (of the colours that aren't trump for the leads), so a lookup is one dictionary access.
+
+    The file has a header with the amount of entries, then the keys of the trump entries as
+    unsigned 32 bit integers and their trumps as bytes, then the same for the leads.'''
+    def __init__(self):
+        self.trumps = {} # trump_key -> position of the trump in the order of the key
+        self.leads = {} # lead_key -> position of the colour in the order of the key * 8 + value
+
+    def __len__(self):
+        return len(self.trumps) + len(self.leads)
+
+    def trump(self, mask):
+        '''Returns the trump to choose with the hand in mask, or None if it isn't in the book'''
+        key, order = trump_key(mask)
+        pos = self.trumps.get(key)
+        if pos is None: return None
+        return order[pos]
+
+    def lead(self, mask, trump):
+        '''Returns the index of the card to lead the first round with, or None'''
+        key, order = lead_key(mask, trump)
+        card = self.leads.get(key)
+        if card is None: return None
+        return order[card >> 3]*8 + (card & 7)
+
+    def add_trump(self, mask, trump):
+        key, order = trump_key(mask)
+        self.trumps[key] = order.index(trump)
+
+    def add_lead(self, mask, trump, index):
+        key, order = lead_key(mask, trump)
+        self.leads[key] = order.index(index >> 3)*8 + (index & 7)
+
+    def save(self, path=BOOK_PATH):
+        with open(path, "wb") as f:
+            f.write(MAGIC + struct.pack("<BII", VERSION, len(self.trumps), len(self.leads)))
+            for table in (self.trumps, self.leads):
+                keys = sorted(table)
+                f.write(array.array("I", keys).tobytes())
+                f.write(bytes(table[k] for k in keys))
+
+    @classmethod
+    def load(cls, path=BOOK_PATH):
+        book = cls()
+        with open(path, "rb") as f:
+            data = f.read()
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not an opening book".format(path))
+        pos = len(MAGIC)
+        version, ntrumps, nleads = struct.unpack_from("<BII", data, pos)
+        if version != VERSION:
+            raise ValueError("Opening book version {:d} is not supported".format(version))
+        pos += struct.calcsize("<BII")
+        for table, n in ((book.trumps, ntrumps), (book.leads, nleads)):
+            keys = array.array("I")
+            keys.frombytes(data[pos:pos+4*n])
+            pos += 4*n
+            table.update(zip(keys, data[pos:pos+n]))
+            pos += n
+        return book
+
+_book = None
+
+def get_book():
+    '''Returns the opening book at BOOK_PATH, loaded on first use. When there is no book
+    it is empty, so every lookup falls back to the AI itself.'''
+    global _book
+    if _book is None:
+        _book = OpeningBook.load() if os.path.exists(BOOK_PATH) else OpeningBook()
+    return _book
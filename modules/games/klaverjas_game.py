@@ -2,12 +2,10 @@ import json
 import random
 import string
 from collections import OrderedDict
-import threading
 import time
 
-import telepot
 
-from .base import BaseGame, BaseDispatcher
+from .base import BaseGame, BaseDispatcher, game_classes, when_sent
 from .cards import *
 from .klaverjas_ai import BasePlayer, AI
 
@@ -15,6 +13,12 @@ KLAVERJASSEN = 100
 KLAVERJASSEN_DISPATCH = 101
 KLAVERJASSEN_CHALLENGE = 102
 
+AI_MOVE_TIME = 0.75 # Seconds an AI move takes, the AI can spend them thinking
+ROUND_TIME = 1.25 # Seconds between the end of a round and the next one
+END_TIME = 2.0 # Seconds between the end of the game and calling its final callback
+
+STATE_VERSION = 1 # Version of the format a Klaverjas game is saved in
+
 klaverjas_names = ["Ingrid", "Klaas", "Bert", "Fatima", "Piet", "Joop", "Els", "Sjaan", "Achmed", "Bob", "Bep", "Kim",
                    "Rico", "Benny", "Serena", "Amalia", "D'Shawn", "Jezus", "Sterre", "D'Nise", "Aagje", "Edith", "Renate",
                    "Ling", "Yusuf"]
@@ -24,9 +28,17 @@ klaverjas_names = ["Ingrid", "Klaas", "Bert", "Fatima", "Piet", "Joop", "Els", "
 def dummy_printer(s): pass
 
 class Klaverjas(BaseGame):
+    '''A game of klaverjas. It is saved as its state at the start (the seed, the players and
+    who starts) and the list of moves done since then, see save_move. Only the new moves are
+    written to the database, and loading a game does all its moves again.'''
     game_type = KLAVERJASSEN
-    def __init__(self, bot, game_id, players, date, cmd, startingplayer=0, should_initialize=True):
+    keyboard_callbacks = {"trump": "_trump_set", "card": "_card_picked", "glory": "_accept_glory"}
+    share_decisions = False # Whether the AI's use the searches done in other games, see decisions.DecisionCache
+    def __init__(self, bot, game_id, players, date, cmd, startingplayer=0, should_initialize=True, parent_id=None):
         super().__init__(bot, game_id, players, date, cmd)
+        self.parent_id = parent_id
+        self.moves = []
+        self.saved_state = None
         self.real_players = []
         for user_id,user_name in players:
             p = RealPlayer(self, user_id,user_name, len(self.real_players))
@@ -38,7 +50,7 @@ class Klaverjas(BaseGame):
             self.players.append(p)
 
         self.startingplayer = startingplayer
-        self.callbacks_disposed = []
+        self.firstplayer = startingplayer
 
         if should_initialize: 
             self.initialize()
@@ -51,18 +63,21 @@ class Klaverjas(BaseGame):
         except KeyError: pass
         return state
         
-    def give_cards(self):
+    def give_cards(self, seed=None):
         self.deck = create_deck()
-        if self.cmd: self.seed = self.cmd
+        if seed: self.seed = seed
+        elif self.cmd: self.seed = self.cmd
         else:
             self.seed = ''.join(random.choice(string.ascii_lowercase) for _ in range(10))
         r = random.Random()
         r.seed(self.seed)
         r.shuffle(self.deck)
         for i in range(4):
+            self.players[i].seed("{}:{:d}".format(self.seed, i))
             self.players[i].give_cards(Cards([self.deck[i*8+j] for j in range(8)]))
 
-    def initialize(self):
+    def deal(self, seed=None):
+        '''Sets up the game and gives the cards'''
         self.round = 1
         self.cards_this_round = Cards()
         self.cards_previous_round = Cards()
@@ -70,6 +85,7 @@ class Klaverjas(BaseGame):
         self.glory_lists = []
         self.glory = -1
         self.glory_previous_round = -1
+        self.ending = False
         self.currentplayer = self.startingplayer
         self.status_messages = []
         self.endroundtext = ""
@@ -89,7 +105,11 @@ class Klaverjas(BaseGame):
         self.pointsglory1 = 0
         self.pointsglory2 = 0
 
-        self.give_cards()
+        self.give_cards(seed)
+
+    def initialize(self):
+        self.deal()
+        self.save_game_state()
         if self.startingplayer in (0,2):
             msg = "Team 1: {}, {}\n".format(self.p1.name, self.p3.name)
             msg += "Team 2: {}, {}\n".format(self.p2.name, self.p4.name)
@@ -104,27 +124,28 @@ class Klaverjas(BaseGame):
             #self.players[0].pick_trump()
             return
         self.trump = self.players[self.startingplayer].pick_trump()
+        self.save_move(["t", self.trump])
         [self.players[i].set_trump(self.trump) for i in range(4)]
         self.progress_game()
 
 
     def _trump_set(self,ident, button_id, user):
-        if ident in self.callbacks_disposed: return
-        self.callbacks_disposed.append(ident)
+        if not self.dispose_callback(ident): return
         self.trump = button_id
+        self.save_move(["t", self.trump])
         [self.players[i].set_trump(self.trump) for i in range(4)]
         self.disable_keyboard(ident)
         self.progress_game()
         return "Troef gekozen"
     def message_pick_trump(self, player):
         msg = player.hand_string() + "\nKies troef"
-        self.send_keyboard_message(player.user_id, msg, ["  {}  ".format(suit_to_unicode[i]) for i in range(4)], self._trump_set)
-        self.save_game_state()
+        self.send_keyboard_message(player.user_id, msg, ["  {}  ".format(suit_to_unicode[i]) for i in range(4)], self._trump_set,
+                                   lambda ident: self.save_move(["k", "trump", ident]))
     
 
     def _card_picked(self,ident, button_id, user):
-        if ident in self.callbacks_disposed: return
-        self.callbacks_disposed.append(ident)
+        if not self.dispose_callback(ident): return
+        self.save_move(["c", self.playable_cards[button_id].index])
         self.cards_this_round.append(self.playable_cards[button_id])
         p = self.players[self.currentplayer]
         p.cards.remove(self.playable_cards[button_id])
@@ -132,21 +153,23 @@ class Klaverjas(BaseGame):
             p.send_hand_message()
         self.disable_keyboard(ident)
         self.currentplayer = (self.currentplayer+1)%4
-        if self.currentplayer == self.startingplayer:
-            self.process_round(progress_game=True)
-        else: self.progress_game()
+        self.progress_game()
         return "Kaart gekozen"
 
-    def message_play_card(self, player):
+    def set_playable_cards(self, player):
+        '''Sets the cards player can choose from, in the order of the buttons'''
         legal = Cards(player.legal_cards(self.cards_this_round))
         self.playable_cards = legal.get_trumps().sorted(reverse=True)
         suits = list(range(4))
         suits.remove(self.trump)
         for col in suits:
             self.playable_cards.extend(legal.filter_color(col).sorted(reverse=True))
+
+    def message_play_card(self, player):
+        self.set_playable_cards(player)
         buttons = [card.pretty() for card in self.playable_cards]
-        self.send_keyboard_message(player.user_id, "Kies een kaart", buttons, self._card_picked)
-        self.save_game_state()
+        self.send_keyboard_message(player.user_id, "Kies een kaart", buttons, self._card_picked,
+                                   lambda ident: self.save_move(["k", "card", ident]))
 
     def update_status_message(self):
         if self.cards_previous_round:
@@ -197,7 +220,8 @@ class Klaverjas(BaseGame):
             if self.glory == -1: msg += " "
 
         if not self.status_messages:
-            self.status_messages = self.send_user_message(msg, parse_mode="Markdown")
+            self.status_messages = self.send_user_message(msg, parse_mode="Markdown") #edited before they are sent, if need be
+            when_sent(self.status_messages, self.status_sent)
             #for p in self.real_players:
                 #sent = self.bot.telebot.sendMessage(p.user_id, msg, parse_mode="Markdown")
                 #ident = telepot.message_identifier(sent)
@@ -212,41 +236,42 @@ class Klaverjas(BaseGame):
                 #     pass
 
 
+    def status_sent(self, idents):
+        self.status_messages = idents
+        if idents: self.save_move(["s", idents]) #a game of only AI's has nobody to send them to
+
     def _accept_glory(self,ident, button_id, user):
-        if ident in self.callbacks_disposed: return
-        self.callbacks_disposed.append(ident)
+        if not self.dispose_callback(ident): return
         if button_id == 1:
             self.glory = 0
         else:
             self.glory = glory_calculation(self.cards_this_round, self.trump)
+        self.save_move(["g", self.glory])
         self.disable_keyboard(ident)
-        self.process_round(progress_game=True)
+        self.progress_game()
 
     def message_accept_glory(self, player, glory_amount):
         buttons = ["ja", "nee"]
-        self.send_keyboard_message(player.user_id, "{!s} roem. Kloppen?".format(glory_amount), buttons, self._accept_glory)
-        self.save_game_state()
-
-    def process_round(self, progress_game=False):
+        self.send_keyboard_message(player.user_id, "{!s} roem. Kloppen?".format(glory_amount), buttons, self._accept_glory,
+                                   lambda ident: self.save_move(["k", "glory", ident]))
+
+    def decide_glory(self):
+        '''Decides the glory of the finished round, unless its winner is a user who has to
+        accept it. Returns the glory that has to be accepted, or 0.'''
+        if self.glory != -1: return 0
+        glory = glory_calculation(self.cards_this_round, self.trump)
+        winner = highest_card(self.cards_this_round, self.trump).owner
+        if glory == 0 or not isinstance(self.players[winner], RealPlayer):
+            self.glory = glory
+            return 0
+        return glory
+
+    def score_round(self):
+        '''Adds the points of the finished round, whose glory has been decided, and goes on
+        to the next round. Returns whether it was the last round.'''
         cards = self.cards_this_round
-        h = highest_card(cards,self.trump)
-        winner = h.owner 
+        winner = highest_card(cards,self.trump).owner
         points = card_points(cards, self.trump)
-        
-        msg = "{} heeft gewonnen met een {}".format(self.players[winner].name, h.pretty())
-        self.endroundtext = msg
-
-        if self.glory == -1:
-            glory = glory_calculation(cards, self.trump)
-            if glory == 0 or not isinstance(self.players[winner], RealPlayer):
-                self.glory = glory
-            else:
-                self.update_status_message()
-                self.message_accept_glory(self.players[winner], glory)
-                return
-        if self.glory>0:
-            msg += "\nRoem! {!s} punten\n".format(self.glory)
-        
         if self.players[winner].is_playing:
             self.points1 += points + self.glory
             self.pointsglory1 += self.glory
@@ -258,9 +283,6 @@ class Klaverjas(BaseGame):
         for p in self.players:
             p.show_trick(cards, self.round)
 
-        self.endroundtext = msg
-        self.update_status_message()
-
         self.startingplayer = winner
         self.currentplayer = winner
         self.round_lists.append(self.cards_this_round)
@@ -270,7 +292,6 @@ class Klaverjas(BaseGame):
         self.glory_previous_round = self.glory
         self.glory = -1
 
-
         if self.round == 8: #end of game
             if self.points1 == 0: 
                 self.points2 += 100
@@ -278,48 +299,162 @@ class Klaverjas(BaseGame):
             if self.points2 == 0: 
                 self.points1 += 100
                 self.pointsglory1 += 100
+            return True
+        self.round += 1
+        return False
 
+    def process_round(self):
+        '''Scores the finished round. Returns after how many seconds the game should go on,
+        or None if we need to wait for the winner to accept the glory.'''
+        h = highest_card(self.cards_this_round,self.trump)
+        msg = "{} heeft gewonnen met een {}".format(self.players[h.owner].name, h.pretty())
+        self.endroundtext = msg
+
+        glory = self.decide_glory()
+        if glory:
+            self.update_status_message()
+            self.message_accept_glory(self.players[h.owner], glory)
+            return None
+        if self.glory>0:
+            msg += "\nRoem! {!s} punten\n".format(self.glory)
+        self.endroundtext = msg
+        self.update_status_message()
+
+        if self.score_round():
             msg = self.game_end_message()
             self.send_user_message(msg, parse_mode="Markdown")
-            time.sleep(2.0)
             #for i in self.player_names: self.bot.telebot.sendMessage(i, msg, parse_mode="Markdown")
+            self.ending = True
+            return END_TIME
+        return ROUND_TIME
+        
+    def progress_step(self):
+        '''Does the next step of the game: an AI playing a card, scoring a finished round or
+        ending the game. Returns after how many seconds the next step should be done, or None
+        when we have to wait for user input or the game has ended.'''
+        if getattr(self, "ending", False):
+            self.ending = False
             self.game_ended()
             self.save_game_state()
             self.save_game_result()
-            return
-        
-        self.round += 1
-
-        if progress_game:
-            time.sleep(1.25)
-            self.progress_game()
-        
-    def _progress_game_thread(self):
-        '''When the cards have been dealt and trump has been chosen, tries to progress the game
-        until it hits a point where user input is required.'''
-        while self.round<=8:
-            if isinstance(self.players[self.currentplayer],RealPlayer):
-                self.update_status_message()
-                self.message_play_card(self.players[self.currentplayer])
-                return
+            return None
+        if not self.is_active or self.round > 8: return None
+        self.update_status_message()
+        if len(self.cards_this_round) == 4:
+            return self.process_round()
+        if isinstance(self.players[self.currentplayer],RealPlayer):
+            self.message_play_card(self.players[self.currentplayer])
+            return None
+        t = time.time()
+        player = self.players[self.currentplayer]
+        player.seed("{}:{:d}:{:d}".format(self.seed, player.index, self.round)) #a restored game doesn't have the random state, so don't depend on it
+        if self.share_decisions and hasattr(self, "moves"):
+            key = (self.seed, self.firstplayer, player.index, self.public_moves())
+            card = player.play_card(self.round, self.cards_this_round.copy(), AI_MOVE_TIME, self.bot.decisions, key)
+        else:
+            card = player.play_card(self.round, self.cards_this_round.copy(), budget=AI_MOVE_TIME)
+        self.save_move(["c", card.index, player.knowledge()])
+        self.cards_this_round.append(card)
+        self.currentplayer = (self.currentplayer+1)%4
+        return AI_MOVE_TIME - (time.time() - t)
 
-            self.update_status_message()
-            t = time.time()
-            self.cards_this_round.append(self.players[self.currentplayer].play_card(self.round, self.cards_this_round.copy()))
-            delta = time.time() - t
-            if delta < 0.75:
-                time.sleep(0.75-delta)
-            self.currentplayer = (self.currentplayer+1)%4
-            if self.currentplayer == self.startingplayer:
-                self.update_status_message()
-                self.process_round(progress_game=True)
-                return
+    def public_moves(self):
+        '''The moves everyone has seen: the trump, the cards played and the glory accepted'''
+        return tuple(tuple(move[:2]) for move in self.moves if move[0] in ("t", "c", "g"))
 
     def progress_game(self):
         '''When the cards have been dealt and trump has been chosen, tries to progress the game
         until it hits a point where user input is required.'''
-        t = threading.Thread(target=self._progress_game_thread)
-        t.start()
+        self.bot.gamescheduler.schedule(self)
+
+    def game_state(self):
+        '''The state the game is saved as, everything else follows from its moves'''
+        return {
+            "version": STATE_VERSION,
+            "seed": self.seed,
+            "cmd": self.cmd,
+            "firstplayer": self.firstplayer,
+            "players": [(p.user_id, p.name) for p in self.real_players],
+            "names": [p.name for p in self.players],
+            "parent": self.parent_id,
+        }
+
+    def save_game_state(self):
+        '''Saves the state of the game when it changed. The moves are saved by save_move.'''
+        if not hasattr(self, "moves"): #loaded from a pickle, keep saving it like that
+            return super().save_game_state()
+        if not hasattr(self, "seed"): return #the cards haven't been dealt yet
+        state = json.dumps(self.game_state())
+        if self.saved_state == (state, self.is_active): return
+        self.saved_state = (state, self.is_active)
+        with self._lock:
+            self.bot.dataManager.add_game(self.game_type, self.game_id, state, self.date, self.is_active, STATE_VERSION)
+
+    def save_move(self, move):
+        '''Adds a move to the game and appends it to the saved ones. A move is a list with
+        its kind and arguments:
+        ["t", trump] trump was chosen
+        ["c", index] the current player played the card with this index, for an AI followed
+                     by what it concluded while choosing it, see BasePlayer.knowledge
+        ["g", glory] the winner of the round accepted glory, or not when it is 0
+        ["k", kind, ident] a keyboard to choose a trump, card or glory was sent
+        ["s", idents] the status messages were sent
+        ["h", index, ident] the hand of the player with this index was sent'''
+        if not hasattr(self, "moves"): return self.save_game_state()
+        with self._lock: #the identifiers of sent messages are saved from the thread of the outbox
+            self.moves.append(move)
+            self.bot.dataManager.add_game_move(self.game_id, len(self.moves)-1, json.dumps(move))
+
+    @classmethod
+    def from_state(cls, bot, game_id, date, is_active, state, moves):
+        '''Recreates a saved game by dealing the same cards and doing its moves again'''
+        game = cls(bot, game_id, [tuple(p) for p in state["players"]], date, state["cmd"],
+                   state["firstplayer"], should_initialize=False, parent_id=state.get("parent"))
+        for p, name in zip(game.players, state["names"]): p.name = name
+        game.deal(state["seed"])
+        game.is_active = bool(is_active)
+        game.replay(moves)
+        game.moves = moves
+        game.saved_state = (json.dumps(game.game_state()), game.is_active)
+        return game
+
+    def replay(self, moves):
+        '''Does the moves again without sending any messages'''
+        keyboard = None #the keyboard the next move of a user is chosen with
+        for move in moves:
+            kind = move[0]
+            if kind == "s":
+                self.status_messages = [tuple(ident) for ident in move[1]]
+            elif kind == "h":
+                self.players[move[1]].hand_message_id = tuple(move[2])
+            elif kind == "k":
+                keyboard = tuple(move[2])
+                if move[1] == "card": self.set_playable_cards(self.players[self.currentplayer])
+                self.add_callback(keyboard, getattr(self, self.keyboard_callbacks[move[1]]))
+            else:
+                if keyboard:
+                    self.dispose_callback(keyboard)
+                    keyboard = None
+                if kind == "t":
+                    self.trump = move[1]
+                    for p in self.players:
+                        if isinstance(p, RealPlayer): BasePlayer.set_trump(p, self.trump) #without sending the hand
+                        else: p.set_trump(self.trump)
+                elif kind == "c":
+                    p = self.players[self.currentplayer]
+                    card = [c for c in p.cards if c.index == move[1]][0]
+                    if isinstance(p, RealPlayer): p.cards.remove(card)
+                    else:
+                        p.play_this_card(card)
+                        if len(move) > 2: p.set_knowledge(move[2])
+                    self.cards_this_round.append(card)
+                    self.currentplayer = (self.currentplayer+1)%4
+                    if len(self.cards_this_round) == 4 and not self.decide_glory():
+                        self.score_round()
+                elif kind == "g":
+                    self.glory = move[1]
+                    self.score_round()
+        if self.is_active and len(self.round_lists) == 8: self.ending = True
     
     def game_end_message(self):
         msg  = "Klaverjas potje met seed {}\n".format(self.seed)
@@ -431,24 +566,24 @@ class KlaverjasDispatcher(BaseDispatcher):
                 return "Alleen {} kan dit potje beginnen".format(self.sender_name)
             index = self.bot.dataManager.get_unique_game_id()
             self.started = True
-            g = Klaverjas(self.bot,index,self.players,self.date, self.cmd)
+            g = Klaverjas(self.bot,index,self.players,self.date, self.cmd, parent_id=self.game_id)
             g.final_callback = self.game_end
             self.bot.games[index] = g
             self.game_index = index
-            editor = telepot.helper.Editor(self.bot.telebot, self.ident)
-            editor.editMessageReplyMarkup()
+            self.remove_keyboard(self.ident)
             return "Spel gestart"
 
     def update_message(self):
         msg = self.welcome +"\n" +"\n".join("* "+n for i,n in self.players)
-        editor = telepot.helper.Editor(self.bot.telebot, self.ident)
-        editor.editMessageText(msg, reply_markup=self.get_keyboard(self.buttons,index=0))
+        self.edit_message_text(self.ident, msg, reply_markup=self.get_keyboard(self.buttons,index=0))
         self.save_game_state()
 
+    def attach(self, game):
+        if game.game_id == self.game_index: game.final_callback = self.game_end
+
     def game_end(self, g):
         msg = g.game_end_message()
-        editor = telepot.helper.Editor(self.bot.telebot, self.ident)
-        editor.editMessageText(msg,parse_mode="Markdown")
+        self.edit_message_text(self.ident, msg, parse_mode="Markdown")
 
 
 class KlaverjasChallenge(BaseDispatcher):
@@ -483,10 +618,11 @@ class KlaverjasChallenge(BaseDispatcher):
             self.gamestrings[pid] = ""
         n = self.games_finished[pid]
         if pid != 1:
-            g = Klaverjas(self.bot,index,[(pid,name)], self.date, self.seeds[n], startingplayer=n%4, should_initialize=False)
+            g = Klaverjas(self.bot,index,[(pid,name)], self.date, self.seeds[n], startingplayer=n%4, should_initialize=False, parent_id=self.game_id)
         else:
-            g = Klaverjas(self.bot,index,[], self.date, self.seeds[n], startingplayer=n%4, should_initialize=False)
+            g = Klaverjas(self.bot,index,[], self.date, self.seeds[n], startingplayer=n%4, should_initialize=False, parent_id=self.game_id)
         for i,p in enumerate(g.players[1:]): p.name = self.ai_names[i]
+        g.share_decisions = True
         g.initialize()
         self.bot.games[index] = g
         g.final_callback = self.game_end
@@ -495,18 +631,25 @@ class KlaverjasChallenge(BaseDispatcher):
 
     def __getstate__(self):
         state = super().__getstate__()
-        if self.games and not isinstance(list(self.games.keys())[0],int):
-            state['games'] = {pid: g.game_id for pid,g in self.games.items()}
+        if any(isinstance(g, Klaverjas) for g in self.games.values()):
+            state['games'] = {pid: g.game_id if isinstance(g, Klaverjas) else g for pid,g in self.games.items()}
         state['loaded'] = False
         return state
 
+    def attach(self, game):
+        for pid, g in self.games.items():
+            if g == game.game_id or getattr(g, "game_id", None) == game.game_id:
+                game.final_callback = self.game_end
+                game.share_decisions = True
+                self.games[pid] = game
+
+    def child_ids(self):
+        return [getattr(g, "game_id", g) for g in self.games.values()]
+
     def load(self):
-        for pid in self.games:
+        for pid in list(self.games):
             if isinstance(self.games[pid], Klaverjas): continue
-            g = self.bot.dataManager.load_game(self.games[pid])
-            g.setstate(self.bot)
-            g.final_callback = self.game_end
-            self.games[pid] = g
+            self.attach(self.bot.games[self.games[pid]])
         self.loaded = True
 
     def callback(self, ident, button_id, s):
@@ -565,8 +708,7 @@ class KlaverjasChallenge(BaseDispatcher):
                     else: msg += self.player_stats(sender_id) + "\n"
                 else:
                     msg += "{}: Klaar (score verborgen)\n".format(name)
-        editor = telepot.helper.Editor(self.bot.telebot, self.ident)
-        editor.editMessageText(msg, reply_markup=self.get_keyboard(self.buttons,index=0))
+        self.edit_message_text(self.ident, msg, reply_markup=self.get_keyboard(self.buttons,index=0))
         self.save_game_state()
 
     def game_end(self, g):
@@ -629,12 +771,17 @@ class RealPlayer(BasePlayer):
     def send_hand_message(self):
         msg = "Troef is " + suit_to_unicode[self.trump] + "\n" + self.hand_string()
         if not self.hand_message_id:
-            sent = self.game.bot.telebot.sendMessage(self.user_id, msg)
-            self.hand_message_id = telepot.message_identifier(sent)
+            self.hand_message_id = self.game.send_user_message(msg, self.user_id) #edited before it is sent, if need be
+            when_sent(self.hand_message_id, self.hand_sent)
         else:
-            editor = telepot.helper.Editor(self.game.bot.telebot, self.hand_message_id)
-            editor.editMessageText(msg)
+            self.game.edit_message_text(self.hand_message_id, msg)
+
+    def hand_sent(self, ident):
+        self.hand_message_id = ident
+        if ident: self.game.save_move(["h", self.index, ident])
     
     def set_trump(self, trump):
         super().set_trump(trump)
         self.send_hand_message()
+
+game_classes[KLAVERJASSEN] = Klaverjas
@@ -0,0 +1,101 @@
+import itertools
+import math
+import time
+
+class DealSampler(object):
+    '''Samples the hidden hands of the three other players from all deals that are
+    consistent with what we know about them, without ever rejecting a deal.
+
+    possible is a list with for each of the three players the bitmask of the cards that
+    player might have, and counts how many cards each of them has. The cards are grouped
+    by which players might have them. Then count is the exact number of consistent deals,
+    and deals are sampled uniformly by splitting every group over the players.'''
+    def __init__(self, possible, counts):
+        self.counts = tuple(counts)
+        groups = {}
+        for i in range(32):
+            owners = tuple(p for p in range(3) if possible[p] >> i & 1)
+            if owners: groups.setdefault(owners, []).append(i)
+        self.groups = sorted(groups.items())
+        self.ways = {} # (group number, cards still needed) -> number of deals
+        self.count = self.number_of_deals(0, self.counts)
+
+    def splits(self, k, needed):
+        '''Yields the ways to divide group k over the players, with how many deals each gives'''
+        owners, cards = self.groups[k]
+        n = len(cards)
+        for x0 in (range(min(n, needed[0])+1) if 0 in owners else (0,)):
+            for x1 in (range(min(n-x0, needed[1])+1) if 1 in owners else (0,)):
+                x2 = n - x0 - x1
+                if x2 > needed[2] or (x2 and 2 not in owners): continue
+                rest = (needed[0]-x0, needed[1]-x1, needed[2]-x2)
+                ways = self.number_of_deals(k+1, rest)
+                if ways:
+                    yield (x0, x1, x2), rest, ways*math.factorial(n)//(
+                        math.factorial(x0)*math.factorial(x1)*math.factorial(x2))
+
+    def number_of_deals(self, k, needed):
+        '''Number of ways to give the cards of groups k and later to players needing that many cards'''
+        if k == len(self.groups):
+            return 1 if needed == (0, 0, 0) else 0
+        key = (k, needed)
+        if key not in self.ways:
+            self.ways[key] = sum(ways for split, rest, ways in self.splits(k, needed))
+        return self.ways[key]
+
+    def sample(self, rng):
+        '''Returns a uniformly random consistent deal as a tuple of three bitmasks'''
+        if not self.count:
+            raise ValueError("No deal is consistent with the constraints")
+        hands = [0, 0, 0]
+        needed = self.counts
+        for k, (owners, cards) in enumerate(self.groups):
+            r = rng.randrange(self.number_of_deals(k, needed))
+            for split, rest, ways in self.splits(k, needed):
+                if r < ways: break
+                r -= ways
+            cards = list(cards)
+            rng.shuffle(cards)
+            pos = 0
+            for p in range(3):
+                for i in cards[pos:pos+split[p]]:
+                    hands[p] |= 1 << i
+                pos += split[p]
+            needed = rest
+        return tuple(hands)
+
+    def all_deals(self, k=0, needed=None, hands=(0, 0, 0)):
+        '''Yields every consistent deal as a tuple of three bitmasks'''
+        if needed is None: needed = self.counts
+        if k == len(self.groups):
+            yield hands
+            return
+        cards = self.groups[k][1]
+        for split, rest, ways in self.splits(k, needed):
+            for c0 in itertools.combinations(cards, split[0]):
+                left = [i for i in cards if i not in c0]
+                for c1 in itertools.combinations(left, split[1]):
+                    h = list(hands)
+                    for i in c0: h[0] |= 1 << i
+                    for i in c1: h[1] |= 1 << i
+                    for i in left:
+                        if i not in c1: h[2] |= 1 << i
+                    for deal in self.all_deals(k+1, rest, tuple(h)):
+                        yield deal
+
+    def deals(self, rng, samples=None, timeout=None):
+        '''Returns a list of deals within a budget of at most samples deals and/or timeout
+        seconds. When all the consistent deals fit in the budget, all of them are returned
+        exactly once, otherwise they are sampled uniformly with rng. At least one deal is
+        returned if there is any.'''
+        if not self.count: return []
+        if samples is not None and self.count <= samples:
+            return list(self.all_deals())
+        deals = []
+        end = time.time() + timeout if timeout is not None else None
+        while True:
+            deals.append(self.sample(rng))
+            if samples is not None and len(deals) >= samples: break
+            if end is not None and time.time() >= end: break
+            if samples is None and end is None: break
+        return deals
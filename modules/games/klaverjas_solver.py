@@ -0,0 +1,237 @@
+import atexit
+import multiprocessing
+
+if __package__ is None or __package__ == '':
+    from cards import *
+else:
+    from .cards import *
+
+# Kinds of values stored in the transposition table
+EXACT = 0
+LOWER = 1 # the real value is at least the stored value
+UPPER = 2 # the real value is at most the stored value
+
+MAXSCORE = 1000
+
+class Solver(object):
+    '''Double dummy solver for the end of a game: with all the hands known it finds the
+    score every player can force. The value of a position is points1 - points2 at the end
+    of the game, which the attacking team maximizes and the defending team minimizes.
+
+    Cards are handled as indices and hands as bitmasks. Moves are applied in place with
+    play and taken back with undo, positions that were already solved are looked up in a
+    transposition table keyed on (hands, current player, round so far, points).
+    The trick are the indices of the cards already played this round.'''
+    def __init__(self, hands, trump, playing, points1, points2, currentplayer, round, trick):
+        self.hands = list(hands) # bitmask of the cards of every player
+        self.trump = trump
+        self.playing = playing # for every player whether it is on the attacking team
+        self.points1 = points1
+        self.points2 = points2
+        self.currentplayer = currentplayer
+        self.round = round
+        self.history = [] # information needed to undo the moves played
+        self.table = {} # transposition table
+        self.nodes = 0
+        self.strength = []
+        self.card_value = []
+        for i in range(32):
+            color, value = divmod(i, 8)
+            if color == trump:
+                self.strength.append(8 + trump_rank[value])
+                self.card_value.append(point_valueT[value])
+            else:
+                self.strength.append(normal_rank[value])
+                self.card_value.append(point_value[value])
+        # The round so far, and incrementally updated information about it
+        self.trick = []
+        self.color = None # the asked colour
+        self.best = None # the index of the card that is winning this round
+        self.winner = None # the player that played that card
+        self.trumped = False # whether a trump has been played this round
+        p = (currentplayer - len(trick)) % 4
+        for index in trick:
+            self.add_to_trick(index, p)
+            p = (p + 1) % 4
+
+    def add_to_trick(self, index, player):
+        color = index >> 3
+        self.trick.append(index)
+        if len(self.trick) == 1:
+            self.color = color
+            self.best = index
+            self.winner = player
+            self.trumped = (color == self.trump)
+            return
+        if color == self.trump:
+            self.trumped = True
+        elif color != self.color:
+            return
+        if self.strength[index] > self.strength[self.best]:
+            self.best = index
+            self.winner = player
+
+    def legal_moves(self):
+        '''Returns the bitmask of the cards the current player may play'''
+        hand = self.hands[self.currentplayer]
+        if not self.trick: return hand
+        winning = (self.winner == (self.currentplayer + 2) % 4)
+        return legal_mask(hand, self.color, self.best, winning, self.trumped, self.trump)
+
+    def ordered_moves(self, legal, first=None):
+        '''Returns the indices of the cards in legal, the most promising ones first'''
+        moves = []
+        while legal:
+            bit = legal & -legal
+            moves.append(bit.bit_length() - 1)
+            legal ^= bit
+        if len(moves) == 1: return moves
+        strength = self.strength
+        card_value = self.card_value
+        if not self.trick: #we start the round, try high cards first
+            moves.sort(key=lambda i: -(strength[i] % 8)) # the highest card of every colour first
+        else:
+            beat = higher_mask(self.best, self.trump)
+            if self.winner == (self.currentplayer + 2) % 4: #our mate is winning, give him points
+                moves.sort(key=lambda i: (beat >> i & 1, -card_value[i]))
+            else: #first the cards that win the round, highest first, then the rest lowest first
+                moves.sort(key=lambda i: -strength[i] if beat >> i & 1 else 100 + card_value[i])
+        if first is not None and first in moves:
+            moves.remove(first)
+            moves.insert(0, first)
+        return moves
+
+    def play(self, index):
+        '''Plays the card with this index for the current player'''
+        p = self.currentplayer
+        self.hands[p] &= ~(1 << index)
+        self.history.append((p, self.color, self.best, self.winner, self.trumped, self.points1, self.points2))
+        self.add_to_trick(index, p)
+        if len(self.trick) != 4:
+            self.currentplayer = (p + 1) % 4
+            return
+        winner = self.winner
+        mask = 0
+        for c in self.trick: mask |= 1 << c
+        points = mask_points(mask, self.trump) + trick_glory(mask, self.trump)
+        if self.playing[winner]:
+            self.points1 += points
+            if self.round == 8: self.points1 += 10
+        else:
+            self.points2 += points
+            if self.round == 8: self.points2 += 10
+
+        if self.round == 8:
+            if self.points1 == 0:
+                self.points2 += 100
+            if self.points2 == 0:
+                self.points1 += 100
+            if self.points1 < self.points2: #Nat
+                self.points2 += self.points1
+                self.points1 = 0
+
+        self.history.append(self.trick)
+        self.currentplayer = winner
+        self.round += 1
+        self.trick = []
+
+    def undo(self):
+        '''Takes back the last card that was played'''
+        if not self.trick: #the last card finished a round
+            self.trick = self.history.pop()
+            self.round -= 1
+        p, self.color, self.best, self.winner, self.trumped, self.points1, self.points2 = self.history.pop()
+        self.currentplayer = p
+        self.hands[p] |= 1 << self.trick.pop()
+
+    def search(self, alpha=-MAXSCORE, beta=MAXSCORE):
+        '''Alpha-beta search of the current position. Returns its value if it lies
+        between alpha and beta, and otherwise a bound on the side of the window it is on.'''
+        if self.round > 8:
+            return self.points1 - self.points2
+        self.nodes += 1
+        legal = self.legal_moves()
+        if not legal & (legal - 1): #only one card to play
+            self.play(legal.bit_length() - 1)
+            value = self.search(alpha, beta)
+            self.undo()
+            return value
+
+        key = (self.hands[0], self.hands[1], self.hands[2], self.hands[3],
+               self.currentplayer, tuple(self.trick), self.points1, self.points2)
+        first = None
+        entry = self.table.get(key)
+        if entry:
+            value, kind, first = entry
+            if kind == EXACT: return value
+            if kind == LOWER and value > alpha: alpha = value
+            elif kind == UPPER and value < beta: beta = value
+            if alpha >= beta: return value
+
+        alpha0, beta0 = alpha, beta
+        maximize = self.playing[self.currentplayer]
+        best = -MAXSCORE if maximize else MAXSCORE
+        best_move = None
+        for c in self.ordered_moves(legal, first):
+            self.play(c)
+            value = self.search(alpha, beta)
+            self.undo()
+            if maximize:
+                if value > best:
+                    best, best_move = value, c
+                    if best > alpha: alpha = best
+            else:
+                if value < best:
+                    best, best_move = value, c
+                    if best < beta: beta = best
+            if alpha >= beta: break
+
+        if best <= alpha0: kind = UPPER
+        elif best >= beta0: kind = LOWER
+        else: kind = EXACT
+        self.table[key] = (best, kind, best_move)
+        return best
+
+    def evaluate(self, index):
+        '''Returns the value of the game when the current player plays the card with this index'''
+        self.play(index)
+        value = self.search()
+        self.undo()
+        return value
+
+
+_pools = {} # worker pools by their amount of processes
+
+def get_pool(processes):
+    '''Returns the pool of worker processes of this size, creating it on first use. The bot
+    has threads running, so the workers are started by a fork server or spawned instead of
+    forking the bot itself, which could copy a lock that another thread is holding.'''
+    if processes not in _pools:
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _pools[processes] = multiprocessing.get_context(method).Pool(processes)
+    return _pools[processes]
+
+@atexit.register
+def close_pools():
+    '''Stops the worker processes, they are started again when needed'''
+    while _pools:
+        _, pool = _pools.popitem()
+        pool.close()
+        pool.join()
+
+def solve(task):
+    '''Evaluates a (state, indices) pair, where state are the arguments of a Solver, for
+    every card index in indices. They share the transposition table of the deal.'''
+    state, indices = task
+    s = Solver(*state)
+    return [s.evaluate(i) for i in indices]
+
+def evaluate_states(states, indices, workers=0):
+    '''Returns for every state the list of values of playing each of the cards in indices.
+    If workers is more than 1, the states are spread over a pool of that many processes.
+    The results are the same and in the same order as when evaluated here.'''
+    tasks = [(state, indices) for state in states]
+    if workers <= 1 or len(states) < 2:
+        return [solve(task) for task in tasks]
+    chunksize = max(1, len(tasks)//(4*workers))
+    return get_pool(workers).map(solve, tasks, chunksize)
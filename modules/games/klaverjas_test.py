@@ -246,6 +246,8 @@ class Game(object):
         self.deck = create_deck()
         r.shuffle(self.deck)
         for i in range(4):
+            if hasattr(self.players[i], "seed"): #older AI's use the global random
+                self.players[i].seed("{}:{:d}".format(self.seed, i))
             self.players[i].give_cards(Cards([self.deck[i*8+j] for j in range(8)]))
 
     def initialize(self):
@@ -0,0 +1,173 @@
+import collections
+import concurrent.futures
+import itertools
+import threading
+import time
+import traceback
+
+import telepot
+
+class PendingMessage(concurrent.futures.Future):
+    '''The future of the identifier of a message that is queued to be sent. It can be used
+    as the identifier of that message in Outbox.edit and Outbox.call right away: those are
+    sent after it, as the messages to a chat are sent in order.'''
+    def __init__(self, chat_id):
+        super().__init__()
+        self.chat_id = chat_id
+
+def chat_of(ident):
+    '''Returns the chat of the message identifier ident'''
+    if isinstance(ident, PendingMessage): return ident.chat_id
+    return ident[0] if isinstance(ident, tuple) else ident
+
+class OutgoingMessage(object):
+    def __init__(self, chat_id, func, args, kwargs, ident=None, is_edit=False, convert=False):
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.ident = ident #the message that gets changed by this one
+        self.is_edit = is_edit #whether it only edits the text of ident, and can be merged
+        self.convert = convert #whether the result should be converted to a message identifier
+        self.future = PendingMessage(chat_id) if convert else concurrent.futures.Future()
+
+class Outbox(object):
+    '''Queue of the messages the games send to Telegram, sent by a worker thread so the
+    game logic never waits for the network. Repeated edits of the same message are merged
+    while they wait in the queue, so only the latest text gets sent.
+
+    The messages to a chat are sent in the order they were queued. A chat gets a burst of
+    messages at once and then one per chat_interval seconds, or group_interval for groups,
+    and over all chats at most one message is sent per global_interval seconds. When
+    Telegram still answers with "too many requests", the chat waits as long as it is told.'''
+    def __init__(self, bot, chat_interval=1.0, group_interval=3.0, burst=3, global_interval=1/30.):
+        self.bot = bot
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.burst = burst
+        self.global_interval = global_interval
+        self.queue = collections.OrderedDict() # number -> OutgoingMessage, in the order they are sent
+        self.edits = {} # ident -> number of the edit of that message that can still be merged
+        self.ready_at = {} # chat_id -> the time it is allowed to send its next message at
+        self.global_next = 0
+        self.numbers = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+        self.sent = 0
+        self.merged = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, message):
+        with self.condition:
+            self.queue[next(self.numbers)] = message
+            if message.ident is not None: self.edits.pop(message.ident, None)
+            self.condition.notify()
+        return message.future
+
+    def send(self, chat_id, text, **kwargs):
+        '''Queues sending text to chat_id. Returns a PendingMessage of the message identifier'''
+        return self.put(OutgoingMessage(chat_id, self.bot.telebot.sendMessage, (chat_id, text), kwargs, convert=True))
+
+    def edit(self, ident, text, **kwargs):
+        '''Queues editing the text of the message ident. If an edit of it is still queued,
+        that one gets the new text instead. Returns a future that is done when it is sent.'''
+        with self.condition:
+            n = self.edits.get(ident)
+            if n is not None:
+                message = self.queue[n]
+                message.args = (ident, text)
+                message.kwargs = kwargs
+                self.merged += 1
+                return message.future
+            n = next(self.numbers)
+            message = OutgoingMessage(chat_of(ident), self.bot.telebot.editMessageText, (ident, text), kwargs, ident, True)
+            self.queue[n] = message
+            self.edits[ident] = n
+            self.condition.notify()
+            return message.future
+
+    def call(self, chat_id, func, *args, ident=None, **kwargs):
+        '''Queues calling func(*args, **kwargs), for other things sent to chat_id. If it
+        changes the message ident, earlier edits of that message are no longer merged with
+        later ones.'''
+        return self.put(OutgoingMessage(chat_id, func, args, kwargs, ident))
+
+    def interval(self, chat_id):
+        if isinstance(chat_id, int) and chat_id < 0: return self.group_interval
+        return self.chat_interval
+
+    def next_message(self, now):
+        '''Returns the number of the first message that may be sent now, and otherwise
+        None and how long to wait'''
+        if not self.queue: return None, None
+        if now < self.global_next: return None, self.global_next - now
+        wait = None
+        for n, message in self.queue.items():
+            t = self.ready_at.get(message.chat_id, 0) - (self.burst-1)*self.interval(message.chat_id)
+            if t <= now: return n, 0
+            if wait is None or t - now < wait: wait = t - now
+        return None, wait
+
+    def take(self, n, now):
+        message = self.queue.pop(n)
+        if message.ident is not None and self.edits.get(message.ident) == n:
+            del self.edits[message.ident]
+        chat_id = message.chat_id
+        self.ready_at[chat_id] = max(self.ready_at.get(chat_id, 0), now) + self.interval(chat_id)
+        self.global_next = now + self.global_interval
+        return message
+
+    def retry(self, message, seconds):
+        '''Puts message back in front of the queue, and lets its chat wait for seconds'''
+        with self.condition:
+            self.ready_at[message.chat_id] = time.time() + seconds + (self.burst-1)*self.interval(message.chat_id)
+            if message.is_edit:
+                if message.ident in self.edits: #a newer edit is queued already
+                    message.future.set_result(None)
+                    return
+                n = next(self.numbers)
+                self.edits[message.ident] = n
+            else:
+                n = next(self.numbers)
+            self.queue[n] = message
+            self.queue.move_to_end(n, last=False)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.running: return
+                    now = time.time()
+                    n, wait = self.next_message(now)
+                    if n is not None: break
+                    if not self.queue: #forget the chats that are allowed to send again
+                        self.ready_at = {c: t for c, t in self.ready_at.items() if t > now}
+                    self.condition.wait(wait)
+                message = self.take(n, now)
+            try:
+                #the messages that are edited have been sent by now, as they were queued earlier
+                args = [a.result(timeout=0) if isinstance(a, PendingMessage) else a for a in message.args]
+                with self.bot.messagelock:
+                    result = message.func(*args, **message.kwargs)
+            except telepot.exception.TooManyRequestsError as e:
+                try: seconds = e.json["parameters"]["retry_after"]
+                except (KeyError, TypeError): seconds = 1
+                self.retry(message, seconds)
+                continue
+            except telepot.exception.TelegramError as e:
+                if message.is_edit: message.future.set_result(None) #probably not modified
+                else: message.future.set_exception(e)
+                continue
+            except Exception as e:
+                traceback.print_exc()
+                message.future.set_exception(e)
+                continue
+            self.sent += 1
+            if message.convert: result = telepot.message_identifier(result)
+            message.future.set_result(result)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
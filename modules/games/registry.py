@@ -0,0 +1,100 @@
+import collections
+import contextlib
+import threading
+
+from .base import restore_game
+
+class GameRegistry(object):
+    '''The games by their game_id, used like a dictionary. At the start only the ids and
+    types of the active games are read, a game is loaded from the database the first time
+    it is asked for. At most max_live games are kept in memory: when there are more, the
+    least recently used idle ones are saved and dropped, to be loaded again when needed.
+
+    A game is idle when the scheduler isn't progressing it, no callback of it is being
+    handled (see use) and none of the games started from it (see BaseGame.parent_id) are in
+    memory. When a game is loaded that was started
+    from another game, that game gets the new instance with its attach method.'''
+    def __init__(self, bot, max_live=100):
+        self.bot = bot
+        self.max_live = max_live
+        self.live = collections.OrderedDict() # game_id -> game, the least recently used first
+        self.index = {} # game_id -> game_type of the active games
+        self.in_use = collections.Counter() # game_id -> amount of threads using the game, see use
+        self.lock = threading.RLock()
+        for game_id, game_type in bot.dataManager.get_active_game_ids():
+            self.index[game_id] = game_type
+
+    def __getitem__(self, game_id):
+        with self.lock:
+            if game_id in self.live:
+                self.live.move_to_end(game_id)
+                return self.live[game_id]
+            return self.load(game_id)
+
+    def __setitem__(self, game_id, game):
+        with self.lock:
+            self.live[game_id] = game
+            self.live.move_to_end(game_id)
+            self.index[game_id] = game.game_type
+            self.evict()
+
+    def __contains__(self, game_id):
+        return game_id in self.live or game_id in self.index
+
+    def __len__(self):
+        return len(self.index.keys() | self.live.keys())
+
+    def get(self, game_id, default=None):
+        try: return self[game_id]
+        except KeyError: return default
+
+    def load(self, game_id):
+        '''Loads the game from the database and attaches it to the game it was started from'''
+        row = self.bot.dataManager.load_game(game_id)
+        if row is None: raise KeyError(game_id)
+        game = restore_game(self.bot, row)
+        self[game_id] = game
+        parent_id = getattr(game, "parent_id", None)
+        if parent_id is not None:
+            parent = self.get(parent_id)
+            if parent is not None: parent.attach(game)
+        return game
+
+    @contextlib.contextmanager
+    def use(self, game_id):
+        '''Gives the game like self[game_id] does, and doesn't drop it from memory until the
+        with block is done. Otherwise a thread could still be changing the game after it was
+        dropped, while a new instance is loaded from the database for the next callback.'''
+        with self.lock: self.in_use[game_id] += 1 #before loading, so it can't be dropped right away
+        try:
+            yield self[game_id]
+        finally:
+            with self.lock: self.release(game_id)
+
+    def release(self, game_id):
+        self.in_use[game_id] -= 1
+        if not self.in_use[game_id]: del self.in_use[game_id]
+
+    def is_idle(self, game):
+        if game.game_id in self.in_use: return False
+        if self.bot.gamescheduler.is_busy(game.game_id): return False
+        return not any(getattr(g, "parent_id", None) == game.game_id for g in self.live.values())
+
+    def open_ids(self):
+        '''Returns the ids of the games in memory, of the games they were started from and
+        of the games started from them. The maintenance of the database leaves those open.'''
+        with self.lock:
+            ids = set(self.live)
+            for game in self.live.values():
+                if getattr(game, "parent_id", None) is not None: ids.add(game.parent_id)
+                ids.update(game.child_ids())
+        return ids
+
+    def evict(self):
+        '''Saves and drops the least recently used idle games while there are too many'''
+        for game_id, game in list(self.live.items()):
+            if len(self.live) <= self.max_live: return
+            if not self.is_idle(game): continue
+            game.save_game_state()
+            del self.live[game_id]
+            if not game.is_active: self.index.pop(game_id, None)
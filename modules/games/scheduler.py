@@ -0,0 +1,58 @@
+import asyncio
+import concurrent.futures
+import threading
+import traceback
+
+class GameScheduler(object):
+    '''Progresses the games from a single event loop in a background thread, instead of
+    starting a thread per game. A game is progressed by calling its progress_step, which
+    does one step (like an AI playing a card) and returns after how many seconds the next
+    step should happen, or None when the game waits for a user or has ended. The waiting is
+    done with timers on the event loop. The steps themselves run in a pool of max_searches
+    threads, so at most that many AI's are thinking at the same time, however many games
+    are in progress.'''
+    def __init__(self, max_searches=4):
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_searches)
+        self.progressing = {} # game_id -> whether the game should be progressed again when it stops
+        self.scheduled = set() # game_ids that were scheduled and aren't in progressing yet
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def schedule(self, game):
+        '''Makes sure game gets progressed. Can be called from any thread.'''
+        with self.lock: self.scheduled.add(game.game_id)
+        self.loop.call_soon_threadsafe(self._schedule, game)
+
+    def _schedule(self, game):
+        if game.game_id in self.progressing: #already busy, go on when it stops
+            self.progressing[game.game_id] = True
+        else:
+            self.progressing[game.game_id] = False
+            self.loop.create_task(self._progress(game))
+        with self.lock: self.scheduled.discard(game.game_id)
+
+    async def _progress(self, game):
+        try:
+            while True:
+                try:
+                    delay = await self.loop.run_in_executor(self.executor, game.progress_step)
+                except Exception:
+                    traceback.print_exc()
+                    delay = None
+                if delay is None:
+                    if not self.progressing[game.game_id]: return
+                    self.progressing[game.game_id] = False
+                    continue
+                if delay > 0: await asyncio.sleep(delay)
+        finally:
+            del self.progressing[game.game_id]
+
+    def is_busy(self, game_id):
+        '''Whether the game is being progressed or waits for its next step'''
+        with self.lock: return game_id in self.scheduled or game_id in self.progressing
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.executor.shutdown(wait=False)
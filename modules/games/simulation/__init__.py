@@ -0,0 +1,2 @@
+from .game import SimulatedGame
+from .runner import run_match, play_game, load_ai, confidence_interval
@@ -0,0 +1,26 @@
+'''Plays klaverjas AI's against each other, for instance:
+cd modules/games
+python -m simulation klaverjas_ai klaverjas_ai2 -n 1000 -o results.jsonl
+
+It is run from modules/games so only the klaverjas engine is imported, not the bot modules
+and their dependencies.'''
+import argparse
+import multiprocessing
+
+from .runner import run_match, load_ai
+
+parser = argparse.ArgumentParser(description="Compare two klaverjas AI's by self-play")
+parser.add_argument("ai1", help="module of the first AI, like klaverjas_ai or klaverjas_ai2.AI")
+parser.add_argument("ai2", help="module of the second AI")
+parser.add_argument("-n", "--games", type=int, default=1000, help="amount of deals, each is played in both seat orders")
+parser.add_argument("-s", "--seed", type=int, default=500)
+parser.add_argument("-p", "--processes", type=int, default=multiprocessing.cpu_count())
+parser.add_argument("-o", "--output", help="file to stream the results to, .jsonl or .csv")
+args = parser.parse_args()
+
+summary = run_match(load_ai(args.ai1), load_ai(args.ai2), args.games, args.seed, args.processes, args.output)
+print("Games played: {} in {:.1f}s, {:.2f} games/s".format(summary["games"], summary["seconds"], summary["games_per_second"]))
+print("Points {} minus {} per game: {:.2f} +- {:.2f}".format(args.ai1, args.ai2, *summary["point_difference"]))
+print("Points {} minus {} per deal: {:.2f} +- {:.2f}".format(args.ai1, args.ai2, *summary["deal_point_difference"]))
+print("Nat when attacking: {} {:.1f}%, {} {:.1f}%".format(args.ai1, summary["nat_percentage"]["ai1"],
+                                                         args.ai2, summary["nat_percentage"]["ai2"]))
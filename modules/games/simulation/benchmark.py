@@ -0,0 +1,153 @@
+'''Benchmarks of the klaverjas engine and AI over a fixed set of seeded games, for instance:
+cd modules/games
+python -m simulation.benchmark --save baseline.json
+python -m simulation.benchmark --compare baseline.json
+
+The games are played first, timing every AI call by round. The positions and tricks seen in
+them are then replayed through the card functions to time those separately.'''
+import argparse
+import collections
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+if "." in __package__:
+    from ..cards import *
+    from ..klaverjas_ai import AI
+else: # run from modules/games as "python -m simulation", so the bot modules aren't imported
+    from cards import *
+    from klaverjas_ai import AI
+from .game import SimulatedGame
+
+_timings = collections.defaultdict(list) # (name, round) -> seconds of every call
+_positions = [] # (hand, played cards, trump, partner) the AI's had to play a card in
+_tricks = [] # (cards, trump) of every completed round
+
+class TimedAI(AI):
+    '''AI that records how long its calls take, and the positions it saw'''
+    def play_card(self, rnum, played_cards, *args, **kwargs):
+        _positions.append((Cards(self.cards), Cards(played_cards), self.trump, self.partner))
+        t = time.perf_counter()
+        c = super().play_card(rnum, played_cards, *args, **kwargs)
+        _timings["AI.play_card", rnum].append(time.perf_counter() - t)
+        return c
+
+    def do_minmax(self, *args, **kwargs):
+        t = time.perf_counter()
+        c = super().do_minmax(*args, **kwargs)
+        _timings["AI.do_minmax", self.round].append(time.perf_counter() - t)
+        return c
+
+    def show_trick(self, cards, round):
+        if self.index == 0: _tricks.append((Cards(cards), self.trump))
+        t = time.perf_counter()
+        super().show_trick(cards, round)
+        _timings["AI.show_trick", round].append(time.perf_counter() - t)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values)-1, int(p*len(values)))]
+
+def play_games(ngames, seed):
+    '''Plays ngames seeded games between TimedAI's and returns the metrics of the AI calls'''
+    _timings.clear()
+    del _positions[:]
+    del _tricks[:]
+    r = random.Random(seed)
+    t = time.perf_counter()
+    for i in range(ngames):
+        SimulatedGame(r.randint(10000000,20000000), [TimedAI]*4, i%4).play()
+    metrics = {"games": {"total_s": time.perf_counter() - t}}
+    for (name, rnum), l in sorted(_timings.items()):
+        metrics["{} round {:d}".format(name, rnum)] = {
+            "calls": len(l),
+            "mean_ms": 1000*sum(l)/len(l),
+            "p95_ms": 1000*percentile(l, 0.95),
+            "max_ms": 1000*max(l),
+        }
+    return metrics
+
+def time_function(f, inputs, repeat=5):
+    '''Returns the microseconds per call of f over inputs, the best of repeat runs, and the
+    peak memory in kilobytes allocated during one run'''
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for args in inputs: f(*args)
+        t = time.perf_counter() - t
+        if best is None or t < best: best = t
+    tracemalloc.start()
+    for args in inputs: f(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"calls": len(inputs), "us_per_call": 1e6*best/len(inputs), "peak_kb": peak/1024}
+
+def time_functions(repeat=5):
+    '''Times the card functions on the positions and tricks recorded by play_games'''
+    partial = [(cards[:i], trump) for cards, trump in _tricks for i in range(1, 5)]
+    return {
+        "legal_cards": time_function(legal_cards, _positions, repeat),
+        "highest_card": time_function(highest_card, partial, repeat),
+        "card_points": time_function(card_points, _tricks, repeat),
+        "glory_calculation": time_function(glory_calculation, _tricks, repeat),
+    }
+
+def run(ngames=20, seed=500, repeat=5):
+    metrics = play_games(ngames, seed)
+    metrics.update(time_functions(repeat))
+    return {
+        "meta": {"games": ngames, "seed": seed, "python": platform.python_version(),
+                 "machine": platform.machine(), "date": time.strftime("%Y-%m-%d %H:%M:%S")},
+        "metrics": metrics,
+    }
+
+TIMING_KEYS = ("total_s", "mean_ms", "p95_ms", "us_per_call")
+
+def regressions(baseline, results, threshold=0.25, min_ms=1.0):
+    '''Returns (metric, key, old, new) for every timing that got more than threshold slower.
+    Latencies of AI calls that got less than min_ms slower are ignored as noise.'''
+    found = []
+    for name, values in sorted(results["metrics"].items()):
+        old = baseline["metrics"].get(name)
+        if not old: continue
+        for key in TIMING_KEYS:
+            if key not in values or not old.get(key): continue
+            if key.endswith("_ms") and values[key] - old[key] < min_ms: continue
+            if values[key] > old[key]*(1+threshold):
+                found.append((name, key, old[key], values[key]))
+    return found
+
+def print_results(results):
+    for name, values in sorted(results["metrics"].items()):
+        print("{:<28} {}".format(name, ", ".join("{} {:.3f}".format(k, v) if isinstance(v, float)
+                                               else "{} {}".format(k, v) for k, v in sorted(values.items()))))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the klaverjas engine over fixed seeds")
+    parser.add_argument("-n", "--games", type=int, default=20)
+    parser.add_argument("-s", "--seed", type=int, default=500)
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs of every function, the best one counts")
+    parser.add_argument("--save", help="file to save the results to as the new baseline")
+    parser.add_argument("--compare", help="baseline file to compare the results with")
+    parser.add_argument("-t", "--threshold", type=float, default=0.25, help="fraction slower that counts as a regression")
+    parser.add_argument("--min-ms", type=float, default=1.0, help="AI calls less than this much slower are never a regression")
+    args = parser.parse_args()
+
+    results = run(args.games, args.seed, args.repeat)
+    print_results(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["meta"]["games"] != args.games or baseline["meta"]["seed"] != args.seed:
+            print("Warning: baseline was made with other games or seed")
+        found = regressions(baseline, results, args.threshold, args.min_ms)
+        for name, key, old, new in found:
+            print("REGRESSION {} {}: {:.3f} -> {:.3f} ({:+.0f}%)".format(name, key, old, new, 100*(new/old-1)))
+        if found: sys.exit(1)
+        print("No regressions over {:.0f}%".format(100*args.threshold))
@@ -0,0 +1,151 @@
+'''Builds the opening book of the klaverjas AI, for instance:
+cd modules/games
+python -m simulation.book --hands 2000 --deals 24
+
+A hand is scored by dealing the other 24 cards at random a number of times. In every deal the
+AI's play the first rounds and the rest of the game is solved exactly, which is a lot faster
+than solving the whole game. The trump with the best average score is stored, and for that
+trump the card to lead the first round with. The hands of seeded games can be added with
+--seeds, so a challenge always finds its own deals in the book.'''
+import argparse
+import multiprocessing
+import random
+import time
+
+if "." in __package__:
+    from ..cards import *
+    from ..klaverjas_ai import AI
+    from ..klaverjas_book import BOOK_PATH, OpeningBook, trump_key
+    from ..klaverjas_solver import Solver
+else: # run from modules/games as "python -m simulation", so the bot modules aren't imported
+    from cards import *
+    from klaverjas_ai import AI
+    from klaverjas_book import BOOK_PATH, OpeningBook, trump_key
+    from klaverjas_solver import Solver
+from .game import SimulatedGame
+
+class BookAI(AI):
+    '''AI that doesn't use the book it is building, and can be made to lead with a given card'''
+    use_book = False
+    lead = None
+
+    def play_card(self, rnum, played_cards, *args, **kwargs):
+        if rnum == 1 and not played_cards and self.lead is not None:
+            for c in self.cards:
+                if c.index == self.lead: return self.play_this_card(c)
+        return super().play_card(rnum, played_cards, *args, **kwargs)
+
+def playout(hands, trump, lead=None, rounds=3, seed=0):
+    '''Plays the game with these hands (lists of card indices by seat) and trump, where seat 0
+    chose trump and leads. The AI's play the first rounds and the rest is solved. Returns the
+    points of the team of seat 0 minus those of the other team, where going nat counts as
+    the other team getting all 162 points.'''
+    g = SimulatedGame(seed, [BookAI]*4, 0)
+    for i, p in enumerate(g.players):
+        p.seed("{}:{:d}".format(seed, i))
+        p.give_cards(Cards([index_to_card(index) for index in hands[i]]))
+    g.players[0].lead = lead
+    g.trump = trump
+    for p in g.players:
+        p.set_trump(trump)
+    currentplayer = 0
+    for rnum in range(1, rounds+1):
+        currentplayer = g.play_round(rnum, currentplayer)
+    solver = Solver([p.cards.mask() for p in g.players], trump, [p.is_playing for p in g.players],
+                    g.points1, g.points2, currentplayer, rounds+1, [])
+    value = solver.search()
+    if value < 0: value = min(value, -162) #nat, a tie is not
+    return value
+
+def score_hand(task):
+    '''Scores the hand for every trump and every first lead with the best trump, over the
+    same random deals of the other cards. Returns (hand, trump, lead, scores by trump).'''
+    hand, ndeals, rounds, seed = task
+    r = random.Random("{}:{}".format(seed, hand))
+    rest = [i for i in range(32) if i not in hand]
+    deals = []
+    for _ in range(ndeals):
+        r.shuffle(rest)
+        deals.append([hand, rest[0:8], rest[8:16], rest[16:24]])
+    scores = [sum(playout(d, trump, None, rounds, seed+n) for n, d in enumerate(deals))/ndeals for trump in range(4)]
+    trump = max(range(4), key=lambda t: scores[t])
+    leads = {index: sum(playout(d, trump, index, rounds, seed+n) for n, d in enumerate(deals)) for index in hand}
+    lead = max(hand, key=lambda index: leads[index])
+    return hand, trump, lead, scores
+
+def hand_mask(hand):
+    mask = 0
+    for index in hand:
+        mask |= 1 << index
+    return mask
+
+def random_hands(amount, seed):
+    r = random.Random(seed)
+    return [sorted(r.sample(range(32), 8)) for _ in range(amount)]
+
+def seeded_hands(seeds):
+    '''Returns the hands of the games with these seeds, dealt like Klaverjas.give_cards does'''
+    hands = []
+    for s in seeds:
+        r = random.Random()
+        r.seed(s)
+        deck = create_deck()
+        r.shuffle(deck)
+        for i in range(4):
+            hands.append(sorted(c.index for c in deck[i*8:i*8+8]))
+    return hands
+
+def build_book(hands, ndeals=24, rounds=3, seed=500, processes=None, book=None, callback=None):
+    '''Scores hands and adds them to book (a new one by default), which is returned.
+    Hands that are already in it up to the symmetry of the colours are skipped.'''
+    if processes is None: processes = multiprocessing.cpu_count()
+    if book is None: book = OpeningBook()
+    tasks = []
+    keys = set(book.trumps)
+    for hand in hands:
+        key = trump_key(hand_mask(hand))[0]
+        if key in keys: continue
+        keys.add(key)
+        tasks.append((hand, ndeals, rounds, seed))
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        results = pool.imap_unordered(score_hand, tasks) if pool else map(score_hand, tasks)
+        for hand, trump, lead, scores in results:
+            mask = hand_mask(hand)
+            book.add_trump(mask, trump)
+            book.add_lead(mask, trump, lead)
+            if callback: callback(hand, trump, lead, scores)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return book
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the opening book of the klaverjas AI")
+    parser.add_argument("-n", "--hands", type=int, default=1000, help="amount of random hands to score")
+    parser.add_argument("--seeds", nargs="*", default=[], help="seeds of games whose hands should be scored too")
+    parser.add_argument("-d", "--deals", type=int, default=24, help="amount of deals of the other cards per hand")
+    parser.add_argument("-r", "--rounds", type=int, default=3, help="rounds the AI's play before the solver takes over")
+    parser.add_argument("-s", "--seed", type=int, default=500)
+    parser.add_argument("-p", "--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("-o", "--output", default=BOOK_PATH, help="book to add the hands to")
+    parser.add_argument("--new", action="store_true", help="start a new book instead of adding to the output")
+    args = parser.parse_args()
+
+    try:
+        book = OpeningBook() if args.new else OpeningBook.load(args.output)
+    except FileNotFoundError:
+        book = OpeningBook()
+    before = len(book.trumps)
+    hands = seeded_hands(args.seeds) + random_hands(args.hands, args.seed)
+    t = time.time()
+    done = [0]
+    def progress(hand, trump, lead, scores):
+        done[0] += 1
+        if done[0] % 50 == 0:
+            print("{:d} hands scored in {:.1f}s".format(done[0], time.time() - t))
+    build_book(hands, args.deals, args.rounds, args.seed, args.processes, book, progress)
+    book.save(args.output)
+    print("Scored {:d} hands in {:.1f}s, the book has {:d} hands now ({:d} new)".format(
+        done[0], time.time() - t, len(book.trumps), len(book.trumps) - before))
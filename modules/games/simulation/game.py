@@ -0,0 +1,97 @@
+import random
+
+if "." in __package__:
+    from ..cards import *
+else: # run from modules/games as "python -m simulation", so the bot modules aren't imported
+    from cards import *
+
+class SimulatedGame(object):
+    '''A game of klaverjas between four AI's, without any printing or user input.
+    players are the four AI classes by seat, the players in seats 0 and 2 form a team.
+    The deal and the random choices of the AI's only depend on the seed.'''
+    def __init__(self, seed, players, startingplayer=0):
+        self.seed = seed
+        self.startingplayer = startingplayer
+        self.players = []
+        for i, ai_class in enumerate(players):
+            p = ai_class(i)
+            p.silent = True
+            p.printer = lambda s: None
+            self.players.append(p)
+        for i, p in enumerate(self.players):
+            p.set_partner((i+2)%4)
+            p.is_playing = (i%2 == startingplayer%2)
+        self.points1 = 0 # Points of the attacking team
+        self.points2 = 0 # Points of the defending team
+        self.pointsglory1 = 0
+        self.pointsglory2 = 0
+        self.nat = False # Whether the attacking team went nat
+        self.pit = False # Whether a team got all the tricks
+        self.trump = None
+        self.round_lists = []
+        self.glory_lists = []
+
+    def give_cards(self):
+        r = random.Random()
+        r.seed(self.seed)
+        deck = create_deck()
+        r.shuffle(deck)
+        for i, p in enumerate(self.players):
+            if hasattr(p, "seed"): #older AI's use the global random
+                p.seed("{}:{:d}".format(self.seed, i))
+            p.give_cards(Cards([deck[i*8+j] for j in range(8)]))
+
+    def play_round(self, rnum, currentplayer):
+        '''Plays a single round and returns the player that won it'''
+        cards = Cards()
+        for i in range(4):
+            p = self.players[(currentplayer+i)%4]
+            cards.append(p.play_card(rnum, cards))
+        winner = highest_card(cards, self.trump).owner
+        points = card_points(cards, self.trump)
+        glory = glory_calculation(cards, self.trump)
+        if rnum == 8: points += 10
+        if self.players[winner].is_playing:
+            self.points1 += points + glory
+            self.pointsglory1 += glory
+        else:
+            self.points2 += points + glory
+            self.pointsglory2 += glory
+        for p in self.players:
+            p.show_trick(cards, rnum)
+        self.round_lists.append(cards)
+        self.glory_lists.append(glory)
+        return winner
+
+    def play(self):
+        random.seed(self.seed)
+        self.give_cards()
+        self.trump = self.players[self.startingplayer].pick_trump()
+        for p in self.players:
+            p.set_trump(self.trump)
+        currentplayer = self.startingplayer
+        for rnum in range(1, 9):
+            currentplayer = self.play_round(rnum, currentplayer)
+        self.score_game()
+
+    def score_game(self):
+        '''Applies pit and nat to the points of the played rounds, like the game does: when
+        the attackers have less points than the defenders, those get all of them'''
+        self.pit = self.points1 == 0 or self.points2 == 0
+        if self.points1 == 0:
+            self.points2 += 100
+            self.pointsglory2 += 100
+        if self.points2 == 0:
+            self.points1 += 100
+            self.pointsglory1 += 100
+        self.nat = self.points1 < self.points2
+        if self.nat:
+            self.points2 += self.points1
+            self.pointsglory2 += self.pointsglory1
+            self.points1 = 0
+            self.pointsglory1 = 0
+
+    def team_points(self, seat):
+        '''Returns the points of the team of the player in this seat'''
+        if self.players[seat].is_playing: return self.points1
+        return self.points2
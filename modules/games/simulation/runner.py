@@ -0,0 +1,115 @@
+import csv
+import importlib
+import json
+import math
+import multiprocessing
+import random
+import time
+
+from .game import SimulatedGame
+
+FIELDS = ["seed", "startingplayer", "ai1_seats", "ai1_playing", "trump", "points1", "points2",
+          "glory1", "glory2", "ai1_points", "ai2_points", "nat", "pit", "seconds"]
+
+def load_ai(name):
+    '''Returns the AI class named like "klaverjas_ai2" or "klaverjas_ai2.AI", from modules.games'''
+    module, _, cls = name.partition(".")
+    if "." in __package__: module = __package__.rpartition(".")[0] + "." + module
+    return getattr(importlib.import_module(module), cls or "AI")
+
+def play_game(task):
+    '''Plays one game for a (seed, startingplayer, ai1, ai2, ai1_seats) task and returns its result.
+    ai1 sits in seats 0 and 2 if ai1_seats is 0, and in seats 1 and 3 otherwise.'''
+    seed, startingplayer, ai1, ai2, ai1_seats = task
+    players = [ai1, ai2, ai1, ai2] if ai1_seats == 0 else [ai2, ai1, ai2, ai1]
+    t = time.time()
+    g = SimulatedGame(seed, players, startingplayer)
+    g.play()
+    return {
+        "seed": seed,
+        "startingplayer": startingplayer,
+        "ai1_seats": "02" if ai1_seats == 0 else "13",
+        "ai1_playing": g.players[ai1_seats].is_playing,
+        "trump": g.trump,
+        "points1": g.points1,
+        "points2": g.points2,
+        "glory1": g.pointsglory1,
+        "glory2": g.pointsglory2,
+        "ai1_points": g.team_points(ai1_seats),
+        "ai2_points": g.team_points(1 - ai1_seats),
+        "nat": g.nat,
+        "pit": g.pit,
+        "seconds": round(time.time() - t, 4),
+    }
+
+def confidence_interval(values, z=1.96):
+    '''Returns the mean of values and the half width of its confidence interval (95% by default)'''
+    n = len(values)
+    if n == 0: return 0.0, 0.0
+    mean = sum(values)/n
+    if n == 1: return mean, float("inf")
+    var = sum((v-mean)**2 for v in values)/(n-1)
+    return mean, z*math.sqrt(var/n)
+
+class ResultWriter(object):
+    '''Streams game results to a .jsonl or .csv file'''
+    def __init__(self, path):
+        self.f = open(path, "w", newline="")
+        self.csv = None
+        if path.endswith(".csv"):
+            self.csv = csv.DictWriter(self.f, FIELDS)
+            self.csv.writeheader()
+
+    def write(self, result):
+        if self.csv: self.csv.writerow(result)
+        else: self.f.write(json.dumps(result) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+def run_match(ai1, ai2, ngames, seed=500, processes=None, output=None, callback=None):
+    '''Plays ngames deals between the AI classes ai1 and ai2. Every deal is played twice with the
+    same cards, once with each AI in seats 0 and 2, so the luck of the deal cancels out. The games
+    are spread over processes worker processes (all cores by default, 1 plays them here).
+    Results are written to output if given and passed to callback as they come in.
+    Returns a dictionary summarizing the match.'''
+    if processes is None: processes = multiprocessing.cpu_count()
+    r = random.Random(seed)
+    tasks = []
+    for i in range(ngames):
+        s = r.randint(10000000,20000000)
+        tasks.append((s, i%4, ai1, ai2, 0))
+        tasks.append((s, i%4, ai1, ai2, 1))
+    writer = ResultWriter(output) if output else None
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    t = time.time()
+    results = pool.imap(play_game, tasks, chunksize=max(1, len(tasks)//(8*processes))) if pool else map(play_game, tasks)
+    diffs = [] # point difference between ai1 and ai2 per game
+    deal_diffs = [] # the same, summed over both games of a deal
+    attacks = {"ai1": [0, 0], "ai2": [0, 0]} # games attacked and gone nat, by the AI that attacked
+    try:
+        for result in results:
+            if writer: writer.write(result)
+            if callback: callback(result)
+            diffs.append(result["ai1_points"] - result["ai2_points"])
+            if len(diffs) % 2 == 0: deal_diffs.append(diffs[-1] + diffs[-2])
+            a = attacks["ai1" if result["ai1_playing"] else "ai2"]
+            a[0] += 1
+            if result["nat"]: a[1] += 1
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if writer: writer.close()
+    seconds = time.time() - t
+    mean, error = confidence_interval(diffs)
+    deal_mean, deal_error = confidence_interval(deal_diffs)
+    return {
+        "games": len(diffs),
+        "seconds": seconds,
+        "games_per_second": len(diffs)/seconds if seconds else 0.0,
+        "point_difference": (mean, error),
+        "deal_point_difference": (deal_mean, deal_error),
+        "nat_percentage": {k: 100.0*v[1]/v[0] if v[0] else 0.0 for k, v in attacks.items()},
+    }
@@ -2,7 +2,6 @@ from collections import defaultdict
 
 from .base import Module
 from util import prepare_query
-import difflib
 
 class Learning(Module):
     def register_commands(self,bot):
@@ -34,10 +33,7 @@ class Learning(Module):
             else: bot.responses[c[1:]].extend(responses)
         bot.dataManager.add_response(c, responses, msg.sender, msg.date)
         if not c.startswith("$"):
-            if c in bot.aliasdict: bot.userresponses[bot.aliasdict[c]].extend(responses)
-            else:
-                bot.aliasdict[c] = len(bot.userresponses)+1 #add new to list of aliases
-                bot.userresponses[bot.aliasdict[c]] = responses
+            bot.aliasindex.add_response(msg.sender, c, " | ".join(responses))
         return "Ik denk dat ik het snap"
 
     def myresponses(self, bot, msg):
@@ -71,8 +67,14 @@ class Learning(Module):
         n = msg.command
         if not n.isdigit():
             return "Dat is geen geldig getal"
-        if bot.dataManager.delete_response(msg.sender, int(n)):
-            bot.build_response_dict()
+        deleted = bot.dataManager.delete_response(msg.sender, int(n))
+        if deleted:
+            call, response = deleted
+            if call.startswith("$"):
+                for r in response.split(" | "):
+                    if r in bot.responses[call[1:]]: bot.responses[call[1:]].remove(r)
+            else:
+                bot.aliasindex.delete_response(msg.sender, call, response)
             return "Gelukt!"
         else:
             return "hmm, iets ging mis. Check even of het getal daadwerkelijk klopt"
@@ -84,34 +86,28 @@ class Learning(Module):
             return "geef wel synoniemen op door woorden te splitten met |"
         if not all(options): #one of the options is empty
             return "een van je gegeven opties is niet geldig (leeg)"
-        matches = [o for o in options if o in bot.aliasdict]
+        matches = [o for o in options if o in bot.aliasindex]
         if not matches:
             return "ik ken nog geen responses voor deze queries, voeg die eerst toe alsjeblieft"
         bot.dataManager.add_alias(options, msg.sender, msg.date)
-        if len(matches) == 1:
-            for o in options: #match all the new aliases to the known one
-                bot.aliasdict[o] = bot.aliasdict[matches[0]]
-        else: #two sets of queries now point to the same thing, we need to reload the entire structure
-            bot.build_response_dict()
+        bot.aliasindex.add_alias(msg.sender, " | ".join(options)) #merges the groups of all the options
         return "deze dingen betekenen hetzelfde... got it!"
 
     def showalias(self, bot, msg):
         s = prepare_query(msg.raw[11:])
         if not s:
             return "type een query na /showalias en ik laat zien welke synoniemen ik hier van ken"
-        l = bot.aliasdict.keys()
-        if not s in l:
-            options = difflib.get_close_matches(s,l)
+        if not s in bot.aliasindex:
+            options = bot.aliasindex.get_close_matches(s)
             if not options:
                 return "Deze query ken ik uberhaupt niet, misschien wil je me leren hoe ik er op moet reageren met /learn?"
             else:
                 return "Ik ken deze niet, maar het lijkt wel op deze die ik wel ken: \n%s" % "\n".join(options)
-        i = bot.aliasdict[s]
-        aliases = [k for k,v in bot.aliasdict.items() if v==i]
-        count = len(bot.userresponses[i])
+        aliases = bot.aliasindex.synonyms(s)
+        count = len(bot.aliasindex.responses_for(s))
         response = "Ik ken %d verschillende responses op deze query\n" % count
         if len(aliases) == 1:
-            options = difflib.get_close_matches(s,l)
+            options = bot.aliasindex.get_close_matches(s)
             if s in options: options.remove(s)
             if not options:
                 response += "Het lijkt er op dat ik geen synoniemen van deze term ken, misschien wil je me er een paar leren met /alias?"
@@ -137,8 +133,9 @@ class Learning(Module):
         n = msg.command
         if not n.isdigit():
             return "dat is geen geldig getal"
-        if bot.dataManager.delete_alias(msg.sender, int(n)):
-            bot.build_response_dict()
+        deleted = bot.dataManager.delete_alias(msg.sender, int(n))
+        if deleted:
+            bot.aliasindex.delete_alias(msg.sender, deleted)
             return "Gelukt!"
         else:
             return "hmm, iets ging mis. Check even of het getal daadwerkelijk klopt"
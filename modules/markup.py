@@ -90,12 +90,12 @@ def code_to_png(s, language='python'):
 
 class Markup(Module):
     def register_commands(self,bot):
-        bot.add_slash_command("latex", self.generate_latex)
-        bot.add_slash_command("python", self.gen_lang_command("python"))
-        bot.add_slash_command("c", self.gen_lang_command("c"))
-        bot.add_slash_command("java", self.gen_lang_command("java"))
-        bot.add_slash_command("php", self.gen_lang_command("php"))
-        bot.add_slash_command("html", self.gen_lang_command("html"))
+        bot.add_slash_command("latex", self.generate_latex, slow=True)
+        bot.add_slash_command("python", self.gen_lang_command("python"), slow=True)
+        bot.add_slash_command("c", self.gen_lang_command("c"), slow=True)
+        bot.add_slash_command("java", self.gen_lang_command("java"), slow=True)
+        bot.add_slash_command("php", self.gen_lang_command("php"), slow=True)
+        bot.add_slash_command("html", self.gen_lang_command("html"), slow=True)
 
     def gen_lang_command(self, lang):
         def f(bot, msg):
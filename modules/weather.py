@@ -83,8 +83,8 @@ def raw_weather_report(weerstation = "6275", lat = 51.81, lon = 5.85):
 
 class Weather(Module):
     def register_commands(self,bot):
-        bot.add_slash_command("weather", self.weather)
-        bot.add_command_category("weather", self.weather)
+        bot.add_slash_command("weather", self.weather, slow=True)
+        bot.add_command_category("weather", self.weather, slow=True)
 
     def weather(self, bot, msg):
         return self.weather_report()
@@ -60,8 +60,8 @@ def wiki_text(name):
 
 class Wiki(Module):
     def register_commands(self, bot):
-        bot.add_slash_command("wiki", self.wiki)
-        bot.add_command_category("question", self.wiki)
+        bot.add_slash_command("wiki", self.wiki, slow=True)
+        bot.add_command_category("question", self.wiki, slow=True)
 
     def wiki(self, bot, msg):
         if msg.normalised.find("moeder")!=-1:
@@ -0,0 +1,7 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The klaverjas engine is imported like its scripts do, as flat modules from modules/games
+sys.path.insert(0, os.path.join(ROOT, "modules", "games"))
+sys.path.insert(0, ROOT)
@@ -0,0 +1,63 @@
+import pickle
+import random
+
+import pytest
+
+from cards import *
+from klaverjas_ai import AI
+
+def dealt_players(seed):
+    r = random.Random(seed)
+    deck = create_deck()
+    r.shuffle(deck)
+    players = [AI(i) for i in range(4)]
+    for i, p in enumerate(players):
+        p.silent = True
+        p.seed("{}:{:d}".format(seed, i))
+        p.set_partner((i+2) % 4)
+        p.is_playing = (i % 2 == 0)
+        p.give_cards(Cards(deck[i*8:i*8+8]))
+    trump = players[0].pick_trump()
+    for p in players: p.set_trump(trump)
+    return players, trump
+
+def play_rounds(players, trump, rounds, currentplayer=0):
+    for rnum in rounds:
+        cards = Cards()
+        for i in range(4):
+            cards.append(players[(currentplayer+i) % 4].play_card(rnum, cards))
+        currentplayer = highest_card(cards, trump).owner
+        for p in players: p.show_trick(cards, rnum)
+    return currentplayer
+
+def legacy_pickle(ai):
+    '''Pickles ai like the players were before the possible cards were bitmasks'''
+    state = dict(ai.__dict__)
+    for name in ("possible", "voids", "mystery", "random"): del state[name]
+    state["unknown_cards"] = [Cards([index_to_card(i) for i in range(32) if mask >> i & 1]) for mask in ai.possible]
+    state["unknown_colours"] = [list(range(4))]*3
+    state["mystery_cards"] = Cards([index_to_card(i) for i in range(32) if ai.mystery >> i & 1])
+    legacy = AI.__new__(AI)
+    legacy.__dict__.update(state)
+    return pickle.dumps(legacy)
+
+def test_legacy_players_can_go_on_playing():
+    players, trump = dealt_players(21)
+    currentplayer = play_rounds(players, trump, range(1, 3))
+    loaded = [pickle.loads(legacy_pickle(p)) for p in players]
+    for p, q in zip(players, loaded):
+        assert q.possible == p.possible
+        assert q.mystery == p.mystery
+        assert not hasattr(q, "unknown_cards")
+        for i in range(3):
+            for color in range(4):
+                if q.voids[i] >> color & 1: assert not q.possible[i] & suit_masks[color]
+    play_rounds(loaded, trump, range(3, 9), currentplayer)
+    assert all(not p.cards for p in loaded)
+
+def test_slots_of_the_other_players():
+    ai = AI(1)
+    assert [ai.slot(i) for i in (2, 3, 0)] == [0, 1, 2]
+    for index in (1, 4, -1):
+        with pytest.raises(ValueError):
+            ai.slot(index)
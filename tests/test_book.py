@@ -0,0 +1,77 @@
+import random
+
+import pytest
+
+import klaverjas_book
+from cards import Cards, index_to_card
+from klaverjas_book import OpeningBook
+from simulation import book as builder
+from test_ai import dealt_players
+
+def permuted(mask, perm):
+    '''The hand in mask with colour c changed to perm[c]'''
+    return sum(((mask >> 8*c) & 0xFF) << 8*perm[c] for c in range(4))
+
+def suit(mask, color):
+    return (mask >> 8*color) & 0xFF
+
+def test_hands_with_other_colours_share_an_entry(tmp_path):
+    r = random.Random(4)
+    book = OpeningBook()
+    hands = [sum(1 << i for i in r.sample(range(32), 8)) for _ in range(20)]
+    for mask in hands:
+        trump = r.randrange(4)
+        book.add_trump(mask, trump)
+        book.add_lead(mask, trump, r.choice([i for i in range(32) if mask >> i & 1]))
+    path = str(tmp_path / "book.bin")
+    book.save(path)
+    loaded = OpeningBook.load(path)
+    assert (loaded.trumps, loaded.leads) == (book.trumps, book.leads)
+    for mask in hands:
+        trump = loaded.trump(mask)
+        lead = loaded.lead(mask, trump)
+        assert mask >> lead & 1
+        perm = [trump] + r.sample([c for c in range(4) if c != trump], 3)
+        perm = [perm.index(c) for c in range(4)]
+        other = permuted(mask, perm)
+        #a colour that holds the same cards, which is the same one unless two colours do
+        assert suit(other, loaded.trump(other)) == suit(mask, trump)
+        index = loaded.lead(other, perm[trump])
+        assert index & 7 == lead & 7 and suit(other, index >> 3) == suit(mask, lead >> 3)
+    assert loaded.trump(0xFF) is None
+
+def test_only_books_are_loaded(tmp_path):
+    path = tmp_path / "book.bin"
+    path.write_bytes(b"KJBOEK" + bytes(9))
+    with pytest.raises(ValueError):
+        OpeningBook.load(str(path))
+
+def test_the_ai_picks_trump_and_leads_from_the_book(monkeypatch):
+    players, trump = dealt_players(5)
+    p = players[1]
+    book = OpeningBook()
+    monkeypatch.setattr(klaverjas_book, "_book", book)
+    mask = p.cards.mask()
+    other = (p.pick_trump() + 1) % 4
+    book.add_trump(mask, other)
+    assert p.pick_trump() == other
+    lead = p.cards[3]
+    book.add_lead(mask, trump, lead.index)
+    assert p.play_card(1, Cards()) is lead
+
+def test_a_tie_is_not_nat(monkeypatch):
+    hands = [list(range(8*i, 8*i+8)) for i in range(4)]
+    for value, result in ((0, 0), (-1, -162), (-200, -200), (12, 12)):
+        class Solver(object):
+            def __init__(self, *args): pass
+            def search(self): return value
+        monkeypatch.setattr(builder, "Solver", Solver)
+        assert builder.playout(hands, 0, rounds=0) == result
+
+def test_book_ai_leads_the_given_card():
+    p = builder.BookAI(0)
+    p.silent = True
+    p.give_cards(Cards([index_to_card(i) for i in range(0, 32, 4)]))
+    p.set_trump(1)
+    p.lead = 12
+    assert p.play_card(1, Cards()).index == 12
@@ -0,0 +1,84 @@
+import pickle
+import random
+
+from cards import (Card, Cards, highest_card, interned_cards, cards_to_mask, mask_to_cards,
+                   mask_count, higher_mask, legal_cards, glory_calculation, mask_glory, trick_glory,
+                   load_glory_table, GLORY_TABLE_VERSION)
+from cards import CLUBS, SPADES, DIAMONDS, HEARTS, SEVEN, EIGHT, NINE, TEN, JACK, QUEEN, KING, ACE
+
+def test_highest_card_leaves_the_cards_alone():
+    r = random.Random(1)
+    for _ in range(500):
+        trump = r.randrange(4)
+        shared = [interned_cards[None][i] for i in r.sample(range(32), 4)]
+        flagged = [interned_cards[trump][c.index] for c in shared]
+        h = highest_card(Cards(shared), trump)
+        assert not any(c.is_trump for c in shared)
+        assert h.index == highest_card(Cards(flagged)).index
+
+def card(value, color, trump, owner=None):
+    c = Card(value, color)
+    c.is_trump = color == trump
+    c.owner = owner
+    return c
+
+def test_masks_and_cards_round_trip():
+    r = random.Random(2)
+    for _ in range(200):
+        mask = r.getrandbits(32)
+        trump = r.choice([None, CLUBS, SPADES, DIAMONDS, HEARTS])
+        cards = mask_to_cards(mask, trump)
+        assert cards_to_mask(cards) == cards.mask() == mask
+        assert mask_count(mask) == len(cards)
+        assert all(c.is_trump == (c.color == trump) for c in cards)
+
+def test_higher_mask_holds_the_cards_that_win():
+    for trump in range(4):
+        cards = interned_cards[trump]
+        for c in cards:
+            higher = [d.index for d in cards if d is not c and highest_card(Cards([c, d]), trump) is d]
+            assert higher_mask(c.index, trump) == sum(1 << i for i in higher)
+
+def test_legal_cards():
+    t = HEARTS
+    played = Cards([card(KING, SPADES, t, owner=1)])
+    hand = Cards([card(SEVEN, SPADES, t), card(ACE, CLUBS, t), card(JACK, HEARTS, t)])
+    assert legal_cards(hand, played, t, 2) == [hand[0]] #follow suit
+    played = Cards([card(NINE, HEARTS, t, owner=1)])
+    hand = Cards([card(SEVEN, HEARTS, t), card(JACK, HEARTS, t), card(ACE, CLUBS, t)])
+    assert legal_cards(hand, played, t, 2) == [hand[1]] #overtrump
+    played = Cards([card(KING, SPADES, t, owner=1)])
+    hand = Cards([card(SEVEN, HEARTS, t), card(ACE, CLUBS, t)])
+    assert legal_cards(hand, played, t, 2) == [hand[0]] #must trump
+    assert legal_cards(hand, played, t, 1) == hand #unless the mate is winning
+    played = Cards([card(KING, SPADES, t, owner=0), card(JACK, HEARTS, t, owner=1)])
+    assert legal_cards(hand, played, t, 2) == [hand[1]] #no undertrumping
+    hand = Cards([card(SEVEN, HEARTS, t), card(EIGHT, HEARTS, t)])
+    assert legal_cards(hand, played, t, 2) == hand #unless there is nothing else
+
+def test_glory():
+    t = HEARTS
+    def glory(*cards): return glory_calculation(Cards([card(v, c, t) for v, c in cards]), t)
+    assert glory((SEVEN, SPADES), (EIGHT, SPADES), (NINE, SPADES), (ACE, CLUBS)) == 20
+    assert glory((TEN, SPADES), (JACK, SPADES), (QUEEN, SPADES), (KING, SPADES)) == 50
+    assert glory((QUEEN, HEARTS), (KING, HEARTS), (SEVEN, CLUBS), (ACE, CLUBS)) == 20 #stuk
+    assert glory((JACK, HEARTS), (QUEEN, HEARTS), (KING, HEARTS), (ACE, CLUBS)) == 40
+    assert glory((QUEEN, SPADES), (KING, SPADES), (SEVEN, CLUBS), (ACE, CLUBS)) == 0
+    assert glory(*[(ACE, c) for c in range(4)]) == 100
+    assert glory(*[(JACK, c) for c in range(4)]) == 200
+
+def test_the_glory_table_matches_the_direct_calculation():
+    r = random.Random(3)
+    for _ in range(2000):
+        mask = sum(1 << i for i in r.sample(range(32), r.randint(1, 4)))
+        for trump in range(4):
+            assert trick_glory(mask, trump) == mask_glory(mask, trump)
+
+def test_the_glory_table_is_stored_and_rebuilt_when_stale(tmp_path):
+    path = str(tmp_path / "glory.pickle")
+    table = load_glory_table(path)
+    with open(path, "rb") as f:
+        assert pickle.load(f) == (GLORY_TABLE_VERSION, table)
+    with open(path, "wb") as f:
+        pickle.dump((GLORY_TABLE_VERSION - 1, [{}]*4), f)
+    assert load_glory_table(path) == table
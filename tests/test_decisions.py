@@ -0,0 +1,49 @@
+import pickle
+import types
+
+import decisions
+from cards import Cards
+from decisions import DecisionCache
+from test_ai import dealt_players, play_rounds
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(decisions, "time", types.SimpleNamespace(time=lambda: now[0]))
+    cache = DecisionCache(ttl=10)
+    cache.put("a", 3)
+    now[0] += 10
+    assert cache.get("a") == 3
+    now[0] += 1
+    assert cache.get("a") is None
+    cache.put("b", 4) #drops the expired ones
+    assert len(cache) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_oldest_entries_are_dropped():
+    cache = DecisionCache(max_entries=3)
+    for i in range(5): cache.put(i, i)
+    cache.put(2, 7) #stored again, so it is the newest
+    cache.put(5, 5)
+    assert list(cache.entries) == [4, 2, 5]
+    assert cache.get(1) is None and cache.get(2) == 7
+
+def test_a_hit_plays_the_stored_card_and_updates_what_the_ai_knows():
+    for seed in range(100):
+        players, trump = dealt_players(seed)
+        current = play_rounds(players, trump, range(1, 5))
+        trick = Cards([players[current].play_card(5, Cards())])
+        p = players[(current+1) % 4]
+        legal = p.legal_cards(trick)
+        if len(legal) > 1: break
+    searched = pickle.loads(pickle.dumps(p))
+    stored = legal[-1]
+    cache = DecisionCache()
+    cache.put("key", stored.index)
+    c = p.play_card(5, trick, None, cache, "key")
+    assert c.index == stored.index and c not in p.cards
+    assert cache.hits == 1
+    before = list(searched.possible)
+    searched.played_cards = Cards(trick)
+    searched.note_played_cards() #what a search does first
+    assert searched.possible != before
+    assert (p.possible, p.mystery) == (searched.possible, searched.mystery)
@@ -0,0 +1,119 @@
+import concurrent.futures
+import importlib
+import itertools
+import json
+import threading
+import types
+
+import pytest
+
+pytest.importorskip("telepot")
+klaverjas_game = importlib.import_module("modules.games.klaverjas_game")
+restore_game = importlib.import_module("modules.games.base").restore_game
+RealPlayer = klaverjas_game.RealPlayer
+
+message_ids = itertools.count(1) #shared by all bots, like Telegram never gives out a message_id twice
+
+class FakeOutbox(object):
+    def send(self, chat_id, text, **kwargs):
+        f = concurrent.futures.Future()
+        f.set_result((chat_id, next(message_ids)))
+        return f
+
+    def edit(self, ident, text, **kwargs): pass
+    def call(self, chat_id, func, *args, ident=None, **kwargs): pass
+
+class FakeScheduler(object):
+    '''Progresses a game right away until it waits for a user, instead of on timers'''
+    def schedule(self, game):
+        while game.progress_step() is not None: pass
+
+class FakeData(object):
+    def __init__(self):
+        self.games = {}
+        self.moves = {}
+        self.results = []
+
+    def add_game(self, game_type, game_id, data, date, is_active, version=0):
+        self.games[game_id] = {"game_type": game_type, "game_id": game_id, "game_data": data,
+                               "date": date, "is_active": is_active, "version": version}
+
+    def add_game_move(self, game_id, number, move):
+        moves = self.moves.setdefault(game_id, [])
+        assert number == len(moves)
+        moves.append(move)
+
+    def get_game_moves(self, game_id):
+        return list(self.moves.get(game_id, []))
+
+    def add_klaverjas_result(self, seed, game_id, result):
+        self.results.append((seed, game_id, result))
+
+    def copy(self):
+        data = FakeData()
+        data.games = {k: dict(v) for k, v in self.games.items()}
+        data.moves = {k: list(v) for k, v in self.moves.items()}
+        return data
+
+class FakeBot(object):
+    def __init__(self, data=None):
+        self.dataManager = data or FakeData()
+        self.messagelock = threading.Lock()
+        self.outbox = FakeOutbox()
+        self.telebot = types.SimpleNamespace(editMessageReplyMarkup=None, deleteMessage=None)
+        self.gamescheduler = FakeScheduler()
+
+@pytest.fixture(autouse=True)
+def fast_ai(monkeypatch):
+    #A budget of 0 solves one deal per batch, so the AI's only depend on their random state
+    monkeypatch.setattr(klaverjas_game, "AI_MOVE_TIME", 0)
+    monkeypatch.setattr(klaverjas_game, "ROUND_TIME", 0)
+    monkeypatch.setattr(klaverjas_game, "END_TIME", 0)
+
+def snapshot(g):
+    players = []
+    for p in g.players:
+        s = [p.name, p.is_playing, sorted(c.index for c in p.cards)]
+        if not isinstance(p, RealPlayer):
+            s += [p.knowledge(), p.points1, p.points2, [c.index for c in p.discarded]]
+        players.append(s)
+    return {"round": g.round, "currentplayer": g.currentplayer, "trump": getattr(g, "trump", None),
+            "points": (g.points1, g.points2, g.pointsglory1, g.pointsglory2), "glory": (g.glory, g.glory_lists),
+            "rounds": [[c.index for c in r] for r in g.round_lists], "trick": [c.index for c in g.cards_this_round],
+            "players": players, "callbacks": sorted((k, i, f.__name__) for k, (i, f) in g.callbacks.items()),
+            "status": g.status_messages, "active": g.is_active}
+
+def answer(g, button):
+    '''Presses a button of the keyboard the game waits for, returns False when there is none'''
+    if not g.callbacks: return False
+    ident, func = g.callbacks[max(g.callbacks)]
+    if func.__name__ == "_card_picked": button = min(button, len(g.playable_cards)-1)
+    func(ident, button, (555, "Piet"))
+    return True
+
+def play_out(g, button):
+    while answer(g, button): pass
+    return [m[:2] for m in g.moves if m[0] in ("t", "c", "g")]
+
+@pytest.mark.parametrize("seed,startingplayer,button", [("aaa", 0, 0), ("ulonrloyfp", 1, 1), ("bbb", 2, 0), ("ccc", 3, 1)])
+def test_restored_game_matches_live_game(seed, startingplayer, button):
+    bot = FakeBot()
+    g = klaverjas_game.Klaverjas(bot, 1, [(555, "Piet")], 0, seed, startingplayer=startingplayer)
+    restored = []
+    while True:
+        r = restore_game(FakeBot(bot.dataManager.copy()), bot.dataManager.games[g.game_id])
+        assert snapshot(r) == snapshot(g)
+        restored.append(r)
+        if not answer(g, button): break
+    assert bot.dataManager.results
+    live = [m[:2] for m in g.moves if m[0] in ("t", "c", "g")]
+    for r in restored[4::9]: #a restored game plays on like the live one did
+        assert play_out(r, button) == live
+
+def test_all_ai_game_saves_no_status_moves():
+    bot = FakeBot()
+    g = klaverjas_game.Klaverjas(bot, 1, [], 0, "aaa")
+    assert not g.is_active
+    moves = [json.loads(m) for m in bot.dataManager.moves[1]]
+    assert not [m for m in moves if m[0] == "s"]
+    assert len([m for m in moves if m[0] == "c"]) == 32
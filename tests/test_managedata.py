@@ -0,0 +1,123 @@
+import importlib
+import threading
+import time
+
+import pytest
+
+dataset = pytest.importorskip("dataset")
+pytest.importorskip("textblob")
+pytest.importorskip("telepot")
+
+from test_registry import FakeGame, registry
+from test_scheduler import wait_for
+
+@pytest.fixture
+def data(tmp_path, monkeypatch):
+    '''A ManageData on an empty database in tmp_path, without the encryption'''
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "password.txt").write_text("test") #read when managedata is imported
+    managedata = importlib.import_module("managedata")
+    m = managedata.ManageData.__new__(managedata.ManageData)
+    m.db = dataset.connect("sqlite:///data.db")
+    m.db.query("PRAGMA journal_mode=WAL")
+    m.reader = managedata.ReadPool("data.db")
+    m.games = m.db['Games']
+    m.game_moves = m.db['GameMoves']
+    m.maxgameid = 0
+    m.dummy = False
+    m.datalock = threading.Lock()
+    yield m
+    m.reader.close()
+    m.db.close()
+
+def test_games_in_use_are_not_closed(data):
+    old = int(time.time() - 30*24*3600)
+    for game_id in range(1, 7):
+        data.add_game(1, game_id, "", old, True, 1)
+    data.add_game(1, 7, "", int(time.time()), True, 1)
+    with data.datalock: #moves from before the last days
+        data.game_moves.insert({'game_id': 5, 'number': 0, 'move': "[]", 'time': old})
+    data.add_game_move(4, 0, "[]")
+    r = registry(5)
+    r[1] = FakeGame(1, children=[2, 3]) #a challenge that is still played
+    assert data.maintain_games(keep=r.open_ids, path="archive.db")["closed"] == 2
+    active = {row['game_id'] for row in data.games.find(is_active=True)}
+    assert active == {1, 2, 3, 4, 7}
+
+def test_old_inactive_games_are_archived_with_their_moves(data):
+    old = int(time.time() - 30*24*3600)
+    for game_id in range(1, 6):
+        data.add_game(1, game_id, "spel%d" % game_id, old, False, 1)
+        for number in range(game_id): data.add_game_move(game_id, number, "[%d]" % number)
+    data.add_game(1, 6, "", int(time.time()), False, 1) #too recent
+    data.add_game(1, 7, "", old, True, 1) #still active
+    data.add_game_move(7, 0, "[]")
+    assert data.archive_games(days=10, chunk_size=2, path="archive.db") == (5, 15)
+    assert {row['game_id'] for row in data.games.all()} == {6, 7}
+    assert [row['game_id'] for row in data.game_moves.all()] == [7]
+    archive = dataset.connect("sqlite:///archive.db")
+    games = {row['game_id']: row['game_data'] for row in archive['Games'].all()}
+    assert games == {i: "spel%d" % i for i in range(1, 6)}
+    moves = sorted((row['game_id'], row['number'], row['move']) for row in archive['GameMoves'].all())
+    assert moves == [(g, n, "[%d]" % n) for g in range(1, 6) for n in range(g)]
+    archive.close()
+    assert data.archive_games(days=10, path="archive.db") == (0, 0)
+
+def test_reads(data):
+    assert data.get_game_moves(1) == [] and data.load_game(1) is None #no tables yet
+    data.add_game(1, 1, "spel", 10, True, 2)
+    for number in (1, 0): data.add_game_move(1, number, "[%d]" % number)
+    assert data.get_game_moves(1) == ["[0]", "[1]"]
+    game = data.load_game(1)
+    assert type(game) is dict and (game['game_data'], game['version']) == ("spel", 2)
+    assert data.get_active_game_ids() == [(1, 1)]
+
+def test_reads_wait_for_a_free_connection(data):
+    data.add_game(1, 1, "", 10, True, 1)
+    pool = importlib.import_module("managedata").ReadPool("data.db", size=1)
+    rows = []
+    with pool.connection():
+        t = threading.Thread(target=lambda: rows.extend(pool.query("SELECT game_id FROM Games")))
+        t.start()
+        t.join(0.2)
+        assert t.is_alive() and pool.opened == 1
+    t.join(5)
+    assert rows == [{'game_id': 1}]
+    pool.close()
+    assert pool.opened == 0
+
+def message(i, chat_id=5):
+    return {'chat_id': chat_id, 'chat_type': "group", 'from_id': 1, 'from_name': "Piet",
+            'time': int(time.time()), 'text': "bericht %d" % i}
+
+def test_messages_are_written_in_batches(data):
+    log = importlib.import_module("managedata").MessageLog(data, batch=3, interval=60)
+    for i in range(2): log.add(message(i))
+    time.sleep(0.1)
+    assert log.written == 0
+    log.add(message(2))
+    assert wait_for(lambda: log.written == 3)
+    assert log.batches == 1
+    log.add(message(3))
+    log.close()
+    assert not log.thread.is_alive()
+    assert [r['text'] for r in data.reader.query("SELECT text FROM Messages ORDER BY id")] == ["bericht %d" % i for i in range(4)]
+    assert log.batches == 2
+
+def test_messages_are_written_after_the_interval(data):
+    log = importlib.import_module("managedata").MessageLog(data, batch=100, interval=0.05)
+    log.add(message(0))
+    assert wait_for(lambda: log.written == 1)
+    log.close()
+
+def test_latest_messages_include_the_buffered_ones(data):
+    data.message_log = importlib.import_module("managedata").MessageLog(data, batch=100, interval=60)
+    data.textlock = threading.Lock()
+    data.alltext = ""
+    for i in range(3):
+        m = message(i, chat_id=5 + i % 2)
+        data.write_message({'chat': {'id': m['chat_id'], 'type': m['chat_type']}, 'date': m['time'],
+                            'from': {'id': m['from_id'], 'first_name': m['from_name']}, 'text': m['text']})
+    assert [r['text'] for r in data.latest_messages(5)] == ["bericht 0", "bericht 2"]
+    assert data.alltext == "\nbericht 0\nbericht 1\nbericht 2"
+    data.message_log.close()
@@ -0,0 +1,83 @@
+import concurrent.futures
+import importlib
+import threading
+import time
+import types
+
+import pytest
+
+pytest.importorskip("telepot")
+Outbox = importlib.import_module("modules.games.outbox").Outbox
+base = importlib.import_module("modules.games.base")
+
+class SlowTelegram(object):
+    '''Sends nothing until release is set'''
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = []
+        self.message_id = 0
+
+    def sendMessage(self, chat_id, text, **kwargs):
+        assert self.release.wait(5)
+        self.message_id += 1
+        self.calls.append(("send", chat_id, text))
+        return {"chat": {"id": chat_id}, "message_id": self.message_id}
+
+    def editMessageText(self, ident, text, **kwargs):
+        self.calls.append(("edit", ident, text))
+
+def outbox():
+    bot = types.SimpleNamespace(telebot=SlowTelegram(), messagelock=threading.Lock())
+    bot.outbox = Outbox(bot, chat_interval=0, group_interval=0, global_interval=0)
+    return bot
+
+def test_pending_messages_can_be_edited():
+    bot = outbox()
+    pending = bot.outbox.send(5, "hoi")
+    done = bot.outbox.edit(pending, "doei")
+    assert not pending.done()
+    bot.telebot.release.set()
+    done.result(5)
+    assert bot.telebot.calls == [("send", 5, "hoi"), ("edit", (5, 1), "doei")]
+    bot.outbox.stop()
+
+def test_keyboards_are_registered_once_sent():
+    bot = outbox()
+    game = base.BaseGame(bot, 1, [(5, "Piet")], 0)
+    sent = []
+    future = game.send_keyboard_message(5, "Kies", ["a", "b"], None, sent.append)
+    assert not game.callbacks and game.next_callback == 1 #didn't wait for Telegram
+    bot.telebot.release.set()
+    future.result(5)
+    for _ in range(500): #the callback runs on the thread of the outbox, right after the result is set
+        if sent: break
+        time.sleep(0.01)
+    assert sent == [(5, 1)]
+    assert game.callbacks == {0: ((5, 1), None)}
+    bot.outbox.stop()
+
+def test_when_sent_leaves_out_failed_messages():
+    futures = [concurrent.futures.Future() for _ in range(3)]
+    got = []
+    base.when_sent(futures, got.append)
+    futures[0].set_result((1, 1))
+    futures[1].set_exception(ValueError())
+    assert not got
+    futures[2].set_result((3, 1))
+    assert got == [[(1, 1), (3, 1)]]
+    base.when_sent([], got.append)
+    assert got[-1] == []
+
+def test_queued_edits_are_merged():
+    bot = outbox()
+    first = bot.outbox.send(5, "hoi")
+    edits = [bot.outbox.edit((5, 1), str(i)) for i in range(3)]
+    bot.outbox.call(5, lambda *args: None, ident=(5, 1)) #like a new keyboard
+    later = bot.outbox.edit((5, 1), "daarna")
+    other = bot.outbox.edit((6, 1), "ander")
+    assert edits[0] is edits[1] is edits[2] and bot.outbox.merged == 2
+    bot.telebot.release.set()
+    for f in (first, later, other): f.result(5)
+    assert bot.telebot.calls == [("send", 5, "hoi"), ("edit", (5, 1), "2"),
+                                 ("edit", (5, 1), "daarna"), ("edit", (6, 1), "ander")]
+    bot.outbox.stop()
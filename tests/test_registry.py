@@ -0,0 +1,69 @@
+import importlib
+import types
+
+import pytest
+
+pytest.importorskip("telepot")
+GameRegistry = importlib.import_module("modules.games.registry").GameRegistry
+
+class FakeGame(object):
+    game_type = 1
+    def __init__(self, game_id, parent_id=None, children=()):
+        self.game_id = game_id
+        self.parent_id = parent_id
+        self.children = list(children)
+        self.is_active = True
+        self.saves = 0
+
+    def child_ids(self):
+        return self.children
+
+    def save_game_state(self):
+        self.saves += 1
+
+class FakeData(object):
+    def __init__(self, games=()):
+        self.games = {g.game_id: g for g in games}
+
+    def get_active_game_ids(self):
+        return [(game_id, 1) for game_id in self.games]
+
+    def load_game(self, game_id):
+        return self.games.get(game_id)
+
+def registry(max_live, games=()):
+    bot = types.SimpleNamespace(dataManager=FakeData(games),
+                                gamescheduler=types.SimpleNamespace(is_busy=lambda game_id: False))
+    return GameRegistry(bot, max_live)
+
+def test_least_recently_used_idle_games_are_dropped():
+    r = registry(2)
+    games = [FakeGame(i) for i in range(3)]
+    for g in games: r[g.game_id] = g
+    assert list(r.live) == [1, 2]
+    assert games[0].saves == 1
+    assert 0 in r #still active, so it can be loaded again
+
+def test_games_in_use_are_kept():
+    r = registry(1)
+    a, b, c = FakeGame(1), FakeGame(2), FakeGame(3)
+    r[1] = a
+    with r.use(1) as g:
+        assert g is a
+        r[2] = b
+        assert r.live[1] is a
+    assert not r.in_use
+    r[3] = c
+    assert 1 not in r.live and 2 not in r.live
+
+def test_use_of_unknown_game():
+    r = registry(1)
+    with pytest.raises(KeyError):
+        with r.use(5): pass
+    assert not r.in_use
+
+def test_open_ids_include_parents_and_children():
+    r = registry(5)
+    r[1] = FakeGame(1, children=[2, 3])
+    r[5] = FakeGame(5, parent_id=4)
+    assert r.open_ids() == {1, 2, 3, 4, 5}
@@ -0,0 +1,64 @@
+import itertools
+import random
+
+from klaverjas_sampler import DealSampler
+
+def random_constraints(r, n):
+    '''Hidden cards split over three players, of which some are known not to be with a player'''
+    cards = r.sample(range(32), n)
+    counts = [n//3, n//3, n - 2*(n//3)]
+    owner = {}
+    pos = 0
+    for p in range(3):
+        for i in cards[pos:pos+counts[p]]: owner[i] = p
+        pos += counts[p]
+    possible = [0, 0, 0]
+    for i in cards:
+        for p in range(3):
+            if p == owner[i] or r.random() < 0.6: possible[p] |= 1 << i
+    return possible, counts
+
+def brute_force(possible, counts):
+    cards = [i for i in range(32) if (possible[0] | possible[1] | possible[2]) >> i & 1]
+    deals = set()
+    for c0 in itertools.combinations(cards, counts[0]):
+        left = [i for i in cards if i not in c0]
+        for c1 in itertools.combinations(left, counts[1]):
+            c2 = [i for i in left if i not in c1]
+            hands = (c0, c1, c2)
+            if all(possible[p] >> i & 1 for p in range(3) for i in hands[p]):
+                deals.add(tuple(sum(1 << i for i in h) for h in hands))
+    return deals
+
+def test_count_and_all_deals_match_brute_force():
+    r = random.Random(5)
+    for n in (3, 6, 8, 9, 10):
+        for _ in range(6):
+            possible, counts = random_constraints(r, n)
+            expected = brute_force(possible, counts)
+            s = DealSampler(possible, counts)
+            deals = list(s.all_deals())
+            assert s.count == len(expected)
+            assert len(deals) == len(set(deals))
+            assert set(deals) == expected
+
+def test_samples_are_consistent_and_cover_all_deals():
+    r = random.Random(6)
+    possible, counts = random_constraints(r, 6)
+    expected = brute_force(possible, counts)
+    s = DealSampler(possible, counts)
+    seen = set(s.sample(r) for _ in range(50*len(expected)))
+    assert seen == expected
+
+def test_deals_budget():
+    r = random.Random(7)
+    possible, counts = random_constraints(r, 9)
+    s = DealSampler(possible, counts)
+    assert sorted(s.deals(r, samples=s.count)) == sorted(s.all_deals())
+    assert len(s.deals(r, samples=3)) == 3
+    assert len(s.deals(r, timeout=0)) == 1
+
+def test_no_consistent_deal():
+    s = DealSampler([0b11, 0b11, 0b11], [1, 1, 1])
+    assert s.count == 0
+    assert s.deals(random.Random(8), samples=10) == []
@@ -0,0 +1,74 @@
+import threading
+import time
+
+from scheduler import GameScheduler
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end: return False
+        time.sleep(0.01)
+    return True
+
+class StepGame(object):
+    '''Does a step for every delay in delays, and then waits for a user'''
+    def __init__(self, game_id, delays, block=None):
+        self.game_id = game_id
+        self.delays = list(delays)
+        self.steps = 0
+        self.block = block
+
+    def progress_step(self):
+        if self.block is not None: assert self.block.wait(5)
+        self.steps += 1
+        if self.delays: return self.delays.pop(0)
+        return None
+
+def test_steps_run_until_the_game_waits():
+    scheduler = GameScheduler()
+    game = StepGame(1, [0, 0.01, 0])
+    scheduler.schedule(game)
+    assert scheduler.is_busy(1)
+    assert wait_for(lambda: not scheduler.is_busy(1))
+    assert game.steps == 4
+    scheduler.stop()
+
+def test_scheduling_a_busy_game_progresses_it_again():
+    scheduler = GameScheduler()
+    release = threading.Event()
+    game = StepGame(1, [], release)
+    scheduler.schedule(game)
+    assert wait_for(lambda: 1 in scheduler.progressing)
+    scheduler.schedule(game) #a user played while the AI is thinking
+    scheduler.schedule(game)
+    release.set()
+    assert wait_for(lambda: not scheduler.is_busy(1))
+    assert game.steps == 2
+    scheduler.stop()
+
+def test_a_failing_step_stops_the_game():
+    scheduler = GameScheduler()
+    game = StepGame(1, [0])
+    game.progress_step = lambda: 1/0
+    scheduler.schedule(game)
+    assert wait_for(lambda: not scheduler.is_busy(1))
+    scheduler.stop()
+
+def test_at_most_max_searches_steps_run_at_once():
+    scheduler = GameScheduler(max_searches=2)
+    lock = threading.Lock()
+    running = [0, 0] # now, most
+    class SlowGame(StepGame):
+        def progress_step(self):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.02)
+            with lock: running[0] -= 1
+            return StepGame.progress_step(self)
+    games = [SlowGame(i, [0, 0]) for i in range(5)]
+    for g in games: scheduler.schedule(g)
+    assert wait_for(lambda: not any(scheduler.is_busy(g.game_id) for g in games))
+    assert [g.steps for g in games] == [3]*5
+    assert running[1] == 2
+    scheduler.stop()
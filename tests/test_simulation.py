@@ -0,0 +1,47 @@
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+from simulation import play_game, load_ai
+
+def test_runs_without_the_bot_modules():
+    code = "import sys, simulation; print(sorted(m for m in sys.modules if m.split('.')[0] in ('modules', 'telepot')))"
+    out = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.join(ROOT, "modules", "games"))
+    assert out.decode().strip() == "[]"
+
+def test_games_are_reproducible():
+    ai = load_ai("klaverjas_ai")
+    a = play_game((12, 1, ai, ai, 0))
+    b = play_game((12, 1, ai, ai, 0))
+    del a["seconds"], b["seconds"]
+    assert a == b
+    assert a["ai1_points"] + a["ai2_points"] >= 162
+
+def test_benchmark_ai_takes_the_arguments_of_play_card():
+    from cards import Cards
+    from decisions import DecisionCache
+    from simulation import SimulatedGame
+    from simulation.benchmark import TimedAI
+    g = SimulatedGame(3, [TimedAI]*4)
+    g.give_cards()
+    for p in g.players: p.set_trump(0)
+    c = g.players[0].play_card(1, Cards(), None, cache=DecisionCache(), cache_key=(3, 0, 0, ()))
+    assert c.owner == 0
+
+def test_nat_gives_the_points_to_the_defenders():
+    from simulation import SimulatedGame
+    ai = load_ai("klaverjas_ai")
+    g = SimulatedGame(1, [ai]*4)
+    g.points1, g.points2, g.pointsglory1 = 70, 112, 20
+    g.score_game()
+    assert (g.points1, g.points2, g.pointsglory1, g.pointsglory2) == (0, 182, 0, 20)
+    assert g.nat and not g.pit
+    g = SimulatedGame(1, [ai]*4)
+    g.points1, g.points2 = 81, 81 #a tie isn't nat
+    g.score_game()
+    assert (g.points1, g.points2) == (81, 81) and not g.nat
+    g = SimulatedGame(1, [ai]*4)
+    g.points1, g.points2 = 0, 162
+    g.score_game()
+    assert (g.points1, g.points2) == (0, 262) and g.nat and g.pit
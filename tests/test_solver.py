@@ -0,0 +1,76 @@
+import random
+
+from cards import Cards, index_to_card
+from klaverjas_ai2 import DummyPlayer, MinMaxer
+import klaverjas_solver
+from klaverjas_solver import Solver, evaluate_states
+
+def random_position(r, rounds_left, trick_size):
+    '''A random end of a game: rounds_left cards for every player, of which trick_size
+    are already played this round. Returns the arguments of a Solver.'''
+    deck = list(range(32))
+    r.shuffle(deck)
+    hands = [deck[i*rounds_left:(i+1)*rounds_left] for i in range(4)]
+    trump = r.randrange(4)
+    attacker = r.randrange(4)
+    playing = [(p - attacker) % 2 == 0 for p in range(4)]
+    round = 9 - rounds_left
+    points1 = r.randrange(0, 80)
+    points2 = r.randrange(0, 80)
+    first = r.randrange(4)
+    trick = []
+    s = Solver([sum(1 << i for i in h) for h in hands], trump, playing, points1, points2, first, round, [])
+    for _ in range(trick_size): #play legal cards to get a trick that can happen in a game
+        legal = s.legal_moves()
+        moves = [i for i in range(32) if legal >> i & 1]
+        index = r.choice(moves)
+        s.play(index)
+        trick.append(index)
+    return (list(s.hands), trump, playing, points1, points2, s.currentplayer, round, trick)
+
+def minmaxer_value(hands, trump, playing, points1, points2, currentplayer, round, trick):
+    def card(index, owner):
+        c = index_to_card(index)
+        c.is_trump = (c.color == trump)
+        c.owner = owner
+        return c
+    players = [DummyPlayer(p, playing[p], trump, Cards([card(i, p) for i in range(32) if hands[p] >> i & 1]))
+               for p in range(4)]
+    first = (currentplayer - len(trick)) % 4
+    played = Cards([card(index, (first + n) % 4) for n, index in enumerate(trick)])
+    p1, p2 = MinMaxer(players, trump, points1, points2, currentplayer, round, played).do_minmax()
+    return p1 - p2
+
+def test_solver_matches_minmaxer():
+    r = random.Random(3)
+    for n in range(60):
+        state = random_position(r, r.choice([2, 3, 4]), r.randrange(4))
+        assert Solver(*state).search() == minmaxer_value(*state), state
+
+def test_evaluate_takes_back_the_move():
+    r = random.Random(4)
+    state = random_position(r, 3, 1)
+    s = Solver(*state)
+    before = (list(s.hands), s.currentplayer, list(s.trick), s.points1, s.points2, s.round)
+    legal = s.legal_moves()
+    values = [s.evaluate(i) for i in range(32) if legal >> i & 1]
+    assert (list(s.hands), s.currentplayer, list(s.trick), s.points1, s.points2, s.round) == before
+    assert s.search() == (max(values) if s.playing[s.currentplayer] else min(values))
+
+def test_the_pool_gives_the_same_values():
+    r = random.Random(5)
+    hands, trump, playing, points1, points2, current, round, trick = random_position(r, 4, 0)
+    other = [i for p in range(4) if p != current for i in range(32) if hands[p] >> i & 1]
+    states = []
+    for _ in range(6): #deals of the other hands, like an AI solves them
+        r.shuffle(other)
+        deal = list(hands)
+        for k, p in enumerate(p for p in range(4) if p != current):
+            deal[p] = sum(1 << i for i in other[4*k:4*k+4])
+        states.append((deal, trump, playing, points1, points2, current, round, trick))
+    indices = [i for i in range(32) if hands[current] >> i & 1]
+    try:
+        assert evaluate_states(states, indices, 2) == evaluate_states(states, indices)
+    finally:
+        klaverjas_solver.close_pools()
+    assert not klaverjas_solver._pools
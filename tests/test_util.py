@@ -0,0 +1,207 @@
+import difflib
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+pytest.importorskip("telepot")
+from util import AliasIndex, Dispatcher, FuzzyIndex, PrefixMatcher, ThrottleStore, startswith
+
+from conftest import ROOT
+
+def random_word(r, alphabet="aaeeiioonrstlkdm h"):
+    return "".join(r.choice(alphabet) for _ in range(r.randint(1, 25)))
+
+def typo(r, word, alphabet="aaeeiioonrstlkdm h"):
+    '''word with up to three characters inserted, removed or replaced'''
+    l = list(word)
+    for _ in range(r.randint(0, 3)):
+        i = r.randrange(len(l)+1)
+        op = r.randrange(3)
+        if op == 0: l.insert(i, r.choice(alphabet))
+        elif op == 1 and l: l.pop(min(i, len(l)-1))
+        elif l: l[min(i, len(l)-1)] = r.choice(alphabet)
+    return "".join(l)
+
+def test_fuzzy_index_matches_difflib():
+    r = random.Random(3)
+    vocab = sorted({random_word(r) for _ in range(300)})
+    index = FuzzyIndex(vocab)
+    queries = [random_word(r) for _ in range(60)] + [typo(r, w) for w in r.sample(vocab, 60)] + [""]
+    for q in queries:
+        for n, cutoff in ((1, 0.9), (3, 0.6), (3, 0.75), (2, 0.99), (5, 1.0), (3, 0.0)):
+            assert index.get_close_matches(q, n, cutoff) == difflib.get_close_matches(q, vocab, n, cutoff), (q, n, cutoff)
+
+def test_fuzzy_index_remove():
+    index = FuzzyIndex(["hallo henk", "hallo hank", "doei"])
+    index.remove("hallo hank")
+    index.remove("niet er in")
+    assert "hallo hank" not in index and len(index) == 2
+    assert index.get_close_matches("hallo hank", 3, 0.6) == ["hallo henk"]
+
+def test_prefix_matcher_matches_startswith():
+    with open(os.path.join(ROOT, "commands.json")) as f:
+        commands = json.load(f)["commands"]
+    categories = list(commands)
+    matcher = PrefixMatcher() #built like Henk.compile_commands
+    for n, cmd in enumerate(categories):
+        for i, phrase in enumerate(commands[cmd]):
+            if phrase: matcher.add(phrase, cmd, (n, i))
+    phrases = [p for cmd in categories for p in commands[cmd]]
+    r = random.Random(4)
+    messages = ["", " "] + phrases
+    for _ in range(2000):
+        p = r.choice(phrases)
+        messages.append(p[:r.randint(0, len(p))] + r.choice(["", " ", " iets", "s", "x y"]))
+    for m in messages:
+        expected = None
+        for cmd in categories: #the loop the matcher replaced
+            s = startswith(m, commands[cmd])
+            if s:
+                expected = (s, cmd)
+                break
+        assert matcher.match(m) == expected, m
+
+def alias_groups(index):
+    return {q: (frozenset(index.synonyms(q)), Counter(index.responses_for(q))) for q in index.parent}
+
+def rebuilt_groups(response_rows, alias_rows):
+    '''The groups worked out from scratch, as the queries connected by the alias rows'''
+    queries = {call for _, call, _ in response_rows} | {q for _, a in alias_rows for q in a.split(" | ")}
+    groups = {q: {q} for q in queries}
+    for _, aliases in alias_rows:
+        qs = aliases.split(" | ")
+        merged = set().union(*(groups[q] for q in qs))
+        for q in merged: groups[q] = merged
+    return {q: (frozenset(g), Counter(o for _, call, response in response_rows if call in g for o in response.split(" | ")))
+            for q, g in groups.items()}
+
+def test_alias_index_updates_match_a_rebuild():
+    r = random.Random(2)
+    queries = ["q%d" % i for i in range(60)]
+    response_rows, alias_rows = [], []
+    index = AliasIndex()
+    for step in range(1500):
+        op = r.random()
+        user_id = r.randint(1, 3)
+        if op < 0.4:
+            row = (user_id, r.choice(queries), " | ".join("r%d" % r.randint(0, 9) for _ in range(r.randint(1, 3))))
+            response_rows.append(row)
+            index.add_response(*row)
+        elif op < 0.55:
+            row = (user_id, " | ".join(r.sample(queries, r.randint(2, 3))))
+            alias_rows.append(row)
+            index.add_alias(*row)
+        elif op < 0.85 and response_rows:
+            _, call, response = r.choice(response_rows)
+            response_rows = [row for row in response_rows if row != (user_id, call, response)]
+            index.delete_response(user_id, call, response)
+        elif alias_rows:
+            _, aliases = r.choice(alias_rows)
+            alias_rows = [row for row in alias_rows if row != (user_id, aliases)]
+            index.delete_alias(user_id, aliases)
+        if step % 25 == 0:
+            expected = rebuilt_groups(response_rows, alias_rows)
+            assert alias_groups(index) == expected, step
+            assert alias_groups(AliasIndex(response_rows, alias_rows)) == expected
+            assert set(index.fuzzy.words) == set(expected)
+
+def test_throttle_counts_decay_per_chat():
+    store = ThrottleStore(half_life=100)
+    store.increment(1, "hoi", now=0)
+    store.increment(1, "hoi", now=0)
+    assert store.count(1, "hoi", now=0) == 2
+    assert store.count(1, "hoi", now=100) == pytest.approx(1)
+    assert store.count(2, "hoi", now=0) == 0 #other chats don't see it
+    store.increment(1, "hoi", now=200) #decayed from the last time it was changed
+    assert store.count(1, "hoi", now=200) == pytest.approx(1.5)
+
+def test_throttle_drops_least_recently_used():
+    store = ThrottleStore(max_chats=2, max_counts=2)
+    store.increment(1, "a", now=0)
+    store.increment(1, "b", now=0)
+    store.increment(1, "a", now=0)
+    store.increment(1, "c", now=0) #"b" was used the longest ago
+    assert store.count(1, "b", now=0) == 0
+    assert store.count(1, "a", now=0) == 2 and store.count(1, "c", now=0) == 1
+    store.set_active(2, True)
+    store.increment(1, "a", now=0)
+    store.set_active(3, True) #chat 2 was used the longest ago
+    assert len(store) == 2
+    assert not store.is_active(2) and store.is_active(3)
+    assert store.count(1, "a", now=0) == 3
+    store.set_active(4, False) #a chat that isn't kept doesn't need to be added
+    assert len(store) == 2
+
+def test_dispatcher_keeps_the_order_of_a_chat():
+    dispatcher = Dispatcher(workers=4, max_pending=5)
+    r = random.Random(6)
+    handled = {chat: [] for chat in range(5)}
+    done = threading.Event()
+    total = 300
+    def handle(chat, n, sleep):
+        def func():
+            time.sleep(sleep)
+            handled[chat].append(n)
+            if sum(len(l) for l in handled.values()) == total: done.set()
+        return func
+    sent = {chat: [] for chat in handled}
+    for n in range(total):
+        chat = r.randrange(5)
+        sent[chat].append(n)
+        dispatcher.dispatch(chat, handle(chat, n, r.choice([0, 0, 0.001])), slow=r.random() < 0.4)
+    assert done.wait(10)
+    assert handled == sent
+    stats = dispatcher.stats()
+    assert stats["handled"] + stats["queued"] == total
+    assert stats["pending"] == 0 and stats["busy_chats"] == 0
+    assert stats["max_pending"] <= 5
+    dispatcher.stop()
+
+def test_dispatcher_handles_fast_messages_inline():
+    dispatcher = Dispatcher(workers=1)
+    release = threading.Event()
+    handled = []
+    dispatcher.dispatch(1, lambda: (release.wait(5), handled.append("slow")), slow=True)
+    dispatcher.dispatch(2, lambda: handled.append("other chat")) #doesn't wait for chat 1
+    assert handled == ["other chat"]
+    dispatcher.dispatch(1, lambda: handled.append("same chat")) #queued behind the slow one
+    assert handled == ["other chat"]
+    release.set()
+    for _ in range(500):
+        if len(handled) == 3: break
+        time.sleep(0.01)
+    assert handled == ["other chat", "slow", "same chat"]
+    dispatcher.stop()
+
+def test_alias_index_can_be_read_while_it_changes():
+    index = AliasIndex([(1, "q%d" % i, "r") for i in range(50)])
+    stop = threading.Event()
+    errors = []
+    def read():
+        r = random.Random()
+        while not stop.is_set():
+            try:
+                q = "q%d" % r.randrange(50)
+                if q in index: index.responses_for(q)
+                index.get_close_matches("q%d" % r.randrange(50), 3, 0.6)
+                index.random_group()
+            except Exception as e: #KeyError or a set that changed size while it was read
+                errors.append(e)
+                return
+    readers = [threading.Thread(target=read) for _ in range(3)]
+    for t in readers: t.start()
+    r = random.Random(7)
+    for _ in range(2000):
+        qs = ["q%d" % i for i in r.sample(range(50), 2)]
+        index.add_alias(1, " | ".join(qs))
+        index.add_response(1, "x%d" % r.randrange(20), "r")
+        index.delete_alias(1, " | ".join(qs))
+        index.delete_response(1, "x%d" % r.randrange(20), "r")
+    stop.set()
+    for t in readers: t.join()
+    assert not errors
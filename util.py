@@ -1,7 +1,14 @@
+import concurrent.futures
 import datetime
+import difflib
+import math
 import random
 import re
 import os
+import threading
+import time
+import traceback
+from collections import Counter, OrderedDict, defaultdict, deque
 
 import telepot
 
@@ -34,6 +41,32 @@ def startswith(s,l):
             return i
     return False
 
+class PrefixMatcher(object):
+    '''Finds which of a number of phrases a string starts with, by walking a trie of the
+    phrases along the string. Every phrase is added with a value and an order, and when
+    the string starts with more than one phrase, the one with the lowest order is found,
+    so it gives the same as trying the phrases one by one in that order.'''
+    def __init__(self):
+        self.root = {} # character -> node, where the key None holds (order, phrase, value)
+
+    def add(self, phrase, value, order):
+        node = self.root
+        for c in phrase:
+            node = node.setdefault(c, {})
+        if None not in node or order < node[None][0]:
+            node[None] = (order, phrase, value)
+
+    def match(self, s):
+        '''Returns (phrase, value) of the first phrase s starts with, or None'''
+        node = self.root
+        found = node.get(None)
+        for c in s:
+            node = node.get(c)
+            if node is None: break
+            entry = node.get(None)
+            if entry and (not found or entry[0] < found[0]): found = entry
+        return found[1:] if found else None
+
 def pick(l): #picks random element from list
     return random.sample(l,1)[0]
 
@@ -66,3 +99,350 @@ class Message(object):
         self.date = msg["date"]
 
         self.object = msg
+
+
+def qgrams(s, q):
+    return Counter(s[i:i+q] for i in range(len(s)-q+1))
+
+class FuzzyIndex(object):
+    '''A set of strings that finds the same matches as difflib.get_close_matches over all of
+    them, while only comparing with the strings that could be close enough. A string of
+    length la can only have a ratio of cutoff with strings whose length is in a range
+    around la. When T is the total length of both, they also need to have at least
+    (cutoff/2 - (q-1)*(1-cutoff))*T - (q-1) substrings of length q in common, as every
+    matching block of difflib of length n has n-q+1 of them and there are at most
+    (1-cutoff)*T + 1 blocks. For a cutoff of 0.9 that is a quarter of the characters for
+    q=3, and a third for q=2, which is used for strings too short for q=3.
+    A string that needs k of the m q-grams of the query has one of its m-k+1 rarest ones,
+    so only the strings in the index of those q-grams are counted. When the cutoff is too
+    low for the q-grams to rule anything out, only the length is used.'''
+    sizes = (3, 2) # The lengths of the substrings in the index, the most selective first
+
+    def __init__(self, words=()):
+        self.words = {} # string -> its q-grams
+        self.lengths = defaultdict(set) # length -> the strings of that length
+        self.postings = defaultdict(set) # q-gram -> the strings that have it
+        for w in words: self.add(w)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.words
+
+    def remove(self, word):
+        grams = self.words.pop(word, None)
+        if grams is None: return
+        self.lengths[len(word)].discard(word)
+        for g in grams:
+            self.postings[g].discard(word)
+
+    def add(self, word):
+        if word in self.words: return
+        grams = Counter()
+        for q in self.sizes: grams.update(qgrams(word, q))
+        self.words[word] = grams
+        self.lengths[len(word)].add(word)
+        for g in grams:
+            self.postings[g].add(word)
+
+    def candidates(self, word, cutoff):
+        '''Returns the strings that could have a ratio of at least cutoff with word'''
+        if cutoff <= 0: return list(self.words)
+        la = len(word)
+        lo = math.ceil(la*cutoff/(2-cutoff) - 1e-9)
+        hi = math.floor(la*(2-cutoff)/cutoff + 1e-9)
+        def needed(total): #q-grams in common needed for a total length
+            return math.ceil((cutoff/2 - (q-1)*(1-cutoff))*total - (q-1) - 1e-9)
+        for q in self.sizes:
+            least = needed(la + lo)
+            if least >= 1: break
+        else:
+            return [w for l in range(lo, hi+1) for w in self.lengths.get(l, ())]
+        grams = qgrams(word, q)
+        rare = sorted(grams.elements(), key=lambda g: len(self.postings.get(g, ())))[:la-q+2-least]
+        found = set()
+        for g in set(rare):
+            found.update(self.postings.get(g, ()))
+        result = []
+        for w in found:
+            if not lo <= len(w) <= hi: continue
+            other = self.words[w]
+            if sum(min(n, other[g]) for g, n in grams.items() if g in other) >= needed(la + len(w)):
+                result.append(w)
+        return result
+
+    def get_close_matches(self, word, n=3, cutoff=0.6):
+        '''Like difflib.get_close_matches(word, strings, n, cutoff)'''
+        return difflib.get_close_matches(word, self.candidates(word, cutoff), n, cutoff)
+
+class AliasIndex(object):
+    '''The queries Henk learned responses for, grouped by the aliases between them. The groups
+    are kept with union-find: every query points to a parent query in its group, and the
+    root of the group holds its members and the responses of all of them. Learning a
+    response or an alias changes the groups in place. Deleting an alias can split a group,
+    so the groups of its queries are worked out again from the aliases that are left.
+
+    The rows are kept as they are in the database, (user_id, call, response) and
+    (user_id, aliases), so deleting one here does the same as deleting it there.
+
+    The commands that learn and delete run on other threads than the messages that are
+    looked up, so the public methods hold self.lock, which also guards the FuzzyIndex, and
+    return copies of the lists. find, add_query, union and regroup expect it to be held.'''
+    def __init__(self, response_rows=(), alias_rows=()):
+        self.lock = threading.RLock()
+        self.parent = {} # query -> a query in the same group, the root points to itself
+        self.members = {} # root -> the queries in its group
+        self.pooled = {} # root -> the responses of all the queries in its group
+        self.responses = defaultdict(list) # query -> [(user_id, response)] learned for it
+        self.aliases = defaultdict(list) # query -> the [user_id, aliases, synonyms] rows it is in
+        self.fuzzy = FuzzyIndex() # for finding queries that are close to a message
+        for user_id, call, response in response_rows:
+            self.add_response(user_id, call, response)
+        for user_id, aliases in alias_rows:
+            self.add_alias(user_id, aliases)
+
+    def __contains__(self, query):
+        with self.lock: return query in self.parent
+
+    def __len__(self):
+        with self.lock: return len(self.parent)
+
+    def find(self, query):
+        '''Returns the root of the group of query'''
+        parent = self.parent
+        while parent[query] != query:
+            parent[query] = parent[parent[query]]
+            query = parent[query]
+        return query
+
+    def add_query(self, query):
+        if query in self.parent: return
+        self.parent[query] = query
+        self.members[query] = [query]
+        self.pooled[query] = []
+        self.fuzzy.add(query)
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b: return
+        if len(self.members[a]) < len(self.members[b]): a, b = b, a
+        self.parent[b] = a
+        self.members[a].extend(self.members.pop(b))
+        self.pooled[a].extend(self.pooled.pop(b))
+
+    def add_response(self, user_id, call, response):
+        '''Adds a response as saved by ManageData.add_response, with the options separated by " | "'''
+        with self.lock:
+            self.add_query(call)
+            self.responses[call].append((user_id, response))
+            self.pooled[self.find(call)].extend(response.split(" | "))
+
+    def add_alias(self, user_id, aliases):
+        '''Adds an alias as saved by ManageData.add_alias, so all its queries are in one group'''
+        row = [user_id, aliases, aliases.split(" | ")]
+        with self.lock:
+            for query in row[2]:
+                self.add_query(query)
+                self.aliases[query].append(row)
+                self.union(row[2][0], query)
+
+    def delete_response(self, user_id, call, response):
+        '''Deletes the responses like ManageData.delete_response does'''
+        with self.lock:
+            if call not in self.parent: return
+            self.responses[call] = [r for r in self.responses[call] if r != (user_id, response)]
+            self.regroup([call])
+
+    def delete_alias(self, user_id, aliases):
+        '''Deletes the aliases like ManageData.delete_alias does'''
+        queries = aliases.split(" | ")
+        with self.lock:
+            for query in queries:
+                if query in self.aliases:
+                    self.aliases[query] = [row for row in self.aliases[query] if row[:2] != [user_id, aliases]]
+            self.regroup([q for q in queries if q in self.parent])
+
+    def regroup(self, queries):
+        '''Works out the groups of these queries again, from their rows. Queries without
+        responses that aren't in any alias are forgotten, like a rebuild would.'''
+        queries = {q for query in queries for q in self.members[self.find(query)]}
+        for query in queries:
+            self.parent[query] = query
+            self.members.pop(query, None)
+            self.pooled.pop(query, None)
+        for query in queries:
+            if not self.responses.get(query) and not self.aliases.get(query):
+                del self.parent[query]
+                self.responses.pop(query, None)
+                self.aliases.pop(query, None)
+                self.fuzzy.remove(query)
+                continue
+            self.members[query] = [query]
+            self.pooled[query] = [o for _, response in self.responses[query] for o in response.split(" | ")]
+        for query in queries:
+            for row in self.aliases.get(query, ()):
+                for other in row[2]:
+                    self.union(query, other)
+
+    def group(self, query):
+        '''Returns an identifier of the group of query, which changes when groups merge'''
+        with self.lock: return self.find(query)
+
+    def synonyms(self, query):
+        with self.lock: return list(self.members[self.find(query)])
+
+    def responses_for(self, query):
+        '''Returns the responses of the group of query'''
+        with self.lock: return list(self.pooled[self.find(query)])
+
+    def random_group(self):
+        '''Returns the responses of a random group that has them, or an empty list'''
+        with self.lock:
+            groups = [r for r in self.pooled.values() if r]
+            return list(random.choice(groups)) if groups else []
+
+    def get_close_matches(self, word, n=3, cutoff=0.6):
+        with self.lock: return self.fuzzy.get_close_matches(word, n, cutoff)
+
+class ChatThrottle(object):
+    '''How much Henk has been talking in one chat'''
+    __slots__ = ("active", "counts")
+    def __init__(self):
+        self.active = False # whether someone has just talked to me here
+        self.counts = OrderedDict() # key -> (count, time it was counted at), the least recently used first
+
+class ThrottleStore(object):
+    '''The state Henk uses to not spam a chat, kept for every chat on its own so one busy
+    chat doesn't change how Henk behaves in another. Henk counts how often he reacted to
+    every query, and the counts halve every half_life seconds. They are only decayed when
+    they are read, from the time they were last changed, so there is nothing to sweep.
+    At most max_chats chats and max_counts counts per chat are kept, when there are more
+    the ones that weren't used for the longest time are dropped.'''
+    def __init__(self, half_life=1800, max_chats=1000, max_counts=200):
+        self.half_life = half_life
+        self.max_chats = max_chats
+        self.max_counts = max_counts
+        self.chats = OrderedDict() # chat_id -> ChatThrottle, the least recently used first
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.chats)
+
+    def chat(self, chat_id):
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = ChatThrottle()
+            if len(self.chats) > self.max_chats: self.chats.popitem(last=False)
+        else:
+            self.chats.move_to_end(chat_id)
+        return chat
+
+    def decayed(self, entry, now):
+        count, t = entry
+        return count * 0.5**(max(0, now - t)/self.half_life)
+
+    def count(self, chat_id, key, now=None):
+        '''Returns how often Henk reacted to key in this chat lately'''
+        if now is None: now = time.time()
+        with self.lock:
+            chat = self.chats.get(chat_id)
+            entry = chat and chat.counts.get(key)
+            if not entry: return 0.0
+            return self.decayed(entry, now)
+
+    def increment(self, chat_id, key, now=None):
+        if now is None: now = time.time()
+        with self.lock:
+            counts = self.chat(chat_id).counts
+            entry = counts.pop(key, None)
+            counts[key] = ((self.decayed(entry, now) if entry else 0.0) + 1, now)
+            if len(counts) > self.max_counts: counts.popitem(last=False)
+
+    def is_active(self, chat_id):
+        with self.lock:
+            chat = self.chats.get(chat_id)
+            return bool(chat and chat.active)
+
+    def set_active(self, chat_id, active):
+        with self.lock:
+            if not active and chat_id not in self.chats: return
+            self.chat(chat_id).active = active
+
+class Dispatcher(object):
+    '''Handles the chat messages and callback queries coming from the update loop. Messages
+    that are fast to handle are handled right away on the loop, slow ones (that wait for a
+    website, run an external program or play a game) go to a pool of worker threads so they
+    don't hold up the other chats.
+    Messages of a chat are always handled in the order they came in: while a chat has a
+    message in the pool, its next messages are queued behind it, even fast ones.
+
+    At most max_pending messages can be waiting in the pool. When there are more the update
+    loop waits until one is done, so a flood of slow commands slows down the loop instead
+    of piling up without end.'''
+    def __init__(self, workers=4, max_pending=100):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.queues = {} # chat_id -> deque of (time queued, function) for chats with messages in the pool
+        self.lock = threading.Lock()
+        self.handled = 0 # messages handled on the update loop
+        self.queued = 0 # messages handed to the pool
+        self.waits = 0 # times the update loop had to wait for a free slot
+        self.pending = 0
+        self.max_pending = 0 # the most messages that were in the pool at once
+        self.started = 0 # messages the pool started on
+        self.delay = 0.0 # total time those waited in the pool before they were started
+
+    def dispatch(self, chat_id, func, slow=False):
+        '''Calls func for a message in chat_id, now or in the pool'''
+        with self.lock:
+            inline = not slow and chat_id not in self.queues
+        if inline:
+            self.handled += 1
+            self.call(func)
+            return
+        if not self.slots.acquire(blocking=False):
+            self.waits += 1
+            print("Dispatcher: {:d} messages pending, waiting for a worker".format(self.pending))
+            self.slots.acquire()
+        with self.lock:
+            self.queued += 1
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+            queue = self.queues.get(chat_id)
+            if queue is not None: #the worker of this chat picks it up
+                queue.append((time.time(), func))
+                return
+            self.queues[chat_id] = deque([(time.time(), func)])
+        self.executor.submit(self.run, chat_id)
+
+    def run(self, chat_id):
+        while True:
+            with self.lock:
+                queue = self.queues[chat_id]
+                if not queue:
+                    del self.queues[chat_id]
+                    return
+                t, func = queue[0] #stays in the queue while it runs, so the next messages wait for it
+                self.started += 1
+                self.delay += time.time() - t
+            self.call(func)
+            with self.lock:
+                queue.popleft()
+                self.pending -= 1
+            self.slots.release()
+
+    def call(self, func):
+        try:
+            func()
+        except Exception:
+            traceback.print_exc()
+
+    def stats(self):
+        with self.lock:
+            return {"handled": self.handled, "queued": self.queued, "pending": self.pending,
+                    "max_pending": self.max_pending, "busy_chats": len(self.queues), "waits": self.waits,
+                    "average_delay": self.delay/max(1, self.started)}
+
+    def stop(self):
+        self.executor.shutdown(wait=False)